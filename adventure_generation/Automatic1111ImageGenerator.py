@@ -1,39 +1,114 @@
-import requests
-import json
 import base64
-from PIL import Image
 import io
 import os
-import random
-import string
+import atexit
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+# One pooled keep-alive connection pool for every backend
+from adventure_generation.http_transport import get_http_client
+from adventure_generation.image_store import save_image_b64, save_image_bytes
+from adventure_generation.telemetry import get_telemetry
+from adventure_generation.output_paths import output_path
+from adventure_generation.web_assets import process_pool
+
+# PIL names for the formats AC_A1111_FORMAT can ask for
+CONVERSION_FORMATS = {
+    "jpg": "JPEG",
+    "jpeg": "JPEG",
+    "webp": "WEBP",
+    "png": "PNG",
+}
+
+
+# Runs in a worker process, so decoding and encoding never hold up our threads
+def convert_image(b64_image, image_format):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(base64.b64decode(b64_image)))
+    if image_format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=image_format)
+    return output.getvalue()
+
+
+_pools_lock = threading.Lock()
+_process_pool = None
+
+
+# Spawned like the page workers (see web_assets.process_pool): it is first
+# used from the image job threads while the rest of the run is going on
+def _get_process_pool():
+    global _process_pool
+    with _pools_lock:
+        if _process_pool is None:
+            _process_pool = process_pool(max(1, (os.cpu_count() or 2) // 2))
+            atexit.register(shutdown)
+        return _process_pool
+
+
+# Stop the conversion workers once the run is over
+def shutdown():
+    global _process_pool
+    with _pools_lock:
+        pool, _process_pool = _process_pool, None
+    if pool is not None:
+        pool.shutdown()
 
 
 class Automatic1111ImageGenerator:
-    def __init__(self, base_url="http://localhost:7860"):
-        
-        # Allow the user to specify and IP address for an AUTOMATIC1111 server
-        if "AC_AUTO1111_SERVER" in os.environ:
-            self.base_url="http://{}:7860".format(
-                os.getenv("AC_AUTO1111_SERVER")
-            )
+    # server, pipeline_depth, output_format and the HTTP pool size come from
+    # the RunConfig (see BackendRegistry), the AC_* variables when not given
+    def __init__(self, base_url="http://localhost:7860", server=None, pipeline_depth=None, output_format=None, pool_size=None):
+
+        # Allow the user to specify and IP address for an AUTOMATIC1111 server,
+        # with a port of its own if it is not on the default one
+        server = server or os.getenv("AC_AUTO1111_SERVER")
+        if server:
+            self.base_url = "http://{}".format(server if ":" in server else f"{server}:7860")
         else:
             self.base_url = base_url
-            
+
         self.api_endpoint = f"{self.base_url}/sdapi/v1/txt2img"
 
+        # The server answers with PNG, which is written to disk as is. Setting
+        # AC_A1111_FORMAT (jpg, webp) converts it first, in a worker process.
+        output_format = output_format or os.getenv("AC_A1111_FORMAT") or ""
+        self.output_format = CONVERSION_FORMATS.get(output_format.lower())
+
+        # Requests sent to the server ahead of time. While the GPU renders one
+        # image the next request is already waiting, so it never sits idle on
+        # our side. AC_A1111_PIPELINE sets how many.
+        if pipeline_depth is None:
+            pipeline_depth = 2
+            if os.getenv("AC_A1111_PIPELINE") and os.getenv("AC_A1111_PIPELINE").isdigit():
+                pipeline_depth = int(os.getenv("AC_A1111_PIPELINE"))
+        self.pipeline_depth = max(1, pipeline_depth)
+        self._pipeline_pool = None
+        self.pool_size = pool_size
+
+    def _get_pipeline_pool(self):
+        with _pools_lock:
+            if self._pipeline_pool is None:
+                self._pipeline_pool = ThreadPoolExecutor(max_workers=self.pipeline_depth, thread_name_prefix="a1111")
+            return self._pipeline_pool
+
     def _send_request(self, payload):
         """Send a POST request to the AUTOMATIC1111 server and return the response."""
-        response = requests.post(self.api_endpoint, json=payload)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            print(f"Error: {response.status_code}")
-            print(response.text)
-            return None
+        with get_telemetry().call("a1111", "txt2img") as call:
+            response = get_http_client(self.pool_size).post(self.api_endpoint, json=payload)
+            if response.status_code == 200:
+                call.images = 1
+                return response.json()
+            else:
+                print(f"Error: {response.status_code}")
+                print(response.text)
+                return None
 
-    def generate_character_portrait(self, prompt):
-        prompt=f"Generate a character portrait based on the provided prompt. Must be safe for work:\n{prompt} "
-        payload = {
+    def _payload(self, prompt):
+        return {
             "prompt": prompt,
             "steps": 30,
             "width": 768,
@@ -44,56 +119,67 @@ class Automatic1111ImageGenerator:
             "negative_prompt": self.mega_negative_prompt()
         }
 
-        # Sending request
+    def _portrait_payload(self, prompt):
+        return self._payload(
+            f"Generate a character portrait based on the provided prompt. Must be safe for work:\n{prompt} "
+        )
+
+    def _map_payload(self, prompt):
+        return self._payload(
+            f"Generate a detailed isometric map based on the provided prompt:\n{prompt} "
+        )
+
+    # Render one image and store it, returns the file path
+    def _render(self, payload, output_dir):
         response = self._send_request(payload)
-        if response and "images" in response:
-            output_dir = "output/character_illustrations"
-            os.makedirs(output_dir, exist_ok=True)
+        if not response or not response.get("images"):
+            return None
+        return self._store(response["images"][0], output_dir)
 
-            filename = (
-                "".join(random.choices(string.ascii_letters + string.digits, k=8))
-                + ".jpg"
-            )
-            file_path = os.path.join(output_dir, filename)
+    def _store(self, b64_image, output_dir):
+        if self.output_format is None:
+            return save_image_b64(b64_image, output_dir)
+        converted = _get_process_pool().submit(convert_image, b64_image, self.output_format).result()
+        return save_image_bytes(converted, output_dir)
 
-            for i, img_data in enumerate(response["images"]):
-                image = Image.open(io.BytesIO(base64.b64decode(img_data)))
-                image.save(file_path)
-                print(f"Character portrait saved as {file_path}")
+    # txt2img's batch_size / n_iter only make variations of a single prompt, so
+    # a batch of different prompts is sent as one request per prompt, pipelined.
+    # Paths come back in the order of the prompts.
+    def _render_batch(self, payloads, output_dir):
+        futures = [
+            # copy_context keeps the telemetry labels of the calling job
+            self._get_pipeline_pool().submit(contextvars.copy_context().run, self._render, payload, output_dir)
+            for payload in payloads
+        ]
+        return [future.result() for future in futures]
 
-            return file_path
+    def generate_character_portrait(self, prompt):
+        file_path = self._render(self._portrait_payload(prompt), output_path("character_illustrations"))
+        if file_path:
+            print(f"Character portrait saved as {file_path}")
+        return file_path
+
+    # All the portraits of a region in one go
+    def generate_character_portrait_batch(self, prompts):
+        file_paths = self._render_batch(
+            [self._portrait_payload(prompt) for prompt in prompts], output_path("character_illustrations")
+        )
+        print(f"{len([path for path in file_paths if path])} character portraits saved")
+        return file_paths
 
     def generate_location_maps(self, prompt):
-        prompt=f"Generate a detailed isometric map based on the provided prompt:\n{prompt} "
-        payload = {
-            "prompt": prompt,
-            "steps": 30,
-            "width": 768,
-            "height": 768,
-            "sampler_name": "Euler a",
-            "seed": -1,
-            "cfg_scale": 7,
-            "negative_prompt": self.mega_negative_prompt()
-        }
+        file_path = self._render(self._map_payload(prompt), output_path("location_maps"))
+        if file_path:
+            print(f"Location Map saved as as {file_path}")
+        return file_path
 
-        # Sending request
-        response = self._send_request(payload)
-        if response and "images" in response:
-            output_dir = "location_maps"
-            os.makedirs(output_dir, exist_ok=True)
-
-            filename = (
-                "".join(random.choices(string.ascii_letters + string.digits, k=8))
-                + ".jpg"
-            )
-            file_path = os.path.join(output_dir, filename)
-
-            for i, img_data in enumerate(response["images"]):
-                image = Image.open(io.BytesIO(base64.b64decode(img_data)))
-                image.save(file_path)
-                print(f"Location Map saved as as {file_path}")
-
-            return file_path
+    # All the location maps of a region in one go
+    def generate_location_map_batch(self, prompts):
+        file_paths = self._render_batch(
+            [self._map_payload(prompt) for prompt in prompts], output_path("location_maps")
+        )
+        print(f"{len([path for path in file_paths if path])} location maps saved")
+        return file_paths
 
     def mega_negative_prompt(self):
         return """"""
@@ -62,3 +62,33 @@ class JsonStructures:
                 }
             }
         )
+
+    # Keys an item has to fill in before the rest of the pipeline can use it
+    required_keys = {
+        "location": ("name", "description", "lore"),
+        "character": ("name", "description", "personality"),
+        "encounter": ("encounter",),
+        "quest": ("name", "description"),
+        # The prompts (and their example JSON) put the description inside
+        # "regionDetails", which the region page reads
+        "region_description": ("regionDetails",),
+    }
+
+    # Models often drop the "encounter" wrapper when they write a list of them
+    def normalize(self, kind, item):
+        if kind == "encounter" and isinstance(item, dict) and "encounter" not in item:
+            if "description" in item:
+                return {"encounter": item}
+        return item
+
+    def validate(self, kind, item):
+        if not isinstance(item, dict):
+            return False
+        for key in self.required_keys[kind]:
+            if not item.get(key):
+                return False
+        if kind == "encounter":
+            return isinstance(item["encounter"], dict) and bool(
+                item["encounter"].get("description")
+            )
+        return True
@@ -0,0 +1,62 @@
+import importlib
+import threading
+
+# The model backends a pipeline can use. A provider's module (and with it
+# openai, ollama or PIL) is only imported, and its client only constructed,
+# the first time a stage asks for it: a FREE MODE run never loads the OpenAI
+# client unless the map analysis actually runs, a warm start with every
+# bootstrap stage cached loads no client at all, and a page rebuild none.
+
+PROVIDERS = {
+    "openai": ("adventure_generation.gpt4o_client", "GPT4oClient"),
+    "ollama": ("adventure_generation.ollama_client", "ollamaClient"),
+    "a1111": ("adventure_generation.Automatic1111ImageGenerator", "Automatic1111ImageGenerator"),
+}
+
+# The models of each provider by role. The clients use these, and the stage
+# cache keys can name a model without importing its client.
+DEFAULT_MODELS = {
+    "openai": {"map": "gpt-4o", "summary": "gpt-3.5-turbo-16k"},
+    "ollama": {"general_use": "llama3.1", "summary": "llama3.1"},
+}
+
+
+class BackendRegistry:
+    """The clients of one or more pipelines, by provider.
+
+    options holds the constructor arguments of a provider, e.g.
+    {"a1111": {"server": "gpu-box:7860"}}. register() puts in a client made
+    elsewhere (a shared one, or a stand-in).
+    """
+
+    def __init__(self, options=None):
+        self.options = dict(options or {})
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def register(self, provider, client):
+        with self._lock:
+            self._clients[provider] = client
+
+    def get(self, provider):
+        with self._lock:
+            if provider not in self._clients:
+                if provider not in PROVIDERS:
+                    raise ValueError(f"Unknown backend '{provider}', expected one of {sorted(PROVIDERS)}")
+                module_name, factory = PROVIDERS[provider]
+                module = importlib.import_module(module_name)
+                self._clients[provider] = getattr(module, factory)(**self.options.get(provider, {}))
+            return self._clients[provider]
+
+    # Providers whose clients exist so far
+    def loaded(self):
+        with self._lock:
+            return sorted(self._clients)
+
+    # The model a provider uses for a role, without constructing its client
+    def model(self, provider, role):
+        with self._lock:
+            client = self._clients.get(provider)
+        if client is not None and hasattr(client, f"{role}_model"):
+            return getattr(client, f"{role}_model")
+        return DEFAULT_MODELS[provider][role]
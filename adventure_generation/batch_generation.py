@@ -0,0 +1,125 @@
+import logging
+
+# Helpers for asking a model for several items of the same kind in one call.
+# The shared prompt (World Info, Writing Style...) is only sent once per batch
+# instead of once per item.
+
+# Roughly how many output tokens one item of each kind takes
+ITEM_TOKENS = {
+    "location": 300,
+    "character": 350,
+    "encounter": 300,
+}
+
+# Give up on batches after this many calls that did not return a single valid
+# item, and fall back to one call per missing item
+MAX_EMPTY_BATCHES = 2
+
+
+# Appended to a single-item prompt to turn it into a batch request
+def batch_instructions(count):
+    return f"""
+        BATCH INSTRUCTIONS: Instead of a single item, create {count} different items.
+        Return a JSON object with a single key "items" holding an array of exactly {count} objects.
+        Every object in the array must follow the Example JSON above. Make every item distinct from the others.
+        """
+
+
+# The answer to a numbered batch of prompt rewrites, {"prompts": {"1": ..., "2": ...}},
+# as a list in input order with None for every number the model skipped.
+# A plain list says nothing about which prompt is which, so it is only taken
+# when it has exactly one entry per input.
+def keyed_prompts(answer, count):
+    prompts = answer.get("prompts", answer) if isinstance(answer, dict) else answer
+    if isinstance(prompts, list):
+        if len(prompts) != count:
+            logging.warning(f"Expected {count} prompts, got {len(prompts)}: dropping the batch")
+            return [None] * count
+        prompts = {str(i): prompt for i, prompt in enumerate(prompts, 1)}
+    if not isinstance(prompts, dict):
+        return [None] * count
+    keyed = []
+    for i in range(1, count + 1):
+        prompt = prompts.get(str(i))
+        keyed.append(str(prompt).strip() if prompt is not None and str(prompt).strip() else None)
+    return keyed
+
+
+# How many items fit in one call, given the model's context window and output limit
+def batch_size(client, prompt, kind, wanted):
+    prompt_tokens = client.budget.count(prompt)
+    room = min(client.max_output_tokens, client.context_window - prompt_tokens)
+    return max(1, min(wanted, room // ITEM_TOKENS[kind]))
+
+
+def _items_from_response(response):
+    if isinstance(response, list):
+        return response
+    if not isinstance(response, dict):
+        return []
+    if isinstance(response.get("items"), list):
+        return response["items"]
+    # Models like to rename the key, take the first array we find
+    for value in response.values():
+        if isinstance(value, list):
+            return value
+    # ... or answer with a single item
+    return [response]
+
+
+def _valid_items(client, kind, response, limit):
+    valid = []
+    for item in _items_from_response(response):
+        item = client.jstructs.normalize(kind, item)
+        if client.jstructs.validate(kind, item):
+            valid.append(item)
+        else:
+            logging.warning(f"Dropping invalid {kind} from batch: {item}")
+    return valid[:limit]
+
+
+# The prompt of the next batch, with its size. The prompt for every missing
+# item is built once and sent as is when it fits; only a batch that has to be
+# cut is built again, smaller.
+def _next_batch(client, kind, build_prompt, first, missing):
+    prompt = build_prompt(first, missing)
+    size = batch_size(client, prompt, kind, missing)
+    if size < missing:
+        prompt = build_prompt(first, size)
+    return prompt, size
+
+
+# Collect `count` valid items. build_prompt(first, size) returns the prompt for
+# items first .. first + size - 1 and single(index) makes one classic
+# single-item call. Only the items that are still missing are asked for again.
+def generate_batch(client, kind, count, build_prompt, single):
+    items = []
+    empty_batches = 0
+    while len(items) < count and empty_batches < MAX_EMPTY_BATCHES:
+        prompt, size = _next_batch(client, kind, build_prompt, len(items), count - len(items))
+        response = client._chat_json(prompt, max_tokens=size * ITEM_TOKENS[kind] + 200)
+        valid = _valid_items(client, kind, response, size)
+        if not valid:
+            empty_batches += 1
+        items.extend(valid)
+
+    while len(items) < count:
+        items.append(single(len(items)))
+    return items
+
+
+# Async twin of generate_batch, `single` is a coroutine function
+async def agenerate_batch(client, kind, count, build_prompt, single):
+    items = []
+    empty_batches = 0
+    while len(items) < count and empty_batches < MAX_EMPTY_BATCHES:
+        prompt, size = _next_batch(client, kind, build_prompt, len(items), count - len(items))
+        response = await client._achat_json(prompt, max_tokens=size * ITEM_TOKENS[kind] + 200)
+        valid = _valid_items(client, kind, response, size)
+        if not valid:
+            empty_batches += 1
+        items.extend(valid)
+
+    while len(items) < count:
+        items.append(await single(len(items)))
+    return items
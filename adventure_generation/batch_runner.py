@@ -0,0 +1,243 @@
+import os
+import sys
+import json
+import queue
+import asyncio
+import argparse
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from adventure_generation.pipeline import Pipeline, RunConfig, close_async_pool
+from adventure_generation.context_extractor import ContextExtractor
+from adventure_generation.task_scheduler import TaskScheduler
+from adventure_generation.json_repair import get_repair_stats
+from adventure_generation.telemetry import get_telemetry
+from adventure_generation.llm_logging import configure_logging
+
+# Headless runner for many maps in one process:
+#
+#   python -m adventure_generation.batch_runner jobs.json
+#
+# jobs.json lists (context, map, settings) jobs, see sample_inputs/batch.json:
+#
+#   {"output": "output/jobs",
+#    "jobs": [{"name": "ariel_coast", "context": "ariel_coast.txt",
+#              "map": "ariel_coast.jpg", "settings": "styles.json"}, ...]}
+#
+# Paths are relative to the manifest. Every job writes to its own output root
+# (<output>/<name> unless the job sets "output"), so jobs never step on each
+# other's journal, shards, images or pages: each job has its own Pipeline,
+# made from one shared with for_root(). The clients, connection pool,
+# rate limiter, caches, worker pool and image queue are shared: the steps of
+# every job go into one task graph, so while one job waits on a slow chain
+# the others keep the quota busy.
+#
+# Nothing asks for input. A finished job (its expanded_world.json is there
+# and nothing is left in its journal) is skipped unless --force is given, an
+# interrupted one resumes. Running the same manifest again overnight picks up
+# whatever did not finish.
+
+DEFAULT_OUTPUT = "output/jobs"
+
+
+class BatchJob:
+    def __init__(self, name, prompt_file, map_image, settings, root):
+        self.name = name
+        self.prompt_file = prompt_file
+        self.map_image = map_image
+        self.settings = settings
+        self.root = root
+        self.pipeline = None
+        self.context_extractor = None
+        self.world = None
+        self.journal = None
+        self.store = None
+        self.output_queue = queue.Queue()
+        self.skipped = False
+        self.error = None
+
+    @property
+    def active(self):
+        return not self.skipped and self.error is None
+
+
+# Read the manifest: a list of jobs, or an object with "jobs" and "output"
+def load_manifest(path):
+    with open(path, "r") as file:
+        manifest = json.load(file)
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+    base = os.path.dirname(os.path.abspath(path))
+    output = manifest.get("output", DEFAULT_OUTPUT)
+
+    def resolve(value):
+        return value if os.path.isabs(value) else os.path.join(base, value)
+
+    jobs = []
+    names = set()
+    for entry in manifest.get("jobs", []):
+        name = entry.get("name") or os.path.splitext(os.path.basename(entry["map"]))[0]
+        # Two jobs on the same map still need their own roots
+        unique = name
+        suffix = 2
+        while unique in names:
+            unique = f"{name}-{suffix}"
+            suffix += 1
+        names.add(unique)
+        jobs.append(BatchJob(
+            unique,
+            resolve(entry["context"]),
+            resolve(entry["map"]),
+            resolve(entry["settings"]),
+            entry.get("output") or os.path.join(output, unique),
+        ))
+    return jobs
+
+
+# Map analysis, summaries and dice of one job, with a pipeline of its own
+# made from `pipeline`
+def prepare_job(job, pipeline, force=False):
+    job.pipeline = pipeline.for_root(job.root)
+    os.makedirs(job.root, exist_ok=True)
+    job.context_extractor = ContextExtractor(job.prompt_file, job.map_image, job.settings)
+    job.journal, job.store = job.pipeline.open_journal()
+
+    if len(job.journal) == 0 and os.path.exists(job.pipeline.expanded_world_path()) and not force:
+        print(f"[{job.name}] already finished, skipping (use --force to build it again)")
+        job.skipped = True
+        return
+
+    print(f"[{job.name}] preparing {job.map_image}")
+    job.world = job.pipeline.bootstrap_stages(job.context_extractor)
+    job.pipeline.plan_regions(job.world, job.journal, job.store)
+
+
+# Every region of every job on one task graph
+def run_threaded(jobs, image_queue, max_threads):
+    scheduler = TaskScheduler(max_threads)
+    for job in jobs:
+        # Task names carry the job, two maps may share region names
+        job_scheduler = scheduler.scoped(job.name)
+        for region in job.world['regions']:
+            job.pipeline.schedule_region_tasks(
+                job_scheduler, job.context_extractor, region, job.output_queue,
+                job.journal, job.store, image_queue,
+            )
+    try:
+        scheduler.run()
+    except Exception:
+        # Reported per job below, the other jobs ran to the end
+        pass
+    for job in jobs:
+        failed = [name for name in scheduler.errors if name.startswith(f"{job.name}:")]
+        if failed:
+            job.error = scheduler.errors[failed[0]]
+
+
+# Same on one event loop, with one in-flight limit for all jobs
+async def run_async(jobs, image_queue, max_in_flight):
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def run_job(job):
+        try:
+            await asyncio.gather(*(
+                job.pipeline.async_world_builder_task(
+                    job.context_extractor, region, semaphore, job.output_queue,
+                    job.journal, job.store, image_queue,
+                )
+                for region in job.world['regions']
+            ))
+        except Exception as e:
+            job.error = e
+
+    try:
+        await asyncio.gather(*(run_job(job) for job in jobs))
+    finally:
+        await close_async_pool()
+
+
+# Save the world and build the pages of a job whose regions are all done
+def finish_job(job, env=None):
+    job.pipeline.save_expanded_world(job.world, job.output_queue)
+    job.pipeline.generate_documents(env=env)
+    job.journal.clear()
+
+
+def run_batch(manifest_path, force=False, config=None):
+    config = config or RunConfig.from_env()
+    jobs = load_manifest(manifest_path)
+    if not jobs:
+        print(f"No jobs in {manifest_path}")
+        return 0
+
+    # One set of clients and one stage cache for every job
+    pipeline = Pipeline(config)
+
+    # The map analyses and summaries of all jobs run side by side
+    print(f"- preparing {len(jobs)} jobs")
+
+    def prepare(job):
+        try:
+            prepare_job(job, pipeline, force)
+        except Exception as e:
+            print(f"[{job.name}] could not be prepared: {e}")
+            job.error = e
+
+    with ThreadPoolExecutor(max_workers=min(len(jobs), max(1, config.max_threads))) as pool:
+        for future in [pool.submit(contextvars.copy_context().run, prepare, job) for job in jobs]:
+            future.result()
+
+    active = [job for job in jobs if job.active]
+    regions = sum(len(job.world['regions']) for job in active)
+    print(f"- building {regions} regions of {len(active)} jobs")
+
+    image_queue = pipeline.new_image_queue()
+    try:
+        if active:
+            if config.async_mode:
+                asyncio.run(run_async(active, image_queue, config.max_in_flight))
+            else:
+                run_threaded(active, image_queue, config.max_threads)
+    finally:
+        if image_queue is not None:
+            image_queue.join()
+
+    for job in active:
+        if job.error is not None:
+            print(f"[{job.name}] failed: {job.error}. Its journal is kept, run the batch again to resume it.")
+            continue
+        try:
+            finish_job(job)
+        except Exception as e:
+            print(f"[{job.name}] could not be saved: {e}")
+            job.error = e
+
+    get_repair_stats().log_summary()
+    get_telemetry().write_report()
+    transport = sys.modules.get("adventure_generation.http_transport")
+    if transport is not None:
+        transport.shutdown()
+    a1111 = sys.modules.get("adventure_generation.Automatic1111ImageGenerator")
+    if a1111 is not None:
+        a1111.shutdown()
+
+    print("Batch summary:")
+    for job in jobs:
+        status = "skipped" if job.skipped else ("FAILED" if job.error is not None else "done")
+        print(f" - {job.name}: {status} ({job.root})")
+    return 1 if any(job.error is not None for job in jobs) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the worlds of many maps in one run.")
+    parser.add_argument("manifest", help="JSON list of (context, map, settings) jobs")
+    parser.add_argument("--force", action="store_true", help="build finished jobs again")
+    args = parser.parse_args(argv)
+    configure_logging()
+    config = RunConfig.from_env()
+    print(config.banner())
+    return run_batch(args.manifest, args.force, config)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
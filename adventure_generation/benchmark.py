@@ -0,0 +1,284 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from adventure_generation.mock_backend import MockBackend, MockSettings, WORDS
+
+# End to end benchmark of the whole pipeline against the mock backends. For
+# every world size a synthetic map_description.json world is made up, served
+# as the map analysis answer, and `python -m adventure_generation.main` runs
+# on it in a fresh working directory. Reports wall time, calls per second and
+# the peak RSS of the run.
+#
+#   python -m adventure_generation.benchmark --regions 1 10 50 200
+#
+# AC_* settings in the environment (AC_MAX_THREADS, AC_ASYNC, AC_BATCH_ITEMS,
+# AC_STREAM, AC_LLM_CACHE...) are passed on, so two configurations can be
+# compared. With --baseline the run fails when wall time or memory grew more
+# than --tolerance over an earlier --output file, for CI.
+#
+# --startup times the start of the entry points instead, with no backend:
+# the wall time of each command and its imports as reported by
+# `python -X importtime`, with the packages that cost the most.
+#
+#   python -m adventure_generation.benchmark --startup --runs 5
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_INPUTS = os.path.join(os.path.dirname(PACKAGE_DIR), "sample_inputs")
+
+REGION_TYPES = ("bigTown", "smallTown", "NaturalFeature", "other")
+
+# Commands timed by --startup. "docs" starts a page rebuild of a root with no
+# world in it, which loads everything a rebuild needs up to the templates.
+STARTUP_COMMANDS = {
+    "import main": ["-c", "import adventure_generation.main"],
+    "import pipeline": ["-c", "import adventure_generation.pipeline"],
+    "import batch_runner": ["-c", "import adventure_generation.batch_runner"],
+    "import service": ["-c", "import adventure_generation.service"],
+    "docs": ["-m", "adventure_generation.main", "--docs", "no-world"],
+}
+
+
+# A map_description.json world of `count` regions with unique names
+def synthetic_world(count, seed=0):
+    rng = random.Random(f"world:{seed}:{count}")
+    regions = []
+    for i in range(count):
+        words = [rng.choice(WORDS).capitalize() for _ in range(2)]
+        regions.append({
+            "LocationName": f"{' '.join(words)} {i + 1:03d}",
+            "LocationType": rng.choice(REGION_TYPES),
+            "ShortDescription": " ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + ".",
+        })
+    return {"regions": regions}
+
+
+def _peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss / scale
+
+
+# One run of main() on a world of `count` regions. Returns its measurements.
+def run_once(backend, count, args, base_env):
+    world = synthetic_world(count, args.seed)
+    backend.settings.world = world
+    backend.reset_stats()
+
+    workdir = tempfile.mkdtemp(prefix=f"ac-bench-{count}-")
+    # main() finds its templates relative to the working directory
+    os.symlink(PACKAGE_DIR, os.path.join(workdir, "adventure_generation"))
+    with open(os.path.join(workdir, "map_description.json"), "w") as file:
+        json.dump(world, file, indent=4)
+
+    env = dict(base_env, PYTHONPATH=workdir)
+    command = [
+        sys.executable, "-m", "adventure_generation.main",
+        os.path.join(SAMPLE_INPUTS, "ariel_coast.txt"),
+        os.path.join(SAMPLE_INPUTS, "ariel_coast.jpg"),
+        os.path.join(SAMPLE_INPUTS, "styles.json"),
+    ]
+    log_path = os.path.join(workdir, "run.log")
+    started = time.monotonic()
+    with open(log_path, "w") as log:
+        process = subprocess.Popen(
+            command, cwd=workdir, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT
+        )
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.monotonic() - started
+
+    stats = backend.stats()
+    calls = stats.get("requests", 0)
+    result = {
+        "regions": count,
+        "exit_code": process.returncode,
+        "wall_seconds": round(wall, 3),
+        "calls": calls,
+        "calls_per_second": round(calls / wall, 2) if wall else 0.0,
+        "rate_limited": stats.get("rate_limited", 0),
+        "malformed": stats.get("malformed", 0),
+        "peak_rss_mb": round(_peak_rss_mb(usage), 1),
+        "endpoints": {name: value for name, value in stats.items()
+                      if name not in ("requests", "rate_limited", "malformed")},
+    }
+    if process.returncode != 0:
+        result["log"] = log_path
+        print(f"  run on {count} regions failed (exit {process.returncode}), see {log_path}")
+    elif args.keep:
+        result["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def _environment(backend, args):
+    env = dict(os.environ)
+    env.update(backend.environment())
+    env.update({
+        "AC_ASSUME_YES": "True",
+        "AC_SEED": str(args.seed),
+        "AC_USE_MONEY": "True" if args.backend == "openai" else "False",
+        "AC_CREATE_IMAGES": "True" if args.images else "False",
+    })
+    if args.small:
+        env["AC_DEBUG"] = "True"
+    return env
+
+
+# Self time of every module from the -X importtime lines on stderr
+def parse_importtime(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|", 2)
+        if self_us.strip().isdigit():
+            modules[name.strip()] = int(self_us)
+    return modules
+
+
+# One start of a --startup command, best of args.runs
+def run_startup(name, command, args):
+    workdir = tempfile.mkdtemp(prefix="ac-startup-")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(PACKAGE_DIR))
+    best = None
+    for _ in range(args.runs):
+        started = time.monotonic()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", *command],
+            cwd=workdir, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True,
+        )
+        wall = time.monotonic() - started
+        modules = parse_importtime(process.stderr)
+        run = {"wall_ms": round(wall * 1000, 1), "import_ms": round(sum(modules.values()) / 1000, 1)}
+        if best is None or run["wall_ms"] < best["wall_ms"]:
+            packages = {}
+            for module, self_us in modules.items():
+                packages[module.split(".")[0]] = packages.get(module.split(".")[0], 0) + self_us
+            heaviest = sorted(packages.items(), key=lambda item: -item[1])[:3]
+            best = dict(run, command=name, modules=len(modules),
+                        heaviest=[f"{package} {self_us / 1000:.0f}ms" for package, self_us in heaviest])
+    shutil.rmtree(workdir, ignore_errors=True)
+    return best
+
+
+def print_startup_table(results):
+    print(f"{'command':<20} {'wall ms':>8} {'import ms':>9} {'modules':>8}  heaviest")
+    for result in results:
+        print(
+            f"{result['command']:<20} {result['wall_ms']:>8.1f} {result['import_ms']:>9.1f} "
+            f"{result['modules']:>8}  {', '.join(result['heaviest'])}"
+        )
+
+
+# Runs slower or bigger than the baseline by more than the tolerance
+def regressions(results, baseline, tolerance, key="regions", fields=("wall_seconds", "peak_rss_mb")):
+    found = []
+    previous = {result[key]: result for result in baseline.get("results", []) if key in result}
+    for result in results:
+        old = previous.get(result[key])
+        if old is None:
+            continue
+        label = f"{result[key]} regions" if key == "regions" else result[key]
+        for field in fields:
+            if old[field] and result[field] > old[field] * (1 + tolerance):
+                found.append(f"{label}: {field} {result[field]} (baseline {old[field]})")
+    return found
+
+
+def print_table(results):
+    print(f"{'regions':>8} {'wall s':>9} {'calls':>7} {'calls/s':>8} {'429s':>5} {'broken':>6} {'RSS MB':>8}")
+    for result in results:
+        print(
+            f"{result['regions']:>8} {result['wall_seconds']:>9.2f} {result['calls']:>7} "
+            f"{result['calls_per_second']:>8.1f} {result['rate_limited']:>5} {result['malformed']:>6} "
+            f"{result['peak_rss_mb']:>8.1f}" + ("" if result["exit_code"] == 0 else "  FAILED")
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against mock backends.")
+    parser.add_argument("--regions", type=int, nargs="+", default=[1, 10, 50], help="world sizes to run")
+    parser.add_argument("--runs", type=int, default=1, help="runs per world size")
+    parser.add_argument("--backend", choices=("openai", "ollama"), default="openai")
+    parser.add_argument("--images", action="store_true", help="also create images (DALL-E or AUTOMATIC1111)")
+    parser.add_argument("--small", action="store_true", help="one item of each kind per region (AC_DEBUG)")
+    parser.add_argument("--latency", type=float, default=0.05, help="median seconds per chat answer")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal spread, 0 for fixed")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="median seconds per image")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of OpenAI requests answered with 429")
+    parser.add_argument("--malformed", type=float, default=0.0, help="share of JSON answers sent broken")
+    parser.add_argument("--rpm", type=int, default=30000, help="OpenAI requests per minute to announce")
+    parser.add_argument("--tpm", type=int, default=150000000, help="OpenAI tokens per minute to announce")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed growth over the baseline")
+    parser.add_argument("--keep", action="store_true", help="keep the working directories of the runs")
+    parser.add_argument("--startup", action="store_true", help="time the start of the entry points instead")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        return startup_main(args)
+
+    settings = MockSettings(
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        image_latency=args.image_latency,
+        rate_limit_rate=args.rate_limit,
+        malformed_rate=args.malformed,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        seed=args.seed,
+    )
+    results = []
+    with MockBackend(settings) as backend:
+        env = _environment(backend, args)
+        for count in args.regions:
+            for run in range(args.runs):
+                print(f"- {count} regions, run {run + 1} of {args.runs}")
+                results.append(run_once(backend, count, args, env))
+
+    print_table(results)
+    report = {"settings": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+
+    failed = any(result["exit_code"] != 0 for result in results)
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for line in found:
+            print(f"Regression: {line}")
+        failed = failed or bool(found)
+    return 1 if failed else 0
+
+
+def startup_main(args):
+    results = [run_startup(name, command, args) for name, command in STARTUP_COMMANDS.items()]
+    print_startup_table(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"settings": vars(args), "results": results}, file, indent=4)
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            found = regressions(results, json.load(file), args.tolerance, "command", ("wall_ms", "import_ms"))
+        for line in found:
+            print(f"Regression: {line}")
+        failed = bool(found)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
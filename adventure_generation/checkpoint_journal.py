@@ -0,0 +1,70 @@
+import os
+import json
+import threading
+import logging
+
+
+class CheckpointJournal:
+    """Append-only record of every finished generation step.
+
+    Each line is one JSON object: {"region": ..., "step": ..., "index": ..., "output": ...}.
+    A step is written as soon as its LLM or image call returns, so an
+    interrupted run can pick up where it stopped instead of starting over.
+    """
+
+    def __init__(self, path="output/json_outputs/checkpoint_journal.jsonl"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as file:
+            data = file.read()
+        # A crash mid-write can leave a partial last line behind. It is cut
+        # off, or the next record would be appended to it and lost with it.
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logging.warning(f"Dropping a partial checkpoint line at the end of {self.path}")
+            with open(self.path, "r+b") as file:
+                file.truncate(end)
+            data = data[:end]
+        for line in data.decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                logging.warning(f"Skipping unreadable checkpoint line in {self.path}")
+                continue
+            key = (entry["region"], entry["step"], entry["index"])
+            self._entries[key] = entry["output"]
+        logging.info(f"Loaded {len(self._entries)} checkpoints from {self.path}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def has(self, region, step, index=0):
+        return (region, step, index) in self._entries
+
+    def get(self, region, step, index=0):
+        return self._entries.get((region, step, index))
+
+    def record(self, region, step, index, output):
+        line = json.dumps({"region": region, "step": step, "index": index, "output": output})
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a") as file:
+                file.write(line + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self._entries[(region, step, index)] = output
+
+    # Called once the whole world has been saved, the journal is not needed anymore
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -1,27 +1,176 @@
 import sys
 import os
 import json
+import hashlib
+import tempfile
 from jinja2 import Template, Environment, FileSystemLoader
+from adventure_generation.world_store import WorldStore
+from adventure_generation.web_assets import WebAssets, region_images, process_pool, ASSET_VERSION, WIDTHS
+
+REGION_TEMPLATE = 'region_template.html'
+
+# Which region went into which page, and the hash it was built from
+MANIFEST_NAME = '.build_manifest.json'
+
+
+def _page_name(region_name):
+    return f"{region_name.replace(' ', '_')}.html"
+
+
+# Render a region straight into its page, a chunk at a time. The page is
+# written to a temp file first, so a reader never sees half of it.
+# images maps the image paths of the region to their web sized copies, base
+# leads from the page back to the working directory (story_styling/, images).
+def _write_page(template, region, output_path, images, base):
+    directory = os.path.dirname(output_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            for chunk in template.generate(region=region, images=images, base=base):
+                file.write(chunk)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Every worker process compiles the template once, when it starts
+_worker_template = None
+
+
+def _init_worker(template_dir):
+    global _worker_template
+    _worker_template = Environment(loader=FileSystemLoader(template_dir)).get_template(REGION_TEMPLATE)
+
+
+def _render_in_worker(region, output_path, images, base):
+    _write_page(_worker_template, region, output_path, images, base)
+    return output_path
+
 
 class DocumentGenerator:
-    def __init__(self, json_path: str, template_dir: str, output_dir: str):
+    # env may be a Jinja environment kept between builds, so its compiled
+    # templates are reused
+    def __init__(self, json_path: str, template_dir: str, output_dir: str, workers=None, env=None):
         self.json_path = json_path
+        self.template_dir = template_dir
         self.output_dir = output_dir
-        self.env = Environment(loader=FileSystemLoader(template_dir))
+        self.env = env or Environment(loader=FileSystemLoader(template_dir))
+        self.workers = workers or os.cpu_count() or 1
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.base = os.path.relpath(os.getcwd(), os.path.abspath(output_dir)).replace(os.sep, '/')
+        self.assets = WebAssets(os.path.join(output_dir, 'assets'), self.workers)
 
+    # json_path is either the monolithic expanded_world.json or the directory
+    # of a WorldStore (world.json + regions/ + manifest.jsonl)
     def load_json(self):
+        if os.path.isdir(self.json_path):
+            return WorldStore(self.json_path).load_world()
         with open(self.json_path, 'r') as file:
             return json.load(file)
-    
+
+    # A template tweak rebuilds every page, so the templates (and the image
+    # sizes and the base the pages point at) are part of each hash
+    def _template_hash(self):
+        digest = hashlib.sha256(f"{ASSET_VERSION}:{WIDTHS}:{self.base}".encode('utf-8'))
+        for root, _, files in sorted(os.walk(self.template_dir)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as file:
+                    digest.update(name.encode('utf-8'))
+                    digest.update(file.read())
+        return digest.hexdigest()
+
+    # [(page name, content hash, load region)]. A WorldStore already keeps the
+    # hash of every shard, so unchanged regions are not even read.
+    def _region_sources(self):
+        if os.path.isdir(self.json_path):
+            store = WorldStore(self.json_path)
+            sources = []
+            for entry in store.manifest().values():
+                path = os.path.join(store.root, entry['file'])
+
+                def load(path=path):
+                    with open(path, 'r') as file:
+                        return json.load(file)
+
+                sources.append((_page_name(entry['region']), entry['sha256'], load))
+            return sources
+
+        with open(self.json_path, 'r') as file:
+            data = json.load(file)
+        return [
+            (
+                _page_name(region['LocationName']),
+                hashlib.sha256(json.dumps(region, sort_keys=True).encode('utf-8')).hexdigest(),
+                lambda region=region: region,
+            )
+            for region in data.get('regions', [])
+        ]
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest):
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(tmp_path, self.manifest_path)
+
+    # Only pages whose region or template changed since the last build are
+    # rendered again, spread over a process pool when there are several.
+    # Returns the number of pages rendered.
     def generate_html(self):
-        data = self.load_json()
-        for region in data.get('regions', []):
-            region_template = self.env.get_template('region_template.html')
-            rendered_html = region_template.render(region=region)
-            file_name = f"{region['LocationName'].replace(' ', '_')}.html"
-            with open(os.path.join(self.output_dir, file_name), 'w') as file:
-                file.write(rendered_html)
-    
+        os.makedirs(self.output_dir, exist_ok=True)
+        template_hash = self._template_hash()
+        # Without the web images every page needs building again
+        old_manifest = self._read_manifest() if self.assets.exists() else {}
+        manifest = {}
+        changed = []
+        for page, content_hash, load in self._region_sources():
+            build_hash = hashlib.sha256(f"{content_hash}:{template_hash}".encode('utf-8')).hexdigest()
+            manifest[page] = build_hash
+            output_path = os.path.join(self.output_dir, page)
+            if old_manifest.get(page) != build_hash or not os.path.exists(output_path):
+                changed.append((load, output_path))
+
+        # Web sized copies of the images on the changed pages, only the new
+        # ones are made
+        pages = [(load(), path) for load, path in changed]
+        images = self.assets.process(
+            [image for region, _ in pages for image in region_images(region)]
+        )
+        jobs = [
+            (region, path, {image: images[image] for image in region_images(region) if image in images}, self.base)
+            for region, path in pages
+        ]
+
+        if len(jobs) > 1 and self.workers > 1:
+            with process_pool(
+                min(self.workers, len(jobs)), initializer=_init_worker, initargs=(self.template_dir,),
+            ) as pool:
+                futures = [pool.submit(_render_in_worker, *job) for job in jobs]
+                for future in futures:
+                    future.result()
+        elif jobs:
+            template = self.env.get_template(REGION_TEMPLATE)
+            for job in jobs:
+                _write_page(template, *job)
+
+        # Pages of regions that are gone
+        for page in old_manifest.keys() - manifest.keys():
+            stale = os.path.join(self.output_dir, page)
+            if os.path.exists(stale):
+                os.remove(stale)
+
+        self._write_manifest(manifest)
+        print(f"{len(changed)} of {len(manifest)} region pages rebuilt")
+        return len(changed)
+
 def main(json_path, template_dir, output_dir):
     generator = DocumentGenerator(json_path, template_dir, output_dir)
     generator.generate_html()
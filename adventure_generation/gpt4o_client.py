@@ -1,27 +1,47 @@
 import os
+import asyncio
 import openai
 import json
-import requests
-import string
 import random
-import sys
 
 from adventure_generation.JsonStructures import JsonStructures
+from adventure_generation import batch_generation
+from adventure_generation.prompt_budget import PromptBudget
+from adventure_generation.json_repair import repair_json, JsonRepairError, get_repair_stats
+from adventure_generation.json_stream import JsonStreamParser, StreamOffSchema
+from openai.types.chat import ChatCompletion
 
 # To prevent rate limit issues
-import time
+from adventure_generation.rate_limiter import get_rate_limiter, estimate_tokens
 
-# Add logging to help track prompt issues
+# What the SDK used to retry by itself (its retries are off, see client):
+# 429s, 5xx answers and dropped or timed out connections
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+# To avoid paying twice for the same answer
+from adventure_generation.llm_cache import get_llm_cache
+
+# One pooled keep-alive connection pool for every backend
+from adventure_generation.http_transport import get_transport, get_async_transport
+from adventure_generation.image_store import save_image_b64, download_image
+from adventure_generation.output_paths import output_path
+from adventure_generation.backends import DEFAULT_MODELS
+
+# Add logging to help track prompt issues. Records are written by a
+# background thread (set up by the Pipeline, see llm_logging), prompts and
+# answers go to a separate sampled log.
 import logging
+from adventure_generation.llm_logging import log_body
 
-# Configure logging
-logging.basicConfig(
-    filename="output/llm_usage.log", level=logging.DEBUG, format="%(asctime)s - %(message)s"
-)
+# Latency, tokens, retries and cost of every call
+from adventure_generation.telemetry import get_telemetry
 
 
 class GPT4oClient:
-    def __init__(self):
+    # stream, prompt_tokens, the response cache and the HTTP pool size come
+    # from the RunConfig (see BackendRegistry), the AC_* variables when they
+    # are not given
+    def __init__(self, stream=None, prompt_tokens=None, cache=None, pool_size=None):
         self.api_key = os.getenv("OPENAI_API_KEY")
         openai.api_key = self.api_key
         self.system_role = """
@@ -34,8 +54,156 @@ class GPT4oClient:
         }
         self.image_storage = "images"
         self.jstructs = JsonStructures()
+        # gpt-4o-mini limits, used to size batched requests
+        self.context_window = 128000
+        self.max_output_tokens = 16384
+        # gpt-4o-mini could take far more, the budget keeps prompts (and the bill) small.
+        # 4000 tokens is about what the old 15KB limit let through.
+        if prompt_tokens is None:
+            prompt_tokens = 4000
+            if os.getenv("AC_PROMPT_TOKENS") and os.getenv("AC_PROMPT_TOKENS").isdigit():
+                prompt_tokens = int(os.getenv("AC_PROMPT_TOKENS"))
+        self.budget = PromptBudget("gpt-4o-mini", prompt_tokens)
+        # Models of the bootstrap stages, part of their stage cache keys
+        self.summary_model = DEFAULT_MODELS["openai"]["summary"]
+        self.map_model = DEFAULT_MODELS["openai"]["map"]
+        self._client = None
+        self._async_client = None
+        self._async_transport = None
+        self.rate_limiter = get_rate_limiter()
+        self.cache = cache or get_llm_cache()
+        self.pool_size = pool_size
+        self.repair_stats = get_repair_stats()
+        self.telemetry = get_telemetry()
+        self.max_rate_limit_retries = 5
+        # Stream JSON answers and hang up once the needed keys are in
+        self.stream = os.getenv("AC_STREAM") == "True" if stream is None else stream
+        self.max_stream_retries = 2
         logging.info("OpenAI Client initiated")
 
+    # The clients are only built when they are first used, so FREE MODE runs
+    # do not need an OpenAI key just to construct this class. Both ride on the
+    # shared connection pool. The SDK's own retries are off: a 429 has to reach
+    # the rate limiter instead of being slept through inside one thread.
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = openai.OpenAI(
+                api_key=self.api_key,
+                max_retries=0,
+                http_client=openai.DefaultHttpxClient(transport=get_transport(self.pool_size)),
+            )
+        return self._client
+
+    # Async connections can not outlive their event loop, so a new loop gets a new client
+    @property
+    def async_client(self):
+        transport = get_async_transport(self.pool_size)
+        if self._async_client is None or self._async_transport is not transport:
+            self._async_client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                max_retries=0,
+                http_client=openai.DefaultAsyncHttpxClient(transport=transport),
+            )
+            self._async_transport = transport
+        return self._async_client
+
+    # Every chat completion goes through here so the shared response cache can
+    # answer it first. dedupe=True is for pure transformations (summaries, fixes)
+    # whose answer can be shared by every identical request.
+    def _create_completion(self, dedupe=False, **kwargs):
+        return self.cache.fetch(
+            "openai",
+            kwargs,
+            lambda: self._send_completion(**kwargs),
+            encode=lambda response: response.model_dump_json(),
+            decode=ChatCompletion.model_validate_json,
+            dedupe=dedupe,
+        )
+
+    # Async twin of _create_completion
+    async def _acreate_completion(self, dedupe=False, **kwargs):
+        return await self.cache.afetch(
+            "openai",
+            kwargs,
+            lambda: self._asend_completion(**kwargs),
+            encode=lambda response: response.model_dump_json(),
+            decode=ChatCompletion.model_validate_json,
+            dedupe=dedupe,
+        )
+
+    # A failed attempt blocks the model in the shared rate limiter, for as long
+    # as the headers say or else for a jittered exponential backoff, so the
+    # next acquire of every thread waits it out
+    def _retry_later(self, model, attempt, error, call):
+        call.retry()
+        response = getattr(error, "response", None)
+        headers = response.headers if response is not None else None
+        if self.rate_limiter.update_from_headers("openai", model, headers):
+            logging.warning(f"{type(error).__name__} from OpenAI ({model}), attempt {attempt + 1}")
+        else:
+            delay = self.rate_limiter.backoff("openai", model, attempt)
+            logging.warning(
+                f"{type(error).__name__} from OpenAI ({model}), attempt {attempt + 1}, backing off {delay:.2f}s"
+            )
+
+    # The shared rate limiter decides if we have to wait, and the response
+    # headers keep its buckets honest.
+    def _send_completion(self, **kwargs):
+        model = kwargs["model"]
+        tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+        with self.telemetry.call("openai", model) as call:
+            for attempt in range(self.max_rate_limit_retries):
+                call.waited(self.rate_limiter.acquire("openai", model, tokens))
+                try:
+                    raw = self.client.chat.completions.with_raw_response.create(**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    self._retry_later(model, attempt, e, call)
+                    continue
+                self.rate_limiter.update_from_headers("openai", model, raw.headers)
+                response = raw.parse()
+                if response.usage:
+                    self.rate_limiter.settle("openai", model, tokens, response.usage.total_tokens)
+                    call.usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+                return response
+            raise RuntimeError(f"OpenAI kept rate limiting or failing {model}, giving up")
+
+    # Async twin of _send_completion
+    async def _asend_completion(self, **kwargs):
+        model = kwargs["model"]
+        tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+        with self.telemetry.call("openai", model) as call:
+            for attempt in range(self.max_rate_limit_retries):
+                call.waited(await self.rate_limiter.aacquire("openai", model, tokens))
+                try:
+                    raw = await self.async_client.chat.completions.with_raw_response.create(**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    self._retry_later(model, attempt, e, call)
+                    continue
+                self.rate_limiter.update_from_headers("openai", model, raw.headers)
+                response = raw.parse()
+                if response.usage:
+                    self.rate_limiter.settle("openai", model, tokens, response.usage.total_tokens)
+                    call.usage(response.usage.prompt_tokens, response.usage.completion_tokens)
+                return response
+            raise RuntimeError(f"OpenAI kept rate limiting or failing {model}, giving up")
+
+    # Same as _send_completion, for DALL-E. Image limits are per request only.
+    def _generate_image(self, **kwargs):
+        model = kwargs["model"]
+        with self.telemetry.call("openai", model) as call:
+            for attempt in range(self.max_rate_limit_retries):
+                call.waited(self.rate_limiter.acquire("openai", model))
+                try:
+                    raw = self.client.images.with_raw_response.generate(**kwargs)
+                except RETRYABLE_ERRORS as e:
+                    self._retry_later(model, attempt, e, call)
+                    continue
+                self.rate_limiter.update_from_headers("openai", model, raw.headers)
+                call.images = kwargs.get("n", 1)
+                return raw.parse()
+            raise RuntimeError(f"OpenAI kept rate limiting or failing {model}, giving up")
+
     # Service function to create messages for API calls
     def _create_messages(self, prompt):
         msgs = [
@@ -45,59 +213,248 @@ class GPT4oClient:
         return msgs
 
     # Service function to parse output json from API
-    def _parse_json(self, json_inputs):
+    def _parse_json(self, json_inputs, model="gpt-4o-mini"):
         try:
             dict_output = json.loads(json_inputs)
         except json.decoder.JSONDecodeError as e:
             logging.warning(f"Failed to decode JSON. Error: {e}")
-            abbreviated_json = self._fix_json_response(json_inputs)
-            dict_output = json.loads(abbreviated_json)
-
-        # Let's add a delay to stop hitting ratelimits
-        time.sleep(5)
+            dict_output = self._repair_json(json_inputs, model)
 
         # Log EVERY output from LLM to DEBUG
-        logging.debug(f"<<< OUTPUT FROM LLM:\n{json_inputs}")
+        log_body("output", json_inputs)
 
         return dict_output
-    
-    # Service function for downloading and saving DALL-E images
-    def _parse_url(self, image_url, image_storage):
-        # Am I overwriting the basic image storage, probably.
-        if image_storage:
-            self.image_storage = image_storage
 
-        # Does this folder exist? make it so.
-        if not os.path.exists(self.image_storage):
-            os.makedirs(self.image_storage)
+    # Async twin of _parse_json
+    async def _aparse_json(self, json_inputs, model="gpt-4o-mini"):
+        try:
+            dict_output = json.loads(json_inputs)
+        except json.decoder.JSONDecodeError as e:
+            logging.warning(f"Failed to decode JSON. Error: {e}")
+            dict_output = await self._arepair_json(json_inputs, model)
+
+        log_body("output", json_inputs)
 
-        # Create a random short jpg file name
-        # TODO: Get character names for image? Not a high priority.
-        filename = (
-            "".join(random.choices(string.ascii_letters + string.digits, k=8)) + ".jpg"
+        return dict_output
+
+    # Broken JSON is repaired locally first, the LLM fixer is the fallback
+    def _repair_json(self, json_inputs, model):
+        self.telemetry.count("openai", model, json_repairs=1)
+        try:
+            dict_output = repair_json(json_inputs)
+            self.repair_stats.record(model, "local")
+            return dict_output
+        except JsonRepairError as e:
+            logging.warning(f"{e}, asking the LLM to fix it")
+        try:
+            dict_output = repair_json(self._fix_json_response(json_inputs))
+        except JsonRepairError:
+            self.repair_stats.record(model, "failed")
+            raise
+        self.repair_stats.record(model, "llm")
+        return dict_output
+
+    # Async twin of _repair_json
+    async def _arepair_json(self, json_inputs, model):
+        self.telemetry.count("openai", model, json_repairs=1)
+        try:
+            dict_output = repair_json(json_inputs)
+            self.repair_stats.record(model, "local")
+            return dict_output
+        except JsonRepairError as e:
+            logging.warning(f"{e}, asking the LLM to fix it")
+        try:
+            dict_output = repair_json(await self._afix_json_response(json_inputs))
+        except JsonRepairError:
+            self.repair_stats.record(model, "failed")
+            raise
+        self.repair_stats.record(model, "llm")
+        return dict_output
+
+    # Service function to send a JSON prompt to gpt-4o-mini and parse the reply.
+    # `kind` names the JsonStructures item being asked for, so a streamed
+    # answer can be cut short once that item's required keys are in.
+    def _chat_json(self, prompt, max_tokens=1000, kind=None):
+        prompt = self.budget.fit(prompt, self._shorten_prompt)
+
+        log_body("input", prompt)
+        request = dict(
+            model="gpt-4o-mini",
+            messages=self._create_messages(prompt),
+            max_tokens=max_tokens,
+            temperature=1.1,
+            response_format={"type": "json_object"},
         )
-        file_path = os.path.join(self.image_storage, filename)
+        if self.stream and kind:
+            return self._stream_json(request, kind)
+        response = self._create_completion(**request)
+        return self._parse_json(response.choices[0].message.content)
 
-        # Download the image located at the generated URL and save it
-        image_data = requests.get(image_url).content
-        with open(file_path, "wb") as handler:
-            handler.write(image_data)
+    # Async twin of _chat_json
+    async def _achat_json(self, prompt, max_tokens=1000, kind=None):
+        prompt = await self.budget.afit(prompt, self._ashorten_prompt)
 
-        # Return the relative path of the downloaded image
-        return file_path
+        log_body("input", prompt)
+        request = dict(
+            model="gpt-4o-mini",
+            messages=self._create_messages(prompt),
+            max_tokens=max_tokens,
+            temperature=1.1,
+            response_format={"type": "json_object"},
+        )
+        if self.stream and kind:
+            return await self._astream_json(request, kind)
+        response = await self._acreate_completion(**request)
+        return await self._aparse_json(response.choices[0].message.content)
+
+    # Streamed version of a JSON chat call. An answer that goes off schema is
+    # dropped as soon as that is clear and asked for again. After
+    # max_stream_retries of those, a normal request is made instead.
+    def _stream_json(self, request, kind):
+        required_keys = self.jstructs.required_keys[kind]
+        for attempt in range(self.max_stream_retries):
+            try:
+                text = self.cache.fetch(
+                    "openai",
+                    dict(request, stream=True),
+                    lambda: self._send_stream(required_keys, **request),
+                    encode=str,
+                    decode=str,
+                )
+            except StreamOffSchema as e:
+                logging.warning(f"Streamed {kind} went off schema, attempt {attempt + 1}: {e}")
+                self.telemetry.count("openai", request["model"], retries=1)
+                continue
+            return self._parse_streamed_json(text, request["model"])
+        response = self._create_completion(**request)
+        return self._parse_json(response.choices[0].message.content)
+
+    # Async twin of _stream_json
+    async def _astream_json(self, request, kind):
+        required_keys = self.jstructs.required_keys[kind]
+        for attempt in range(self.max_stream_retries):
+            try:
+                text = await self.cache.afetch(
+                    "openai",
+                    dict(request, stream=True),
+                    lambda: self._asend_stream(required_keys, **request),
+                    encode=str,
+                    decode=str,
+                )
+            except StreamOffSchema as e:
+                logging.warning(f"Streamed {kind} went off schema, attempt {attempt + 1}: {e}")
+                self.telemetry.count("openai", request["model"], retries=1)
+                continue
+            return await self._aparse_streamed_json(text, request["model"])
+        response = await self._acreate_completion(**request)
+        return await self._aparse_json(response.choices[0].message.content)
+
+    # A stream we hung up on ends mid-object, closing it is routine and is not
+    # counted as a JSON repair
+    def _parse_streamed_json(self, text, model):
+        try:
+            return repair_json(text)
+        except JsonRepairError:
+            return self._parse_json(text, model)
+
+    async def _aparse_streamed_json(self, text, model):
+        try:
+            return repair_json(text)
+        except JsonRepairError:
+            return await self._aparse_json(text, model)
+
+    # Reads the stream until the required keys are complete, then closes the
+    # connection so OpenAI stops generating (and billing) the rest.
+    def _send_stream(self, required_keys, **kwargs):
+        model = kwargs["model"]
+        tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+        with self.telemetry.call("openai", model) as call:
+            for attempt in range(self.max_rate_limit_retries):
+                call.waited(self.rate_limiter.acquire("openai", model, tokens))
+                try:
+                    raw = self.client.chat.completions.with_raw_response.create(stream=True, **kwargs)
+                except RETRYABLE_ERRORS as e:
+                    self._retry_later(model, attempt, e, call)
+                    continue
+                self.rate_limiter.update_from_headers("openai", model, raw.headers)
+                parser = JsonStreamParser(required_keys)
+                stream = raw.parse()
+                try:
+                    for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parser.feed(chunk.choices[0].delta.content)
+                            if parser.complete:
+                                break
+                finally:
+                    stream.close()
+                    self.rate_limiter.settle(
+                        "openai", model, tokens,
+                        estimate_tokens(kwargs["messages"]) + len(parser.text) // 4,
+                    )
+                    # Streams do not report usage, these are estimates
+                    call.usage(estimate_tokens(kwargs["messages"]), len(parser.text) // 4)
+                return parser.text
+            raise RuntimeError(f"OpenAI kept rate limiting or failing {model}, giving up")
+
+    # Async twin of _send_stream
+    async def _asend_stream(self, required_keys, **kwargs):
+        model = kwargs["model"]
+        tokens = estimate_tokens(kwargs["messages"], kwargs.get("max_tokens"))
+        with self.telemetry.call("openai", model) as call:
+            for attempt in range(self.max_rate_limit_retries):
+                call.waited(await self.rate_limiter.aacquire("openai", model, tokens))
+                try:
+                    raw = await self.async_client.chat.completions.with_raw_response.create(
+                        stream=True, **kwargs
+                    )
+                except RETRYABLE_ERRORS as e:
+                    self._retry_later(model, attempt, e, call)
+                    continue
+                self.rate_limiter.update_from_headers("openai", model, raw.headers)
+                parser = JsonStreamParser(required_keys)
+                stream = raw.parse()
+                try:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            parser.feed(chunk.choices[0].delta.content)
+                            if parser.complete:
+                                break
+                finally:
+                    await stream.close()
+                    self.rate_limiter.settle(
+                        "openai", model, tokens,
+                        estimate_tokens(kwargs["messages"]) + len(parser.text) // 4,
+                    )
+                    # Streams do not report usage, these are estimates
+                    call.usage(estimate_tokens(kwargs["messages"]), len(parser.text) // 4)
+                return parser.text
+            raise RuntimeError(f"OpenAI kept rate limiting or failing {model}, giving up")
+    
+    # Service function for storing DALL-E images. We ask for b64_json, so the
+    # image comes with the response and no second request is needed; a URL is
+    # streamed to disk. Files are named by content hash.
+    def _save_image(self, image, image_storage):
+        directory = image_storage or self.image_storage
+        if image.b64_json:
+            return save_image_b64(image.b64_json, directory)
+        return self._parse_url(image.url, directory)
+
+    # Service function for downloading and saving DALL-E images
+    def _parse_url(self, image_url, image_storage):
+        return download_image(image_url, image_storage or self.image_storage, self.pool_size)
 
     # Service function for summarizing the user's input content 
     def _summarize_context(self, input_prompt):
         prompt = "Please summarize the user's input text into a shortened and organized format optimized for use later as context for language models:\n"
         prompt += input_prompt
-        response = openai.chat.completions.create(
-            model="gpt-3.5-turbo-16k",
+        response = self._create_completion(
+            dedupe=True,
+            model=self.summary_model,
             messages=self._create_messages(prompt),
             max_tokens=1000,
         )
-        time.sleep(10)
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        logging.debug(f">> OUTPUT FROM LLM:\n{response.choices[0].message.content}\n")
+        log_body("input", prompt)
+        log_body("output", response.choices[0].message.content)
         return response.choices[0].message.content
 
     # Service function for summarizing really long content
@@ -108,7 +465,8 @@ class GPT4oClient:
         If JSON output is requested, please be sure that JSON output is specified in the prompt. 
         Summarize stories to single sentences or cut unneeded details. Be brief. Do not include any headers or unneccessary text. Just the summay text, please:\n"""
         prompt += input_prompt
-        response = openai.chat.completions.create(
+        response = self._create_completion(
+            dedupe=True,
             model="gpt-3.5-turbo-16k",
             messages=self._create_messages(prompt),
             max_tokens=1000,
@@ -118,22 +476,57 @@ class GPT4oClient:
             output_content = response.choices[0].message.content
             output_content += "\nReturn this information in JSON format."
 
-        time.sleep(5)
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        logging.debug(f">> OUTPUT FROM LLM:\n{response.choices[0].message.content}\n")
+        log_body("input", prompt)
+        log_body("output", response.choices[0].message.content)
+        return output_content
+
+    # Async twin of _shorten_prompt
+    async def _ashorten_prompt(self, input_prompt):
+        prompt = """
+        This prompt is too long.
+        Please optimize this prompt for comsumption by gpt-4o-mini.
+        If JSON output is requested, please be sure that JSON output is specified in the prompt.
+        Summarize stories to single sentences or cut unneeded details. Be brief. Do not include any headers or unneccessary text. Just the summay text, please:\n"""
+        prompt += input_prompt
+        response = await self._acreate_completion(
+            dedupe=True,
+            model="gpt-3.5-turbo-16k",
+            messages=self._create_messages(prompt),
+            max_tokens=1000,
+        )
+        output_content = response.choices[0].message.content
+        if "JSON" not in output_content:
+            output_content += "\nReturn this information in JSON format."
+
+        log_body("input", prompt)
+        log_body("output", response.choices[0].message.content)
         return output_content
 
     # Service function for attempting to repair broken or incomplete json
     def _fix_json_response(self, input_response):
         prompt = "This json data is too long and not in properly formatted. Please make the content shorter and format in proper JSON. Input to be revised: \n"
         prompt += input_response
-        response = openai.chat.completions.create(
+        response = self._create_completion(
+            dedupe=True,
+            model="gpt-4o-mini",
+            messages=self._create_messages(prompt),
+            max_tokens=1000,
+            response_format={"type": "json_object"},
+        )
+        logging.warning(" --- Incomplete JSON data fix attempted.")
+        return response.choices[0].message.content
+
+    # Async twin of _fix_json_response
+    async def _afix_json_response(self, input_response):
+        prompt = "This json data is too long and not in properly formatted. Please make the content shorter and format in proper JSON. Input to be revised: \n"
+        prompt += input_response
+        response = await self._acreate_completion(
+            dedupe=True,
             model="gpt-4o-mini",
             messages=self._create_messages(prompt),
             max_tokens=1000,
             response_format={"type": "json_object"},
         )
-        time.sleep(5)
         logging.warning(" --- Incomplete JSON data fix attempted.")
         return response.choices[0].message.content
 
@@ -147,15 +540,57 @@ class GPT4oClient:
         Include wording to avoid using written text UNLESS it is the name of the location or person.\n
         """
         prompt += f"PROMPT: {input_prompt}"
-        response = openai.chat.completions.create(
+        response = self._create_completion(
+            dedupe=True,
             model="gpt-4o-mini",
             messages=self._create_messages(prompt),
             max_tokens=1000,
         )
-        time.sleep(5)
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        logging.debug(f">> OUTPUT FROM LLM:\n{response.choices[0].message.content}\n")
+        log_body("input", prompt)
+        log_body("output", response.choices[0].message.content)
         return response.choices[0].message.content
+
+    # Batched _optimize_dalle_prompt: one call for a list of prompts. Returns
+    # the optimized prompts in order, or fewer if the model lost some.
+    def _optimize_dalle_prompts(self, input_prompts):
+        prompt = """
+        Optimize each of the prompts below for DALL-E 3. 
+        Be sure to carefully select wording to best fit the visual style specified by the user.
+        Think of the artist medium and color palette when considering how to best render the lighting.
+        Good composition will be greatly prized by the audience.
+        Include wording to avoid using written text UNLESS it is the name of the location or person.
+        Answer in JSON as {"prompts": {"1": "...", "2": "..."}}, one optimized prompt per input prompt, under its number.\n
+        """
+        for i, input_prompt in enumerate(input_prompts, 1):
+            prompt += f"PROMPT {i}: {input_prompt}\n"
+        response = self._create_completion(
+            dedupe=True,
+            model="gpt-4o-mini",
+            messages=self._create_messages(prompt),
+            max_tokens=min(self.max_output_tokens, 1000 * len(input_prompts)),
+            response_format={"type": "json_object"},
+        )
+        log_body("input", prompt)
+        log_body("output", response.choices[0].message.content)
+        answer = self._parse_json(response.choices[0].message.content)
+        return batch_generation.keyed_prompts(answer, len(input_prompts))
+
+    # The DALL-E prompts before optimization
+    def character_portrait_prompt(self, character_description, illustration_style):
+        return f"""
+        Generate a detailed portrait of face and torso based on the following description: {character_description}
+        Please carefully render in standard american alphabetic characters the name of the character in a handwritten style once.\n
+        Illustration style: {illustration_style}
+        """.strip(
+            " \t\n\r"
+        )
+
+    def location_map_prompt(self, location_description, illustration_style):
+        return f"""
+        Draw a stylized map of this place: {location_description}. \n
+        Please carefully render in standard american alphabetic characters the name of the character in a handwritten style once. \n
+        Illustration style: {illustration_style}
+        """
     
     # This service function is used to count the words in a prompt [ DEPRECATED ]
     def _count_words_in_prompt(self, prompt_string):
@@ -164,18 +599,11 @@ class GPT4oClient:
         # Return the number of words
         return len(words)
 
-    # This service function is used to estimate the size of a prompt
-    def _get_size_of_string(self, string_var):
-        # Get the number of bytes of the string
-        byte_size = sys.getsizeof(string_var)
-        # Convert bytes to kilobytes
-        kb_size = byte_size / 1024
-        return kb_size
-
     # This is the step 1 map review
-    def generate_landscape_description(self, base64_image):
-        response = openai.chat.completions.create(
-            model="gpt-4o",
+    # hint adds instructions, for instance when the image is one tile of a map
+    def generate_landscape_description(self, base64_image, image_type="jpeg", hint=""):
+        response = self._create_completion(
+            model=self.map_model,
             messages=[
                 self.system_role_msg,
                 {
@@ -191,12 +619,12 @@ class GPT4oClient:
                     The shortDescription should be one to two lines at most.
                     Please pay detailed attention to the JSON formatting and using the correct key as described in the example. Incorrect key names breaks the program.
                     Example formatting: {\"regions\": [{\"LocationName\": \"\",\"LocationType\": \"\",\"ShortDescription\": \"\"},{\"LocationName\": \"\",\"LocationType\": \"\",\"ShortDescription\": \"\"}]}
-                    """,
+                    """ + hint,
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": f"data:image/{image_type};base64,{base64_image}"
                             },
                         },
                     ],
@@ -206,7 +634,7 @@ class GPT4oClient:
             temperature=1.25,
             response_format={"type": "json_object"},
         )
-        return self._parse_json(response.choices[0].message.content)
+        return self._parse_json(response.choices[0].message.content, model=self.map_model)
 
     # For each region, we generate a detailed description and some lore
     def generate_detailed_region_description(
@@ -214,7 +642,20 @@ class GPT4oClient:
     ):
         if region == "":
             return {}
+        return self._chat_json(
+            self._region_description_prompt(region, world_info, style_input), kind="region_description"
+        )
 
+    async def agenerate_detailed_region_description(
+        self, region, world_info="", style_input=""
+    ):
+        if region == "":
+            return {}
+        return await self._achat_json(
+            self._region_description_prompt(region, world_info, style_input), kind="region_description"
+        )
+
+    def _region_description_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Expand upon the simple description for this region. 
         Be sure to refer to the user-provided World Info and utilize the Writing Style.
@@ -228,30 +669,43 @@ class GPT4oClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
-        prompt += "{'description' : 'An example descriptive paragraph','lore' : 'Example history, mood or lore of this region in one paragraph'}"
+        prompt += "{'regionDetails' : {'description' : 'An example descriptive paragraph','lore' : 'Example history, mood or lore of this region in one paragraph'}}"
 
-        if self._get_size_of_string(prompt) >= 15:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
+    # Generate sublocations in the region
+    def generate_location(self, region, world_info="", style_input=""):
+        return self._chat_json(
+            self._location_prompt(region, world_info, style_input), kind="location"
+        )
 
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=self._create_messages(prompt),
-            max_tokens=1000,
-            temperature=1.1,
-            response_format={"type": "json_object"},
+    async def agenerate_location(self, region, world_info="", style_input=""):
+        return await self._achat_json(
+            self._location_prompt(region, world_info, style_input), kind="location"
         )
-        return self._parse_json(response.choices[0].message.content)
 
-    # Generate sublocations in the region
-    def generate_location(self, region, world_info="", style_input=""):
+    # Several locations in one call, see batch_generation
+    def generate_locations(self, region, count, world_info="", style_input=""):
+        return batch_generation.generate_batch(
+            self, "location", count,
+            lambda first, size: self._location_prompt(region, world_info, style_input)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.generate_location(region, world_info, style_input),
+        )
+
+    async def agenerate_locations(self, region, count, world_info="", style_input=""):
+        return await batch_generation.agenerate_batch(
+            self, "location", count,
+            lambda first, size: self._location_prompt(region, world_info, style_input)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.agenerate_location(region, world_info, style_input),
+        )
+
+    def _location_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Create a fictional signficant locations for the location of {}, a {}.
         Write a brief but creative description of the physical description and appearance of a place.
@@ -267,30 +721,17 @@ class GPT4oClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.generate_location()
 
-        if self._get_size_of_string(prompt) >= 15:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
-
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=self._create_messages(prompt),
-            max_tokens=1000,
-            temperature=1.1,
-            response_format={"type": "json_object"},
-        )
-        return self._parse_json(response.choices[0].message.content)
+        return prompt
     
     # this a helper class for characters
-    def _roll_d100(self, attribute_data):
-        roll = random.randint(1, 100)
+    def _roll_d100(self, attribute_data, dice):
+        roll = dice.randint(1, 100)
         for option, (lower, upper) in attribute_data.items():
             if lower <= roll <= upper:
                 return option
@@ -304,12 +745,56 @@ class GPT4oClient:
             lower_bound = upper_bound + 1
         return attribute_ranges
 
-    # Write character 
-    def generate_character(self, region, world_info="", style_input=""):
-        
+    # Write character. dice_seed seeds the demographics roll of this character
+    # (see WorldBuilder.dice_seed), so the same world sends the same prompt and
+    # a cached answer can be replayed. None rolls unseeded dice.
+    def generate_character(self, region, world_info="", style_input="", dice_seed=None):
+        return self._chat_json(
+            self._character_prompt(region, world_info, style_input, dice_seed), kind="character"
+        )
+
+    async def agenerate_character(self, region, world_info="", style_input="", dice_seed=None):
+        return await self._achat_json(
+            self._character_prompt(region, world_info, style_input, dice_seed), kind="character"
+        )
+
+    # Several characters in one call, each with their own demographics roll.
+    # dice_seeds holds the dice_seed of each of the `count` characters.
+    def generate_characters(self, region, count, world_info="", style_input="", dice_seeds=None):
+        dice_seeds = dice_seeds or [None] * count
+        return batch_generation.generate_batch(
+            self, "character", count,
+            lambda first, size: self._characters_prompt(
+                region, world_info, style_input, dice_seeds[first:first + size]
+            ),
+            lambda index: self.generate_character(region, world_info, style_input, dice_seeds[index]),
+        )
+
+    async def agenerate_characters(self, region, count, world_info="", style_input="", dice_seeds=None):
+        dice_seeds = dice_seeds or [None] * count
+        return await batch_generation.agenerate_batch(
+            self, "character", count,
+            lambda first, size: self._characters_prompt(
+                region, world_info, style_input, dice_seeds[first:first + size]
+            ),
+            lambda index: self.agenerate_character(region, world_info, style_input, dice_seeds[index]),
+        )
+
+    def _characters_prompt(self, region, world_info, style_input, dice_seeds):
+        prompt = self._character_prompt(region, world_info, style_input, dice_seeds[0])
+        prompt += batch_generation.batch_instructions(len(dice_seeds))
+        for i, dice_seed in enumerate(dice_seeds):
+            prompt += f"Character {i + 1}: {self._roll_demographics(region, dice_seed)}\n"
+        return prompt
+
+    # Roll race, gender, class... from the region's demographics tables, with
+    # dice of their own instead of the process random
+    def _roll_demographics(self, region, dice_seed=None):
+        dice = random.Random(dice_seed)
+
         # Get demographics for the region
         demographics = region.get('demographics', {})
-        
+
         # Convert percentages to cumulative ranges for all keys in demographics
         demographics_ranges = {}
         for key in demographics:
@@ -318,10 +803,13 @@ class GPT4oClient:
         # now demographics_ranges is a dictionary containing range information for each key in demographics
         str_attributes = []
         for attribute, attribute_data in demographics_ranges.items():
-            rolled_value = self._roll_d100(attribute_data)
+            rolled_value = self._roll_d100(attribute_data, dice)
             str_attributes.append(f"{attribute.capitalize()}: {rolled_value}")
 
-        final_string = "This character is a " + ", ".join(str_attributes) + "."
+        return "This character is a " + ", ".join(str_attributes) + "."
+
+    def _character_prompt(self, region, world_info, style_input, dice_seed=None):
+        final_string = self._roll_demographics(region, dice_seed)
 
         prompt = """
         INSTRUCTIONS: Create a fictional signficant character for the location of {}, a {}. 
@@ -339,29 +827,26 @@ class GPT4oClient:
             region["LocationName"],
             region["LocationType"],
             final_string,
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.generate_character()
 
-        if self._get_size_of_string(prompt) >= 15:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
-
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=self._create_messages(prompt),
-            max_tokens=1000,
-            temperature=1.1,
-            response_format={"type": "json_object"},
-        )
-        return self._parse_json(response.choices[0].message.content)
+        return prompt
 
     # Generate quest drama
     def generate_regional_drama(self, region, world_info="", style_input=""):
+        return self._chat_json(
+            self._regional_drama_prompt(region, world_info, style_input), kind="quest"
+        )
+
+    async def agenerate_regional_drama(self, region, world_info="", style_input=""):
+        return await self._achat_json(
+            self._regional_drama_prompt(region, world_info, style_input), kind="quest"
+        )
+
+    def _regional_drama_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Review all of the characteristics of the selected region and develop an interesting dilemma or quest for the region.
         These can be serious things like solving a crime, or mundane things like getting two old friends to forgive each other.
@@ -376,39 +861,61 @@ class GPT4oClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.generate_quest()
         
         prompt += "The sitatuation may involve the following characters or locations:"
         prompt += "\nCharacters:\n"
-        for i in region["characters"]:
-            if "personality" in region["characters"][i]:
-                prompt += f" - {region['characters'][i]['personality']}"
+        personalities = [
+            character["personality"]
+            for character in region["characters"].values()
+            if "personality" in character
+        ]
+        for personality in self.budget.trim_list("characters", personalities):
+            prompt += f" - {personality}\n"
 
         prompt += "\nSignificant locations:\n"
-        for i in region["locations"]:
-            if "lore" in region["locations"][i]:
-                prompt += f" - {region['locations'][i]['lore']}"
+        lore = [
+            location["lore"]
+            for location in region["locations"].values()
+            if "lore" in location
+        ]
+        for entry in self.budget.trim_list("locations", lore):
+            prompt += f" - {entry}\n"
 
-        if self._get_size_of_string(prompt) >= 15:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=self._create_messages(prompt),
-            max_tokens=1000,
-            temperature=1.1,
-            response_format={"type": "json_object"},
+    def generate_random_encounter(self, region, world_info):
+        return self._chat_json(
+            self._random_encounter_prompt(region, world_info), kind="encounter"
         )
-        return self._parse_json(response.choices[0].message.content)
 
-    def generate_random_encounter(self, region, world_info):
+    async def agenerate_random_encounter(self, region, world_info):
+        return await self._achat_json(
+            self._random_encounter_prompt(region, world_info), kind="encounter"
+        )
+
+    # A whole random encounter table in as few calls as the context allows
+    def generate_encounter_table(self, region, count, world_info):
+        return batch_generation.generate_batch(
+            self, "encounter", count,
+            lambda first, size: self._random_encounter_prompt(region, world_info)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.generate_random_encounter(region, world_info),
+        )
+
+    async def agenerate_encounter_table(self, region, count, world_info):
+        return await batch_generation.agenerate_batch(
+            self, "encounter", count,
+            lambda first, size: self._random_encounter_prompt(region, world_info)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.agenerate_random_encounter(region, world_info),
+        )
+
+    def _random_encounter_prompt(self, region, world_info):
         prompt = """
         INSTRUCTIONS: Review all of the characteristics of the selected region and create a short but interesting random encounter.
         Unlike a question prompt, this a description of an immediate situation that occurs and the players must react. These can be good or bad.
@@ -425,46 +932,40 @@ class GPT4oClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
         )
         prompt += self.jstructs.generate_random_encounter()
 
         prompt += "Characters:\n"
-        for character in region["characters"]:
+        characters = []
+        for character in region["characters"].values():
             if "description" in character and "personality" in character:
-                prompt += f" - {character['description']}. {character['personality']}."
+                characters.append(f"{character['description']}. {character['personality']}.")
             else:
                 logging.warning("missing important character elements")
+        for character in self.budget.trim_list("characters", characters):
+            prompt += f" - {character}\n"
 
         prompt += "Significant locations:\n"
-        for location in region["locations"]:
+        locations = []
+        for location in region["locations"].values():
             if "description" in location and "lore" in location:
-                prompt += f" - {location['description']}. {location['lore']}."
+                locations.append(f"{location['description']}. {location['lore']}.")
             else:
                 logging.warning("missing important location  elements")
+        for location in self.budget.trim_list("locations", locations):
+            prompt += f" - {location}\n"
 
-        if self._get_size_of_string(prompt) >= 15:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
-
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=self._create_messages(prompt),
-            max_tokens=1000,
-            temperature=1.1,
-            response_format={"type": "json_object"},
-        )
-        return self._parse_json(response.choices[0].message.content)
+        return prompt
 
     def generate_character_portrait(
         self,
         character_description,
         world_info,
         illustration_style,
-        image_storage="output/character_illustrations",
+        image_storage=None,
+        prompt=None,
     ):
 
         # Do not use promptless
@@ -472,23 +973,20 @@ class GPT4oClient:
             print("Warning: character_description cannot be empty. Operation aborted.")
             return None
 
-        prompt = f"""
-        Generate a detailed portrait of face and torso based on the following description: {character_description}
-        Please carefully render in standard american alphabetic characters the name of the character in a handwritten style once.\n
-        Illustration style: {illustration_style}
-        """.strip(
-            " \t\n\r"
-        )
-
-        prompt = self._optimize_dalle_prompt(prompt)
-        logging.debug(f"<< INPUT TO DALLE:\n{prompt}\n")
+        # An already optimized prompt (see PromptOptimizer) skips the rewrite
+        if prompt is None:
+            prompt = self._optimize_dalle_prompt(
+                self.character_portrait_prompt(character_description, illustration_style)
+            )
+        log_body("input", prompt, model="dall-e-3")
         try:
-            response = openai.images.generate(
+            response = self._generate_image(
                 model="dall-e-3",
                 prompt=prompt,
                 size="1024x1024",
                 quality="standard",
                 n=1,
+                response_format="b64_json",
             )
         except openai.BadRequestError as e:
             error_message = f"BadRequestError: {str(e)}\nPrompt: {prompt}\n"
@@ -498,15 +996,16 @@ class GPT4oClient:
             )
             return None
 
-        # Get the generated image URL
-        return self._parse_url(response.data[0].url, image_storage)
+        # Store the generated image
+        return self._save_image(response.data[0], image_storage or output_path("character_illustrations"))
 
     def generate_location_maps(
         self,
         location_description,
         world_info,
         illustration_style,
-        image_storage="output/location_maps",
+        image_storage=None,
+        prompt=None,
     ):
 
         # Do not use promptless
@@ -514,21 +1013,19 @@ class GPT4oClient:
             print("Warning: character_description cannot be empty. Operation aborted.")
             return None
 
-        prompt = f"""
-        Draw a stylized map of this place: {location_description}. \n
-        Please carefully render in standard american alphabetic characters the name of the character in a handwritten style once. \n
-        Illustration style: {illustration_style}
-        """
-
-        prompt = self._optimize_dalle_prompt(prompt)
-        logging.debug(f"<< INPUT TO DALLE:\n{prompt}\n")
+        if prompt is None:
+            prompt = self._optimize_dalle_prompt(
+                self.location_map_prompt(location_description, illustration_style)
+            )
+        log_body("input", prompt, model="dall-e-3")
         try:
-            response = openai.images.generate(
+            response = self._generate_image(
                 model="dall-e-3", 
                 prompt=prompt.strip(" \t\n\r"),
                 size="1024x1024",
                 quality="standard",
                 n=1,
+                response_format="b64_json",
             )
         except openai.BadRequestError as e:
             error_message = f"BadRequestError: {str(e)}\nPrompt: {prompt}\n"
@@ -538,15 +1035,28 @@ class GPT4oClient:
             )
             return None
 
-        # Get the generated image URL
-        return self._parse_url(response.data[0].url, image_storage)
+        # Store the generated image
+        return self._save_image(response.data[0], image_storage or output_path("location_maps"))
     
     def generate_regional_demographics(
         self, region, world_info="", style_input=""
     ):
         if region == "":
             return {}
+        return self._chat_json(
+            self._regional_demographics_prompt(region, world_info, style_input)
+        )
 
+    async def agenerate_regional_demographics(
+        self, region, world_info="", style_input=""
+    ):
+        if region == "":
+            return {}
+        return await self._achat_json(
+            self._regional_demographics_prompt(region, world_info, style_input)
+        )
+
+    def _regional_demographics_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Based on the provided region and world information, generate a list of possible races, genders, and classes or occupations that might be found in this region. Provide a probability or range table for each.
         Region Name: {} - a {}.
@@ -559,24 +1069,10 @@ class GPT4oClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.regional_demographics()
 
-        if self._get_size_of_string(prompt) >= 15:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
-
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-
-        response = openai.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=self._create_messages(prompt),
-            max_tokens=1000,
-            temperature=1.1,
-            response_format={"type": "json_object"},
-        )
-        return self._parse_json(response.choices[0].message.content)
+        return prompt
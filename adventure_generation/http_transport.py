@@ -0,0 +1,130 @@
+import os
+import asyncio
+import logging
+import threading
+import weakref
+
+import httpx
+
+# HTTP/2 needs the optional h2 package (pip install httpx[http2]). It is only
+# negotiated over TLS, so it applies to OpenAI; Ollama and AUTOMATIC1111 keep
+# using HTTP/1.1 keep-alive connections.
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Generous timeouts: a 30 step image or a long llama answer can take minutes
+DEFAULT_TIMEOUT = httpx.Timeout(600.0, connect=10.0)
+
+# Idle connections are kept this long (seconds) before they are closed
+KEEPALIVE_EXPIRY = 60.0
+
+
+def _env_int(name, default):
+    if os.getenv(name) and os.getenv(name).isdigit():
+        return int(os.getenv(name))
+    return default
+
+
+# Enough connections for every worker to have one request in flight plus a
+# few image downloads. AC_HTTP_POOL_SIZE overrides it. Pipelines pass the size
+# of their RunConfig instead, see Pipeline.backend_options.
+def pool_size():
+    concurrency = max(_env_int("AC_MAX_THREADS", 2), _env_int("AC_MAX_IN_FLIGHT", 8))
+    return _env_int("AC_HTTP_POOL_SIZE", concurrency + 4)
+
+
+def _limits(size):
+    return httpx.Limits(
+        max_connections=size,
+        max_keepalive_connections=size,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _http2():
+    return HTTP2_AVAILABLE and os.getenv("AC_HTTP2") != "False"
+
+
+# The clients that use a shared transport each think they own it and may try
+# to close it, only shutdown() really does.
+class _SharedTransport(httpx.HTTPTransport):
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+# Same for async clients. Their pool is closed by ashutdown(), before its
+# event loop goes away.
+class _SharedAsyncTransport(httpx.AsyncHTTPTransport):
+    async def aclose(self):
+        pass
+
+    async def shutdown(self):
+        await super().aclose()
+
+
+_lock = threading.RLock()
+# Pools by size: clients that ask for the same number of connections share one
+_transports = {}
+_http_clients = {}
+# Async connections belong to the event loop that opened them, so there are
+# async pools per loop
+_async_transports = weakref.WeakKeyDictionary()
+
+
+def get_transport(size=None):
+    """The connection pool shared by every synchronous HTTP call of this size
+    (pool_size() when not given)."""
+    size = size or pool_size()
+    with _lock:
+        if size not in _transports:
+            _transports[size] = _SharedTransport(limits=_limits(size), http2=_http2())
+            logging.info(f"HTTP pool: {size} connections, HTTP/2 {'on' if _http2() else 'off'}")
+        return _transports[size]
+
+
+def get_async_transport(size=None):
+    """The connection pool shared by every async HTTP call of this size on the running loop."""
+    size = size or pool_size()
+    loop = asyncio.get_running_loop()
+    with _lock:
+        transports = _async_transports.setdefault(loop, {})
+        if size not in transports:
+            transports[size] = _SharedAsyncTransport(limits=_limits(size), http2=_http2())
+        return transports[size]
+
+
+# For plain requests: image downloads and AUTOMATIC1111
+def get_http_client(size=None):
+    size = size or pool_size()
+    with _lock:
+        if size not in _http_clients:
+            _http_clients[size] = httpx.Client(
+                transport=get_transport(size), timeout=DEFAULT_TIMEOUT, follow_redirects=True
+            )
+        return _http_clients[size]
+
+
+# Close the pools of the running loop. Async connections can not outlive their
+# loop, so a coroutine handed to asyncio.run() that used a pool awaits this
+# at its end, see close_async_pool in pipeline.
+async def ashutdown():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        transports = _async_transports.pop(loop, {})
+    for transport in transports.values():
+        await transport.shutdown()
+
+
+# Close the pooled connections once the run is over
+def shutdown():
+    with _lock:
+        for transport in _transports.values():
+            transport.shutdown()
+        _transports.clear()
+        _http_clients.clear()
@@ -0,0 +1,134 @@
+import os
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+# How many image jobs of each backend run at once. DALL-E is mostly waiting on
+# OpenAI (the rate limiter keeps it honest), AUTOMATIC1111 renders one image
+# at a time on its GPU anyway.
+DEFAULT_CONCURRENCY = {
+    "dalle": 2,
+    "a1111": 1,
+}
+
+
+# The concurrency limits set with AC_DALLE_CONCURRENCY / AC_A1111_CONCURRENCY
+def concurrency_from_env():
+    concurrency = {}
+    for backend in DEFAULT_CONCURRENCY:
+        value = os.getenv(f"AC_{backend.upper()}_CONCURRENCY")
+        if value and value.isdigit() and int(value) > 0:
+            concurrency[backend] = int(value)
+    return concurrency
+
+
+class ImageJobQueue:
+    """Image jobs (portraits, location maps) running next to the text pipeline.
+
+    Every backend gets its own worker pool, sized by its concurrency limit, so
+    a slow AUTOMATIC1111 render never holds up DALL-E jobs and neither of them
+    takes a worker from the text steps. A failed job is logged and leaves its
+    image empty, the rest of the world still gets built.
+    """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = dict(DEFAULT_CONCURRENCY, **(concurrency or {}))
+        self._pools = {}
+        self._futures = []
+        self._lock = threading.Lock()
+        self.errors = {}
+        # A group shares the workers of the queue it came from, see group()
+        self._shared = False
+
+    # AC_DALLE_CONCURRENCY / AC_A1111_CONCURRENCY override the defaults
+    @classmethod
+    def from_env(cls):
+        return cls(concurrency_from_env())
+
+    # A queue that runs its jobs on the workers of this one, but only waits for
+    # its own jobs in join(). Jobs of several worlds built side by side share
+    # the image capacity, and each world can still tell when its images are done.
+    def group(self):
+        group = ImageJobQueue(self.concurrency)
+        group._pools = self._pools
+        group._lock = self._lock
+        group._shared = True
+        return group
+
+    def _pool(self, backend):
+        if backend not in self._pools:
+            self._pools[backend] = ThreadPoolExecutor(
+                max_workers=self.concurrency[backend], thread_name_prefix=f"images-{backend}"
+            )
+        return self._pools[backend]
+
+    def submit(self, backend, name, func, *args):
+        def run():
+            try:
+                return func(*args)
+            except Exception as e:
+                logging.error(f"Image job {name} failed: {e}")
+                print(f" - {name} failed: {e}")
+                with self._lock:
+                    self.errors[name] = e
+                return None
+
+        # The job runs in the context it was submitted from (output root,
+        # telemetry labels)
+        context = contextvars.copy_context()
+        with self._lock:
+            future = self._pool(backend).submit(context.run, run)
+            self._futures.append(future)
+        return future
+
+    # Call callback() once every future in futures is done. It runs on the
+    # worker that finished last, or right away when there is nothing to wait for.
+    def when_done(self, futures, callback):
+        futures = list(futures)
+        if not futures:
+            callback()
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        context = contextvars.copy_context()
+        # join() waits for this one too: a future counts as done before its
+        # done callbacks have run
+        finished = Future()
+        with self._lock:
+            self._futures.append(finished)
+
+        def one_done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                try:
+                    context.run(callback)
+                except Exception as e:
+                    logging.error(f"Image completion callback failed: {e}")
+                    print(f" - saving illustrated region failed: {e}")
+                finally:
+                    finished.set_result(None)
+
+        for future in futures:
+            future.add_done_callback(one_done)
+
+    # Wait for every job (and its completion callbacks), then stop the workers.
+    # A group leaves the shared workers running.
+    def join(self):
+        while True:
+            with self._lock:
+                pending = [future for future in self._futures if not future.done()]
+            if not pending:
+                break
+            wait(pending)
+        if self._shared:
+            return
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools = {}
+        for pool in pools:
+            pool.shutdown(wait=True)
+        if self.errors:
+            print(f" - {len(self.errors)} image jobs failed, see llm_usage.jsonl")
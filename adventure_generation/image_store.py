@@ -0,0 +1,89 @@
+import os
+import base64
+import hashlib
+import tempfile
+
+
+# Images are stored under the hash of their content: a rerender that comes
+# out identical lands on the same file instead of a second copy, and a file
+# name never points at half-written data because every image is written to a
+# temp file first and then moved into place.
+
+CHUNK_SIZE = 64 * 1024
+
+# File signatures of the formats our backends return
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+)
+
+
+def image_extension(head):
+    for signature, extension in _SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return ".bin"
+
+
+# Write the chunks to directory/<sha256><ext> and return that path
+def save_image_chunks(chunks, directory):
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    head = b""
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if len(head) < 16:
+                    head += chunk[: 16 - len(head)]
+                digest.update(chunk)
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        if not head:
+            raise ValueError("Received an empty image")
+
+        path = os.path.join(directory, digest.hexdigest()[:32] + image_extension(head))
+        if os.path.exists(path):
+            # Same picture as one we already have
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+        return path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_image_bytes(data, directory):
+    return save_image_chunks([data], directory)
+
+
+# Decode base64 a slice at a time instead of holding the whole image twice
+def _b64_chunks(b64_data, size=CHUNK_SIZE):
+    # A multiple of 4 characters always decodes on its own
+    step = (size // 3) * 4
+    for start in range(0, len(b64_data), step):
+        yield base64.b64decode(b64_data[start:start + step])
+
+
+def save_image_b64(b64_data, directory):
+    return save_image_chunks(_b64_chunks(b64_data), directory)
+
+
+# Stream a download straight to disk through the shared connection pool
+# (of pool_size connections, the default size when not given)
+def download_image(url, directory, pool_size=None):
+    # httpx is only loaded by runs that download
+    from adventure_generation.http_transport import get_http_client
+
+    with get_http_client(pool_size).stream("GET", url) as response:
+        response.raise_for_status()
+        return save_image_chunks(response.iter_bytes(CHUNK_SIZE), directory)
@@ -0,0 +1,225 @@
+import re
+import json
+import logging
+import threading
+from collections import defaultdict
+
+# Local repair for the almost-JSON that models send back. Handles the usual
+# suspects without another round trip to a model:
+#  - markdown code fences and chatter before (or after) the JSON
+#  - single-quoted strings and keys, like our own example JSON in the prompts
+#  - trailing commas
+#  - Python literals (True, False, None)
+#  - output that was cut off: open strings, arrays and objects are closed and
+#    a member without a value is dropped
+
+_FENCE = re.compile(r"```[a-zA-Z]*\s*\n?(.*?)(?:```|$)", re.S)
+_BARE_WORD = re.compile(r"[A-Za-z0-9_.+\-]+")
+_NUMBER = re.compile(r"-?\d+(\.\d+)?([eE][+-]?\d+)?")
+
+_LITERALS = {
+    "true": "true", "false": "false", "null": "null",
+    "True": "true", "False": "false", "None": "null",
+}
+
+
+class JsonRepairError(ValueError):
+    pass
+
+
+def _strip_wrapping(text):
+    match = _FENCE.search(text)
+    if match and ("{" in match.group(1) or "[" in match.group(1)):
+        text = match.group(1)
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise JsonRepairError("No JSON object or array found")
+    return text[min(starts):]
+
+
+def _drop_trailing(out, chars):
+    while out and out[-1].strip() == "":
+        out.pop()
+    if out and out[-1].rstrip()[-1:] in chars:
+        chunk = out.pop().rstrip()
+        if chunk[:-1]:
+            out.append(chunk[:-1])
+
+
+def _rewrite(text):
+    out = []
+    # One entry per open container: "{" or "["
+    stack = []
+    # For each open object, the index in out where its current member starts,
+    # so a member that was cut off before its value can be dropped
+    member_starts = []
+    i = 0
+    n = len(text)
+    while i < n:
+        char = text[i]
+
+        if char in "\"'":
+            quote = char
+            i += 1
+            chunk = ['"']
+            closed = False
+            while i < n:
+                char = text[i]
+                if char == "\\" and i + 1 < n:
+                    escaped = text[i + 1]
+                    # \' is not valid JSON, and an unescaped " is fine inside '...'
+                    chunk.append("'" if escaped == "'" else "\\" + escaped)
+                    i += 2
+                    continue
+                if char == quote:
+                    closed = True
+                    i += 1
+                    break
+                if char == '"':
+                    chunk.append('\\"')
+                elif char == "\n":
+                    chunk.append("\\n")
+                elif char == "\t":
+                    chunk.append("\\t")
+                else:
+                    chunk.append(char)
+                i += 1
+            if not closed:
+                # Cut off in the middle of a string
+                chunk.append('"')
+                out.append("".join(chunk))
+                break
+            chunk.append('"')
+            out.append("".join(chunk))
+            continue
+
+        if char in "{[":
+            stack.append(char)
+            out.append(char)
+            if char == "{":
+                member_starts.append(len(out))
+        elif char in "}]":
+            if not stack:
+                break
+            _drop_trailing(out, ",")
+            opener = stack.pop()
+            if opener == "{":
+                member_starts.pop()
+            out.append("}" if opener == "{" else "]")
+            if not stack:
+                # Anything after the top-level value is chatter
+                break
+        elif char == ",":
+            out.append(char)
+            if stack and stack[-1] == "{":
+                member_starts[-1] = len(out)
+        elif char == ":":
+            out.append(char)
+        elif char.isspace():
+            out.append(char)
+        else:
+            match = _BARE_WORD.match(text, i)
+            if not match:
+                # Stray character, skip it
+                i += 1
+                continue
+            word = match.group()
+            if word in _LITERALS:
+                out.append(_LITERALS[word])
+            elif _NUMBER.fullmatch(word):
+                out.append(word)
+            else:
+                # Bare keys and unquoted words become strings
+                out.append(json.dumps(word))
+            i = match.end()
+            continue
+        i += 1
+
+    # Close whatever the truncation left open
+    while stack:
+        opener = stack.pop()
+        if opener == "{":
+            start = member_starts.pop()
+            if not _member_complete(out[start:]):
+                del out[start:]
+            _drop_trailing(out, ",")
+            out.append("}")
+        else:
+            _drop_trailing(out, ",:")
+            out.append("]")
+    return "".join(out)
+
+
+# A member is complete when it has a key, a colon and a value
+def _member_complete(chunks):
+    significant = [chunk for chunk in chunks if chunk.strip()]
+    if not significant:
+        return True
+    if ":" not in significant:
+        return False
+    return significant[-1] != ":"
+
+
+def repair_json(text):
+    """Parse a model's JSON answer, repairing it locally if needed.
+
+    Raises JsonRepairError when the text can not be turned into JSON.
+    """
+    try:
+        return json.loads(text)
+    except json.decoder.JSONDecodeError:
+        pass
+    repaired = _rewrite(_strip_wrapping(text))
+    try:
+        return json.loads(repaired)
+    except json.decoder.JSONDecodeError as e:
+        raise JsonRepairError(f"Local JSON repair failed: {e}") from e
+
+
+class RepairStats:
+    """Counts how broken JSON answers were handled, per model.
+
+    outcome is one of:
+        local   - fixed by repair_json
+        llm     - needed the LLM fixer
+        failed  - nothing worked
+    """
+
+    OUTCOMES = ("local", "llm", "failed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = defaultdict(lambda: dict.fromkeys(self.OUTCOMES, 0))
+
+    def record(self, model, outcome):
+        with self._lock:
+            self.counts[model][outcome] += 1
+
+    def summary(self):
+        with self._lock:
+            report = {}
+            for model, counts in self.counts.items():
+                broken = sum(counts.values())
+                report[model] = dict(
+                    counts,
+                    broken=broken,
+                    local_success_rate=round(counts["local"] / broken, 3) if broken else None,
+                )
+            return report
+
+    def log_summary(self):
+        for model, report in self.summary().items():
+            message = (
+                f"JSON repair for {model}: {report['broken']} broken answers, "
+                f"{report['local']} fixed locally, {report['llm']} needed the LLM fixer, "
+                f"{report['failed']} failed"
+            )
+            logging.info(message)
+            print(message)
+
+
+_repair_stats = RepairStats()
+
+
+def get_repair_stats():
+    return _repair_stats
@@ -0,0 +1,92 @@
+# Follows a JSON object while a model is still streaming it, so the caller can
+# hang up as soon as every key it needs is there, or as soon as the answer is
+# clearly not the JSON object we asked for.
+
+# How much text a model may write before its JSON starts
+MAX_PRELUDE_CHARS = 200
+
+
+class StreamOffSchema(Exception):
+    pass
+
+
+class JsonStreamParser:
+    def __init__(self, required_keys=()):
+        self.required_keys = set(required_keys)
+        self.completed_keys = set()
+        self.text = ""
+        self.started = False
+        self.closed = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        # Top-level object members: the key being read, the key whose value
+        # is being read, and whether the next string at depth 1 is a key
+        self._key_chars = None
+        self._value_key = None
+        self._expect_key = False
+
+    @property
+    def complete(self):
+        return self.required_keys <= self.completed_keys
+
+    def feed(self, chunk):
+        for char in chunk:
+            self._feed_char(char)
+        self.text += chunk
+
+    def _feed_char(self, char):
+        if self.closed:
+            return
+
+        if not self.started:
+            if char == "{":
+                self.started = True
+                self._depth = 1
+                self._expect_key = True
+            elif len(self.text) > MAX_PRELUDE_CHARS:
+                raise StreamOffSchema("The answer does not start with a JSON object")
+            return
+
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._key_chars is not None:
+                    self._value_key = "".join(self._key_chars)
+                    self._key_chars = None
+                elif self._depth == 1:
+                    self._finish_value()
+            elif self._key_chars is not None:
+                self._key_chars.append(char)
+            return
+
+        if char == '"':
+            self._in_string = True
+            if self._depth == 1 and self._expect_key:
+                self._key_chars = []
+                self._expect_key = False
+        elif char in "{[":
+            self._depth += 1
+        elif char in "}]":
+            self._depth -= 1
+            if self._depth == 1:
+                # A nested value of a top-level key just closed
+                self._finish_value()
+            elif self._depth == 0:
+                self._finish_value()
+                self.closed = True
+                if not self.complete:
+                    missing = ", ".join(sorted(self.required_keys - self.completed_keys))
+                    raise StreamOffSchema(f"The JSON object is missing: {missing}")
+        elif char == "," and self._depth == 1:
+            self._finish_value()
+            self._expect_key = True
+
+    def _finish_value(self):
+        if self._value_key is not None:
+            self.completed_keys.add(self._value_key)
+            self._value_key = None
@@ -0,0 +1,241 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import logging
+from collections import Counter
+from concurrent.futures import Future
+
+# On-disk cache for LLM responses, shared by GPT4oClient and ollamaClient.
+#
+# Modes (AC_LLM_CACHE):
+#   off          - no caching (default)
+#   readthrough  - answer from the cache when we can, store every new response
+#   writeonly    - always call the model, but store every response
+#   replay       - only answer from the cache; a miss raises CacheMissError
+#
+# The key is a hash of the backend, model, messages, temperature, response
+# format and the user's run salt (AC_CACHE_SALT). Change the salt to get a
+# fresh world out of the same inputs.
+#
+# The pipeline sends the exact same prompt several times on purpose (ten
+# identical generate_location prompts give ten different locations), so for
+# sampled requests the key also carries how many times that request has been
+# made in this run. Pure transformations (summaries, prompt shortening, JSON
+# fixes) pass dedupe=True and share a single entry, and identical concurrent
+# ones are sent once.
+
+CACHE_MODES = ("off", "readthrough", "writeonly", "replay")
+
+
+class CacheMissError(LookupError):
+    pass
+
+
+class LLMCache:
+
+    def __init__(self, path="output/llm_cache.sqlite", mode="off", salt="", max_bytes=512 * 1024 * 1024):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode '{mode}', expected one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.salt = salt
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._occurrences = Counter()
+        self._inflight = {}
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)"
+            )
+            self._db.commit()
+        return self._db
+
+    # Build the cache key for a request. Only the fields that change the answer
+    # are hashed, so unrelated kwargs (max_tokens, stream...) do not split entries.
+    def make_key(self, backend, request, dedupe=False):
+        key_fields = {
+            "backend": backend,
+            "model": request.get("model"),
+            "messages": request.get("messages"),
+            "temperature": request.get("temperature"),
+            "response_format": request.get("response_format") or request.get("format"),
+            "salt": self.salt,
+        }
+        digest = hashlib.sha256(
+            json.dumps(key_fields, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        if dedupe:
+            return digest
+        with self._lock:
+            occurrence = self._occurrences[digest]
+            self._occurrences[digest] += 1
+        return f"{digest}:{occurrence}"
+
+    def get(self, key):
+        with self._lock:
+            db = self._connect()
+            row = db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            db.commit()
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self._evict(db)
+            db.commit()
+
+    # Drop least recently used entries until we are back under the size cap
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = db.execute("SELECT key, size FROM responses ORDER BY last_access ASC")
+        doomed = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            doomed.append((key,))
+            total -= size
+        db.executemany("DELETE FROM responses WHERE key = ?", doomed)
+        logging.info(f"LLM cache evicted {len(doomed)} entries")
+
+    # Look up / compute a response. `compute` makes the real call, `encode`
+    # turns its result into a string for storage and `decode` turns a stored
+    # string back into the object the client expects.
+    def fetch(self, backend, request, compute, encode, decode, dedupe=False):
+        if self.mode == "off":
+            return compute()
+
+        key = self.make_key(backend, request, dedupe)
+        if self.mode != "writeonly":
+            cached = self.get(key)
+            if cached is not None:
+                return decode(cached)
+            if self.mode == "replay":
+                raise CacheMissError(f"No cached response for {backend}/{request.get('model')} ({key})")
+
+        # Single-flight: the first caller for a key makes the request, anyone
+        # asking for the same key meanwhile waits for that answer.
+        with self._lock:
+            leader = key not in self._inflight
+            if leader:
+                self._inflight[key] = Future()
+            future = self._inflight[key]
+        if not leader:
+            return decode(future.result())
+
+        try:
+            result = compute()
+            value = encode(result)
+            self.put(key, value)
+            future.set_result(value)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    # Async twin of fetch, `compute` is a coroutine function here
+    async def afetch(self, backend, request, compute, encode, decode, dedupe=False):
+        if self.mode == "off":
+            return await compute()
+
+        key = self.make_key(backend, request, dedupe)
+        if self.mode != "writeonly":
+            cached = self.get(key)
+            if cached is not None:
+                return decode(cached)
+            if self.mode == "replay":
+                raise CacheMissError(f"No cached response for {backend}/{request.get('model')} ({key})")
+
+        with self._lock:
+            leader = key not in self._inflight
+            if leader:
+                self._inflight[key] = Future()
+            future = self._inflight[key]
+        if not leader:
+            return decode(await asyncio.wrap_future(future))
+
+        try:
+            result = await compute()
+            value = encode(result)
+            self.put(key, value)
+            future.set_result(value)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+
+DEFAULT_CACHE_PATH = "output/llm_cache.sqlite"
+DEFAULT_PROMPT_CACHE_PATH = "output/prompt_cache.sqlite"
+
+# One cache per set of settings for the whole process, so every client (and
+# every pipeline) with the same settings shares its entries and its counts
+_shared_caches = {}
+_shared_cache_lock = threading.Lock()
+
+
+def _shared(path, mode, salt, max_bytes):
+    key = (path, mode, salt, max_bytes)
+    with _shared_cache_lock:
+        if key not in _shared_caches:
+            _shared_caches[key] = LLMCache(path=path, mode=mode, salt=salt, max_bytes=max_bytes)
+        return _shared_caches[key]
+
+
+# Settings that are not given come from AC_LLM_CACHE, AC_LLM_CACHE_PATH,
+# AC_CACHE_SALT and AC_LLM_CACHE_MB. Pipelines pass those of their RunConfig.
+def get_llm_cache(mode=None, path=None, salt=None, max_mb=None):
+    if max_mb is None:
+        max_mb = os.getenv("AC_LLM_CACHE_MB", "512")
+        max_mb = int(max_mb) if max_mb.isdigit() else 512
+    return _shared(
+        path or os.getenv("AC_LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+        mode or os.getenv("AC_LLM_CACHE", "off"),
+        os.getenv("AC_CACHE_SALT", "") if salt is None else salt,
+        max_mb * 1024 * 1024,
+    )
+
+
+# Rewritten image prompts (see PromptOptimizer) live in their own cache. It is
+# on by default: a rewrite only depends on its description and visual style,
+# so it is never worth paying for twice. AC_PROMPT_CACHE=off turns it off.
+def get_prompt_cache(enabled=None, path=None):
+    if enabled is None:
+        enabled = os.getenv("AC_PROMPT_CACHE") != "off"
+    return _shared(
+        path or os.getenv("AC_PROMPT_CACHE_PATH", DEFAULT_PROMPT_CACHE_PATH),
+        "readthrough" if enabled else "off", "", 64 * 1024 * 1024,
+    )
@@ -0,0 +1,138 @@
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+
+from adventure_generation.telemetry import current_labels
+
+# Logging for the whole pipeline, kept off the worker threads.
+#
+# Workers only put records on a queue; one listener thread formats them and
+# writes to disk. Records go to llm_usage.jsonl (under output/ unless
+# configure_logging is given another directory), one JSON object per line,
+# rotated by size. Prompts and answers ("bodies") are multi-KB, so they go to
+# their own log, llm_bodies.jsonl next to it, and only a sample of them
+# (AC_LOG_BODIES, a share between 0 and 1) is kept at all. Nothing about a
+# body is built unless it is going to be written.
+
+LOG_DIR = "output"
+LOG_NAME = "llm_usage.jsonl"
+BODIES_NAME = "llm_bodies.jsonl"
+MAX_LOG_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+
+BODIES_LOGGER = "adventure_generation.bodies"
+
+_lock = threading.Lock()
+_listener = None
+_body_sample = 0.0
+# Dice of the body sampling, kept apart from the process random so logging
+# never shifts a seeded run's rolls
+_body_dice = random.Random()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# The stock QueueHandler formats the message on the calling thread. Records
+# stay in this process, so the listener can do that instead.
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+class _ByLogger(logging.Filter):
+    def __init__(self, name, keep):
+        super().__init__()
+        self.logger_name = name
+        self.keep = keep
+
+    def filter(self, record):
+        return (record.name == self.logger_name) == self.keep
+
+
+def _file_handler(path, only_bodies):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=MAX_LOG_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(_ByLogger(BODIES_LOGGER, only_bodies))
+    return handler
+
+
+def _share(value, default):
+    try:
+        return min(1.0, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return default
+
+
+# Set up the queue and its listener once per process, writing under
+# directory. Only the entry points call this, a Pipeline used as a library
+# leaves the host's logging alone. AC_LOG_LEVEL sets the level of the main log
+# (default INFO), AC_LOG_BODIES the share of bodies kept (default 0.1).
+def configure_logging(directory=LOG_DIR):
+    global _listener, _body_sample
+    with _lock:
+        if _listener is not None:
+            return
+        level = getattr(logging, os.getenv("AC_LOG_LEVEL", "INFO").upper(), logging.INFO)
+        _body_sample = _share(os.getenv("AC_LOG_BODIES"), 0.1)
+
+        log_queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(
+            log_queue,
+            _file_handler(os.path.join(directory, LOG_NAME), only_bodies=False),
+            _file_handler(os.path.join(directory, BODIES_NAME), only_bodies=True),
+            respect_handler_level=True,
+        )
+        _listener.start()
+
+        root = logging.getLogger()
+        root.addHandler(_DeferredQueueHandler(log_queue))
+        root.setLevel(level)
+        bodies = logging.getLogger(BODIES_LOGGER)
+        bodies.setLevel(logging.DEBUG if _body_sample > 0 else logging.CRITICAL + 1)
+        atexit.register(shutdown_logging)
+
+
+# Write out whatever is still queued and stop the listener
+def shutdown_logging():
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+# Log a prompt or an answer. text may be a callable that returns it, so an
+# expensive body is only built when this call is sampled.
+def log_body(direction, text, **fields):
+    bodies = logging.getLogger(BODIES_LOGGER)
+    if not bodies.isEnabledFor(logging.DEBUG) or _body_dice.random() >= _body_sample:
+        return
+    if callable(text):
+        text = text()
+    bodies.debug(direction, extra={"fields": dict(current_labels(), body=text, **fields)})
@@ -1,35 +1,230 @@
 import json
 import os
+import io
+import re
+import math
 import base64
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from adventure_generation.image_store import image_extension
+from adventure_generation.output_paths import output_path
+
+# GPT-4o never looks at more than this: images are scaled to fit in 2048 x 2048
+# and then until their short side is 768. Anything bigger only costs upload.
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+
+# Tiles overlap by this share of their size, so a label on a seam is whole
+# on at least one of them
+TILE_OVERLAP = 0.15
+
+# Two regions with the same name closer than this (share of the map size)
+# are the same region seen on two tiles
+MERGE_DISTANCE = 0.2
+
+# With AC_MAP_TILES=auto, tiles get about this many source pixels a side
+AUTO_TILE_SIDE = 1536
+MAX_AUTO_TILES = 4
+
+# base64 works on groups of 3 bytes, so chunks of a multiple of 3 encode on their own
+ENCODE_CHUNK = 3 * 64 * 1024
+
+_MIME_TYPES = {".png": "png", ".jpg": "jpeg", ".gif": "gif", ".webp": "webp"}
+
+
+# Size the image down to what the model will look at anyway
+def target_size(width, height):
+    scale = min(1.0, MAX_LONG_SIDE / max(width, height), MAX_SHORT_SIDE / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+# Vision tokens GPT-4o charges for a high detail image of this size
+def vision_tokens(width, height):
+    width, height = target_size(width, height)
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+# base64 of a file, read a chunk at a time instead of holding the raw bytes too
+def encode_file(path):
+    parts = []
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(ENCODE_CHUNK), b""):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+def _normalize_name(name):
+    return re.sub(r"[^a-z0-9]+", " ", str(name).lower()).strip()
+
 
 class MapAnalyzer:
-    def __init__(self, map_image_path, llm_client):
+    def __init__(self, map_image_path, llm_client, tiles=None, max_workers=None):
         self.map_image_path = map_image_path
         self.llm_client = llm_client
+        # Tiles per side: 1 sends the whole map, "auto" picks by map size.
+        # AC_MAP_TILES sets it when not given.
+        if tiles is None:
+            tiles = os.getenv("AC_MAP_TILES", "1")
+        self.tiles = tiles
+        # Tiles studied at once, AC_MAX_THREADS when not given
+        if max_workers is None:
+            max_workers = 4
+            if os.getenv("AC_MAX_THREADS") and os.getenv("AC_MAX_THREADS").isdigit():
+                max_workers = int(os.getenv("AC_MAX_THREADS"))
+        self.max_workers = max(1, max_workers)
+
+    # What changes the analysis besides the image itself, for the stage cache
+    def settings_key(self):
+        return {"tiles": str(self.tiles), "max_side": MAX_LONG_SIDE, "short_side": MAX_SHORT_SIDE}
 
     def identify_regions(self):
-        with open(self.map_image_path, "rb") as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-        
-        landscape_description = self.llm_client.generate_landscape_description(base64_image)
-        
+        from PIL import Image
+
+        # Opening only reads the header, pixels are decoded when first needed
+        with Image.open(self.map_image_path) as image:
+            grid = self._grid(image.size)
+            if grid == 1:
+                landscape_description = self._analyze(*self._encode_whole(image))
+            else:
+                landscape_description = self._analyze_tiles(image, grid)
+
         # convert to dict
         # landscape_description = json.loads(landscape_description)
-        
+
         # save this to a file for review
         self._save_as_json(landscape_description)
-        
+
+        return landscape_description
+
+    def _grid(self, size):
+        if str(self.tiles).isdigit():
+            return max(1, int(self.tiles))
+        if self.tiles == "auto":
+            return min(MAX_AUTO_TILES, max(1, math.ceil(max(size) / AUTO_TILE_SIDE)))
+        raise ValueError(f"AC_MAP_TILES must be a number or 'auto', not '{self.tiles}'")
+
+    def _encode_whole(self, image):
+        # Small enough already: send the file as it is
+        if target_size(*image.size) == image.size:
+            with open(self.map_image_path, "rb") as file:
+                image_type = _MIME_TYPES.get(image_extension(file.read(16)), "jpeg")
+            logging.info(f"Map {image.size}: about {vision_tokens(*image.size)} vision tokens")
+            return encode_file(self.map_image_path), image_type
+        return self._encode(image)
+
+    # Downscale and JPEG encode one image (or tile), returns (base64, type)
+    def _encode(self, image):
+        from PIL import Image
+
+        size = target_size(*image.size)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        logging.info(f"Map image {size}: about {vision_tokens(*size)} vision tokens")
+        # Encode straight out of the buffer, without a second copy of the bytes
+        view = buffer.getbuffer()
+        encoded = "".join(
+            base64.b64encode(view[start:start + ENCODE_CHUNK]).decode("ascii")
+            for start in range(0, len(view), ENCODE_CHUNK)
+        )
+        view.release()
+        return encoded, "jpeg"
+
+    def _analyze(self, base64_image, image_type, hint=""):
+        landscape_description = self.llm_client.generate_landscape_description(
+            base64_image, image_type=image_type, hint=hint
+        )
+        if not isinstance(landscape_description.get("regions"), list):
+            landscape_description["regions"] = []
         return landscape_description
 
+    # Overlapping tiles of a grid x grid split, each analysed on its own worker
+    def _analyze_tiles(self, image, grid):
+        image.load()
+        width, height = image.size
+        boxes = []
+        for row in range(grid):
+            for col in range(grid):
+                boxes.append((row, col, self._tile_box(col, width, grid), self._tile_box(row, height, grid)))
+
+        # Crop here, the workers only scale and encode their own tile
+        tiles = [image.crop((x_range[0], y_range[0], x_range[1], y_range[1])) for _, _, x_range, y_range in boxes]
+
+        def analyze_tile(box, tile):
+            row, col = box[:2]
+            hint = (
+                f"This image is one tile (row {row + 1}, column {col + 1} of a {grid} x {grid} grid) of a larger map. "
+                "Only list regions whose label or feature is on this tile. "
+                "Also give each item a Position: [x, y], the approximate center of the region on this tile "
+                "as fractions of the tile width and height (0 to 1)."
+            )
+            return self._analyze(*self._encode(tile), hint=hint)
+
+        print(f"- studying the map as {grid} x {grid} overlapping tiles")
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(boxes))) as pool:
+            # Each tile keeps the telemetry labels of this call
+            results = list(pool.map(
+                lambda box, tile: contextvars.copy_context().run(analyze_tile, box, tile), boxes, tiles
+            ))
+
+        found = []
+        for (row, col, x_range, y_range), result in zip(boxes, results):
+            for region in result["regions"]:
+                if isinstance(region, dict) and region.get("LocationName"):
+                    found.append(self._to_map_position(region, x_range, y_range, width, height))
+        return {"regions": self.merge_regions(found)}
+
+    def _tile_box(self, index, length, grid):
+        size = length / grid
+        overlap = size * TILE_OVERLAP
+        return max(0, round(index * size - overlap)), min(length, round((index + 1) * size + overlap))
+
+    # Turn a position on a tile into a position on the whole map (0 to 1)
+    def _to_map_position(self, region, x_range, y_range, width, height):
+        try:
+            x, y = (min(1.0, max(0.0, float(value))) for value in region.get("Position", [0.5, 0.5]))
+        except (TypeError, ValueError):
+            x, y = 0.5, 0.5
+        region = dict(region)
+        region.pop("Position", None)
+        region["MapPosition"] = [
+            round((x_range[0] + x * (x_range[1] - x_range[0])) / width, 3),
+            round((y_range[0] + y * (y_range[1] - y_range[0])) / height, 3),
+        ]
+        return region
+
+    # A region seen on two overlapping tiles shows up twice: same name, about
+    # the same place. Keep the one with the longer description.
+    @staticmethod
+    def merge_regions(regions):
+        merged = []
+        for region in regions:
+            name = _normalize_name(region["LocationName"])
+            for i, kept in enumerate(merged):
+                if _normalize_name(kept["LocationName"]) != name:
+                    continue
+                if math.dist(kept["MapPosition"], region["MapPosition"]) > MERGE_DISTANCE:
+                    continue
+                if len(str(region.get("ShortDescription", ""))) > len(str(kept.get("ShortDescription", ""))):
+                    merged[i] = region
+                break
+            else:
+                merged.append(region)
+        return merged
+
     def _save_as_json(self, landscape_description):
         filename = 'map_description.json'
-        
-        output_directory = 'output/json_outputs/'
+
+        output_directory = output_path('json_outputs')
         if not os.path.exists(output_directory):
             os.makedirs(output_directory)
-        
-        output_path = os.path.join(output_directory, filename)
-        print(output_path)
-        with open(output_path, 'w') as json_file:
-            json.dump(landscape_description, json_file)
 
+        json_path = os.path.join(output_directory, filename)
+        print(json_path)
+        with open(json_path, 'w') as json_file:
+            json.dump(landscape_description, json_file)
@@ -0,0 +1,551 @@
+import re
+import ast
+import sys
+import json
+import math
+import time
+import zlib
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from adventure_generation.json_repair import repair_json, JsonRepairError
+
+# A local stand-in for every backend the pipeline talks to, so a full run
+# costs nothing and needs no GPU:
+#   OpenAI        POST /v1/chat/completions (plain and streamed)
+#                 POST /v1/images/generations (b64_json)
+#   Ollama        POST /api/chat (plain and streamed)
+#   AUTOMATIC1111 POST /sdapi/v1/txt2img
+#
+# Answers follow the "Example JSON" of each prompt, filled with made up text,
+# so every step of the pipeline gets something it can use. Latency, 429s
+# (OpenAI only, the others never send them) and malformed JSON are drawn from
+# a random generator seeded by the request itself: the same request always
+# gets the same answer and the same failures, whichever thread sends it.
+#
+# Point the pipeline at it with:
+#   OPENAI_BASE_URL=http://127.0.0.1:PORT/v1 OPENAI_API_KEY=mock
+#   AC_OLLAMA_SERVER=127.0.0.1:PORT AC_AUTO1111_SERVER=127.0.0.1:PORT
+
+WORDS = (
+    "amber ancient ash autumn bitter black bright broken cedar cinder cold copper crooked "
+    "deep distant dusk dusty ember fallen fern frost gilded glass gray green grim hidden "
+    "hollow iron ivory lantern lonely low marsh mist moss night oak old pale pine quiet "
+    "raven red river rust salt shadow silver slate smoke stone storm sun thorn tide "
+    "twisted velvet violet whisper white wild willow wind winter wolf wood"
+).split()
+
+NAME_KEYS = ("name", "title", "LocationName")
+
+# A world to hand out when nothing else was configured
+DEFAULT_WORLD = {
+    "regions": [
+        {"LocationName": "Mockford", "LocationType": "bigTown", "ShortDescription": "A busy port town."},
+        {"LocationName": "Little Mock", "LocationType": "smallTown", "ShortDescription": "A quiet village."},
+        {"LocationName": "Mock Peaks", "LocationType": "NaturalFeature", "ShortDescription": "Cold mountains."},
+    ]
+}
+
+_EXAMPLE = re.compile(r"Example (?:JSON|formatting)\s*:")
+_BATCH = re.compile(r"create (\d+) different items")
+_NUMBERED_PROMPT = re.compile(r"(?:PROMPT|Input prompt) (\d+):")
+_WRAPPER = re.compile(r'(?:should be in the|Store these under) "(\w+)"')
+
+
+class MockSettings:
+    def __init__(
+        self,
+        latency=0.05,
+        latency_sigma=0.5,
+        image_latency=0.2,
+        rate_limit_rate=0.0,
+        malformed_rate=0.0,
+        retry_after=0.05,
+        rpm=30000,
+        tpm=150000000,
+        image_size=512,
+        seed=0,
+        world=None,
+    ):
+        # Median seconds per chat answer, spread out log-normally by sigma
+        # (0 for a fixed latency). Images take image_latency instead.
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.image_latency = image_latency
+        # Shares (0 to 1) of OpenAI requests answered with a 429, and of JSON
+        # answers that come back broken the way models break them
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        # Seconds a 429 asks the client to wait
+        self.retry_after = retry_after
+        # Limits announced in the x-ratelimit headers of chat answers, as
+        # OpenAI does. The pipeline's rate limiter takes them over.
+        self.rpm = rpm
+        self.tpm = tpm
+        # Side of the square PNG every image request gets
+        self.image_size = image_size
+        self.seed = seed
+        # The map analysis answer, a map_description.json world
+        self.world = world or DEFAULT_WORLD
+
+
+# Made up text, the same for the same generator state
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _sentence(rng, count=20):
+    text = _words(rng, count)
+    return text[0].upper() + text[1:] + "."
+
+
+def _name(rng):
+    return " ".join(word.capitalize() for word in (rng.choice(WORDS), rng.choice(WORDS)))
+
+
+# Fill an example structure: every string becomes made up text of about the
+# same job, numbers and empty containers stay as they are
+def _fill(example, rng, key=None):
+    if isinstance(example, dict):
+        return {name: _fill(value, rng, name) for name, value in example.items()}
+    if isinstance(example, list):
+        return [_fill(value, rng, key) for value in example]
+    if isinstance(example, str):
+        if key in NAME_KEYS:
+            return _name(rng)
+        if key in ("gender", "class", "race"):
+            return rng.choice(WORDS)
+        return _sentence(rng, 40 if "paragraph" in example else 15)
+    return example
+
+
+# The first balanced {...} after `start`
+def _json_block(text, start=0):
+    begin = text.find("{", start)
+    if begin == -1:
+        return None
+    depth = 0
+    quote = None
+    for i in range(begin, len(text)):
+        char = text[i]
+        if quote:
+            if char == "\\":
+                continue
+            if char == quote and text[i - 1] != "\\":
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[begin:i + 1]
+    return None
+
+
+def _parse_example(block):
+    try:
+        return json.loads(block)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(block)
+    except (ValueError, SyntaxError):
+        return None
+
+
+# Break a JSON answer the way models do. Every variant is one the local
+# repair in json_repair.py is expected to handle.
+def _malform(text, rng):
+    variant = rng.randrange(4)
+    if variant == 0:
+        return f"Here is the JSON you asked for:\n```json\n{text}\n```"
+    if variant == 1:
+        return re.sub(r"\}$", ",}", text)
+    if variant == 2:
+        return text.replace("true", "True").replace("false", "False")
+    # Cut off mid answer
+    return text[: max(2, int(len(text) * 0.8))]
+
+
+def _png(width, height, rgb):
+    def chunk(kind, data):
+        return (
+            struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+
+    row = b"\x00" + bytes(rgb) * width
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(row * height, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _prompt_text(messages):
+    texts = []
+    has_image = False
+    for message in messages or []:
+        if message.get("role") == "system":
+            continue
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    texts.append(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    has_image = True
+        elif content:
+            texts.append(str(content))
+        if message.get("images"):
+            has_image = True
+    return "\n".join(texts), has_image
+
+
+class MockBackend:
+    def __init__(self, settings=None, host="127.0.0.1", port=0):
+        self.settings = settings or MockSettings()
+        self._lock = threading.Lock()
+        self._attempts = Counter()
+        self._stats = Counter()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.backend = self
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def url(self):
+        return f"http://{self.address}"
+
+    # Environment that points the pipeline at this server
+    def environment(self):
+        return {
+            "OPENAI_BASE_URL": f"{self.url}/v1",
+            "OPENAI_API_KEY": "mock",
+            "AC_OLLAMA_SERVER": self.address,
+            "AC_AUTO1111_SERVER": self.address,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-backend", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+            self._attempts.clear()
+
+    def _count(self, **values):
+        with self._lock:
+            self._stats.update(values)
+
+    # A generator seeded by the request: the n-th identical request always
+    # gets the same draw, whichever thread sends it
+    def _rng(self, path, body):
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            self._attempts[digest] += 1
+            attempt = self._attempts[digest]
+        return random.Random(f"{self.settings.seed}:{path}:{digest}:{attempt}")
+
+    def _latency(self, rng, median):
+        if median <= 0:
+            return 0.0
+        return median * math.exp(self.settings.latency_sigma * rng.gauss(0, 1))
+
+    def _rate_limited(self, rng):
+        return rng.random() < self.settings.rate_limit_rate
+
+    # The text answer to a chat request
+    def answer(self, messages, json_mode, rng):
+        prompt, has_image = _prompt_text(messages)
+
+        if has_image:
+            answer = json.dumps(self.settings.world)
+        elif "json data is too long" in prompt:
+            # The LLM fixer: hand back the broken input, repaired
+            block = prompt[prompt.find("Input to be revised:"):]
+            try:
+                answer = json.dumps(repair_json(block))
+            except JsonRepairError:
+                answer = "{}"
+        elif '{"prompts"' in prompt:
+            count = max([int(n) for n in _NUMBERED_PROMPT.findall(prompt)] or [1])
+            answer = json.dumps({"prompts": {str(i): _words(rng, 12).replace(" ", ", ") for i in range(1, count + 1)}})
+        else:
+            example = None
+            marker = _EXAMPLE.search(prompt)
+            if marker:
+                block = _json_block(prompt, marker.end())
+                example = _parse_example(block) if block else None
+            batch = _BATCH.search(prompt)
+            if example is not None and batch:
+                answer = json.dumps({"items": [_fill(example, rng) for _ in range(int(batch.group(1)))]})
+            elif example is not None:
+                answer = _fill(example, rng)
+                # Some prompts ask for the example inside a named object,
+                # unless the example already is
+                wrapper = _WRAPPER.search(prompt)
+                if wrapper and not (isinstance(answer, dict) and set(answer) == {wrapper.group(1)}):
+                    answer = {wrapper.group(1): answer}
+                answer = json.dumps(answer)
+            elif json_mode:
+                answer = "{}"
+            else:
+                return " ".join(_sentence(rng) for _ in range(3))
+
+        if rng.random() < self.settings.malformed_rate:
+            self._count(malformed=1)
+            return _malform(answer, rng)
+        return answer
+
+    def image(self, rng):
+        size = self.settings.image_size
+        rgb = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        return base64.b64encode(_png(size, size, rgb)).decode("ascii")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, the pipeline pools its connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        backend = self.server.backend
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "bad json"})
+            return
+        routes = {
+            "/v1/chat/completions": self._openai_chat,
+            "/v1/images/generations": self._openai_image,
+            "/api/chat": self._ollama_chat,
+            "/sdapi/v1/txt2img": self._a1111,
+        }
+        route = routes.get(self.path.split("?")[0])
+        if route is None:
+            self._send_json(404, {"error": f"no mock for {self.path}"})
+            return
+        backend._count(requests=1, **{self.path.strip("/").replace("/", "_"): 1})
+        rng = backend._rng(self.path, body)
+        try:
+            route(backend, request, rng)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up on a stream, as it does once it has what it needs
+            self.close_connection = True
+
+    def _limit_headers(self, backend):
+        settings = backend.settings
+        return {
+            "x-ratelimit-limit-requests": str(settings.rpm),
+            "x-ratelimit-remaining-requests": str(settings.rpm),
+            "x-ratelimit-limit-tokens": str(settings.tpm),
+            "x-ratelimit-remaining-tokens": str(settings.tpm),
+        }
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _rate_limit(self, backend):
+        backend._count(rate_limited=1)
+        retry_after = backend.settings.retry_after
+        self._send_json(
+            429,
+            {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+            {"retry-after-ms": str(int(retry_after * 1000)), "retry-after": str(max(1, math.ceil(retry_after)))},
+        )
+
+    # A streamed answer: the first piece after a share of the latency, the
+    # rest spread over what is left. Streams close the connection when done.
+    def _stream(self, content_type, pieces, delay, headers=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Connection", "close")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(delay * 0.2)
+        for piece in pieces:
+            self.wfile.write(piece)
+            self.wfile.flush()
+            time.sleep(delay * 0.8 / max(1, len(pieces)))
+
+    @staticmethod
+    def _split(text, size=16):
+        return [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def _openai_chat(self, backend, request, rng):
+        if backend._rate_limited(rng):
+            self._rate_limit(backend)
+            return
+        delay = backend._latency(rng, backend.settings.latency)
+        json_mode = (request.get("response_format") or {}).get("type") == "json_object"
+        content = backend.answer(request.get("messages"), json_mode, rng)
+        model = request.get("model", "gpt-4o-mini")
+        prompt_tokens = len(json.dumps(request.get("messages"))) // 4
+        created = int(time.time())
+        if request.get("stream"):
+            def event(delta, finish=None):
+                chunk = {
+                    "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+                }
+                return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+            pieces = [event({"role": "assistant", "content": ""})]
+            pieces += [event({"content": piece}) for piece in self._split(content)]
+            pieces += [event({}, "stop"), b"data: [DONE]\n\n"]
+            self._stream("text/event-stream", pieces, delay, self._limit_headers(backend))
+            return
+        time.sleep(delay)
+        self._send_json(200, {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4,
+            },
+        }, self._limit_headers(backend))
+
+    def _openai_image(self, backend, request, rng):
+        if backend._rate_limited(rng):
+            self._rate_limit(backend)
+            return
+        time.sleep(backend._latency(rng, backend.settings.image_latency))
+        self._send_json(200, {
+            "created": int(time.time()),
+            "data": [
+                {"b64_json": backend.image(rng), "revised_prompt": request.get("prompt", "")}
+                for _ in range(request.get("n") or 1)
+            ],
+        })
+
+    def _ollama_chat(self, backend, request, rng):
+        delay = backend._latency(rng, backend.settings.latency)
+        content = backend.answer(request.get("messages"), request.get("format") == "json", rng)
+        model = request.get("model", "llama3.1")
+        counts = {
+            "prompt_eval_count": len(json.dumps(request.get("messages"))) // 4,
+            "eval_count": len(content) // 4,
+        }
+        if request.get("stream", True):
+            pieces = [
+                (json.dumps({"model": model, "message": {"role": "assistant", "content": piece}, "done": False}) + "\n").encode("utf-8")
+                for piece in self._split(content)
+            ]
+            pieces.append((json.dumps(dict(
+                {"model": model, "message": {"role": "assistant", "content": ""}, "done": True}, **counts
+            )) + "\n").encode("utf-8"))
+            self._stream("application/x-ndjson", pieces, delay)
+            return
+        time.sleep(delay)
+        self._send_json(200, dict({
+            "model": model,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+        }, **counts))
+
+    def _a1111(self, backend, request, rng):
+        time.sleep(backend._latency(rng, backend.settings.image_latency))
+        self._send_json(200, {
+            "images": [backend.image(rng)],
+            "parameters": request,
+            "info": "{}",
+        })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve mock OpenAI, Ollama and AUTOMATIC1111 endpoints.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="median seconds per chat answer")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="log-normal spread, 0 for fixed")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="median seconds per image")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of OpenAI requests answered with 429")
+    parser.add_argument("--malformed", type=float, default=0.0, help="share of JSON answers sent broken")
+    parser.add_argument("--rpm", type=int, default=30000, help="OpenAI requests per minute to announce")
+    parser.add_argument("--tpm", type=int, default=150000000, help="OpenAI tokens per minute to announce")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--world", help="map_description.json to answer the map analysis with")
+    args = parser.parse_args(argv)
+
+    world = None
+    if args.world:
+        with open(args.world, "r") as file:
+            world = json.load(file)
+    settings = MockSettings(
+        latency=args.latency,
+        latency_sigma=args.latency_sigma,
+        image_latency=args.image_latency,
+        rate_limit_rate=args.rate_limit,
+        malformed_rate=args.malformed,
+        rpm=args.rpm,
+        tpm=args.tpm,
+        seed=args.seed,
+        world=world,
+    )
+    backend = MockBackend(settings, args.host, args.port)
+    print(f"Mock backends listening on {backend.url}, point the pipeline at them with:")
+    for name, value in backend.environment().items():
+        print(f"  export {name}={value}")
+    try:
+        backend._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend._server.server_close()
+        print(json.dumps(backend.stats()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
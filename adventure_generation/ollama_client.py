@@ -1,39 +1,79 @@
 import os
-import sys
-from ollama import Client
+import asyncio
+from ollama import Client, AsyncClient
 import json
-import requests
-import string
-import random
 from adventure_generation.JsonStructures import JsonStructures
+from adventure_generation import batch_generation
+from adventure_generation.prompt_budget import PromptBudget
+from adventure_generation.json_repair import repair_json, JsonRepairError, get_repair_stats
+from adventure_generation.json_stream import JsonStreamParser, StreamOffSchema
 
 # To prevent rate limit issues
-import time
+from adventure_generation.rate_limiter import get_rate_limiter, estimate_tokens
 
-# Add logging to help track prompt issues
+# To avoid paying twice for the same answer
+from adventure_generation.llm_cache import get_llm_cache
+
+# One pooled keep-alive connection pool for every backend
+from adventure_generation.http_transport import get_transport, get_async_transport
+from adventure_generation.image_store import download_image
+
+# Add logging to help track prompt issues. Records are written by a
+# background thread (set up by the Pipeline, see llm_logging), prompts and
+# answers go to a separate sampled log.
 import logging
+from adventure_generation.llm_logging import log_body
 
-# Configure logging
-logging.basicConfig(
-    filename="output/llm_usage.log", level=logging.NOTSET, format="%(asctime)s - %(message)s"
-)
+# Latency, tokens, retries and cost of every call
+from adventure_generation.telemetry import get_telemetry
+from adventure_generation.backends import DEFAULT_MODELS
 
 class ollamaClient:
 
-    def __init__(self):
+    # server, stream, prompt_tokens, the response cache and the HTTP pool size
+    # come from the RunConfig (see BackendRegistry), the AC_* variables when
+    # they are not given
+    def __init__(self, server=None, stream=None, prompt_tokens=None, cache=None, pool_size=None, num_ctx=None):
         self.api_key = "ollama"
         
-        # Allow the user to specify and IP address for an Ollama server
-        if "AC_OLLAMA_SERVER" in os.environ:
-            self.base_url="http://{}:11434".format(
-                os.getenv("AC_OLLAMA_SERVER")
-            )
+        # Allow the user to specify and IP address for an Ollama server,
+        # with a port of its own if it is not on the default one
+        server = server or os.getenv("AC_OLLAMA_SERVER")
+        if server:
+            self.base_url = "http://{}".format(server if ":" in server else f"{server}:11434")
         else:
             self.base_url = "http://localhost:11434"
             
-        self.client = Client(host=self.base_url)
+        self.pool_size = pool_size
+        self.client = Client(host=self.base_url, transport=get_transport(pool_size))
+        self._async_client = None
+        self._async_transport = None
         self.jstructs = JsonStructures()
-        self.general_use_model = "llama3.1"
+        self.general_use_model = DEFAULT_MODELS["ollama"]["general_use"]
+        self.summary_model = DEFAULT_MODELS["ollama"]["summary"]
+        # Ollama runs models with a 2048 token context unless told otherwise.
+        # AC_OLLAMA_NUM_CTX raises it, which also allows bigger batches.
+        self.context_window = 2048
+        self.chat_options = {}
+        if num_ctx is None and os.getenv("AC_OLLAMA_NUM_CTX") and os.getenv("AC_OLLAMA_NUM_CTX").isdigit():
+            num_ctx = int(os.getenv("AC_OLLAMA_NUM_CTX"))
+        if num_ctx:
+            self.context_window = num_ctx
+            self.chat_options = {"num_ctx": self.context_window}
+        self.max_output_tokens = self.context_window
+        # Anything past the context window is silently dropped by Ollama, so keep
+        # a quarter of it free for the answer
+        if prompt_tokens is None and os.getenv("AC_PROMPT_TOKENS") and os.getenv("AC_PROMPT_TOKENS").isdigit():
+            prompt_tokens = int(os.getenv("AC_PROMPT_TOKENS"))
+        room = self.context_window * 3 // 4
+        self.budget = PromptBudget(self.general_use_model, min(room, prompt_tokens or room))
+        self.rate_limiter = get_rate_limiter()
+        self.cache = cache or get_llm_cache()
+        self.repair_stats = get_repair_stats()
+        self.telemetry = get_telemetry()
+        # Stream JSON answers and hang up once the needed keys are in
+        self.stream = os.getenv("AC_STREAM") == "True" if stream is None else stream
+        self.max_stream_retries = 2
 
         logging.info("Ollama NATIVE Client initiated")
 
@@ -44,6 +84,59 @@ class ollamaClient:
         self.system_role_msg = {"role": "system", "content": f"{self.system_role}"}
         self.image_storage = "images"
 
+    # Async connections can not outlive their event loop, so a new loop gets a new client
+    @property
+    def async_client(self):
+        transport = get_async_transport(self.pool_size)
+        if self._async_client is None or self._async_transport is not transport:
+            self._async_client = AsyncClient(host=self.base_url, transport=transport)
+            self._async_transport = transport
+        return self._async_client
+
+    # Every chat call goes through the shared response cache first.
+    # dedupe=True is for pure transformations whose answer can be shared.
+    def _chat(self, dedupe=False, **kwargs):
+        return self.cache.fetch(
+            "ollama",
+            kwargs,
+            lambda: self._send_chat(**kwargs),
+            encode=json.dumps,
+            decode=json.loads,
+            dedupe=dedupe,
+        )
+
+    # Async twin of _chat
+    async def _achat(self, dedupe=False, **kwargs):
+        return await self.cache.afetch(
+            "ollama",
+            kwargs,
+            lambda: self._asend_chat(**kwargs),
+            encode=json.dumps,
+            decode=json.loads,
+            dedupe=dedupe,
+        )
+
+    # Every request goes through the shared rate limiter. Ollama has no limits
+    # unless AC_OLLAMA_RPM / AC_OLLAMA_TPM are set, so this normally never waits.
+    def _send_chat(self, **kwargs):
+        with self.telemetry.call("ollama", kwargs["model"]) as call:
+            call.waited(self.rate_limiter.acquire(
+                "ollama", kwargs["model"], estimate_tokens(kwargs["messages"])
+            ))
+            response = self.client.chat(**kwargs)
+            call.usage(response.get("prompt_eval_count"), response.get("eval_count"))
+            return response
+
+    # Async twin of _send_chat
+    async def _asend_chat(self, **kwargs):
+        with self.telemetry.call("ollama", kwargs["model"]) as call:
+            call.waited(await self.rate_limiter.aacquire(
+                "ollama", kwargs["model"], estimate_tokens(kwargs["messages"])
+            ))
+            response = await self.async_client.chat(**kwargs)
+            call.usage(response.get("prompt_eval_count"), response.get("eval_count"))
+            return response
+
     # This service function helps create a "messages" variable for LLM APIs
     def _create_messages(self, prompt):
         msgs = [self.system_role_msg, {"role": "user", "content": f"{prompt}"}]
@@ -56,40 +149,193 @@ class ollamaClient:
             dict_output = json.loads(json_inputs)
         except json.decoder.JSONDecodeError as e:
             logging.warning(f"Failed to decode JSON. Error: {e}")
-            abbreviated_json = self._fix_json_response(json_inputs)
-            dict_output = json.loads(abbreviated_json)
+            dict_output = self._repair_json(json_inputs, self.general_use_model)
+
+        log_body("output", json_inputs)
 
-        # Let's add a delay to stop hitting ratelimits
-        time.sleep(1)
+        return dict_output
+
+    # Async twin of _parse_json
+    async def _aparse_json(self, json_inputs):
+        try:
+            dict_output = json.loads(json_inputs)
+        except json.decoder.JSONDecodeError as e:
+            logging.warning(f"Failed to decode JSON. Error: {e}")
+            dict_output = await self._arepair_json(json_inputs, self.general_use_model)
 
-        logging.debug(f"<<< OUTPUT FROM LLM:\n{json_inputs}")
+        log_body("output", json_inputs)
 
         return dict_output
 
-    # This service function hands the download and storing of DALL-E Image URL responses
-    def _parse_url(self, image_url, image_storage):
-        # Am I overwriting the basic image storage, probably.
-        if image_storage:
-            self.image_storage = image_storage
+    # Ollama calls the output limit num_predict
+    def _options(self, max_tokens=None):
+        options = dict(self.chat_options)
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        return options or None
 
-        # Does this folder exist? make it so.
-        if not os.path.exists(self.image_storage):
-            os.makedirs(self.image_storage)
+    # Broken JSON is repaired locally first, the LLM fixer is the fallback
+    def _repair_json(self, json_inputs, model):
+        self.telemetry.count("ollama", model, json_repairs=1)
+        try:
+            dict_output = repair_json(json_inputs)
+            self.repair_stats.record(model, "local")
+            return dict_output
+        except JsonRepairError as e:
+            logging.warning(f"{e}, asking the LLM to fix it")
+        try:
+            dict_output = repair_json(self._fix_json_response(json_inputs))
+        except JsonRepairError:
+            self.repair_stats.record(model, "failed")
+            raise
+        self.repair_stats.record(model, "llm")
+        return dict_output
+
+    # Async twin of _repair_json
+    async def _arepair_json(self, json_inputs, model):
+        self.telemetry.count("ollama", model, json_repairs=1)
+        try:
+            dict_output = repair_json(json_inputs)
+            self.repair_stats.record(model, "local")
+            return dict_output
+        except JsonRepairError as e:
+            logging.warning(f"{e}, asking the LLM to fix it")
+        try:
+            dict_output = repair_json(await self._afix_json_response(json_inputs))
+        except JsonRepairError:
+            self.repair_stats.record(model, "failed")
+            raise
+        self.repair_stats.record(model, "llm")
+        return dict_output
+
+    # This service function sends a JSON prompt to the general use model and parses the reply.
+    # `kind` names the JsonStructures item being asked for, so a streamed
+    # answer can be cut short once that item's required keys are in.
+    def _chat_json(self, prompt, max_tokens=None, kind=None):
+        prompt = self.budget.fit(prompt, self._shorten_prompt)
 
-        # Create a random short jpg file name
-        # TODO: Get character names for image?
-        filename = (
-            "".join(random.choices(string.ascii_letters + string.digits, k=8)) + ".jpg"
+        log_body("input", prompt)
+        request = dict(
+            model=self.general_use_model, messages=self._create_messages(prompt), format="json",
+            options=self._options(max_tokens),
         )
-        file_path = os.path.join(self.image_storage, filename)
+        if self.stream and kind:
+            return self._stream_json(request, kind)
+        response = self._chat(**request)
+        return self._parse_json(response["message"]["content"])
+
+    # Async twin of _chat_json
+    async def _achat_json(self, prompt, max_tokens=None, kind=None):
+        prompt = await self.budget.afit(prompt, self._ashorten_prompt)
 
-        # Download the image located at the generated URL and save it
-        image_data = requests.get(image_url).content
-        with open(file_path, "wb") as handler:
-            handler.write(image_data)
+        log_body("input", prompt)
+        request = dict(
+            model=self.general_use_model, messages=self._create_messages(prompt), format="json",
+            options=self._options(max_tokens),
+        )
+        if self.stream and kind:
+            return await self._astream_json(request, kind)
+        response = await self._achat(**request)
+        return await self._aparse_json(response["message"]["content"])
+
+    # Streamed version of a JSON chat call. An answer that goes off schema is
+    # dropped as soon as that is clear and asked for again. After
+    # max_stream_retries of those, a normal request is made instead.
+    def _stream_json(self, request, kind):
+        required_keys = self.jstructs.required_keys[kind]
+        for attempt in range(self.max_stream_retries):
+            try:
+                text = self.cache.fetch(
+                    "ollama",
+                    dict(request, stream=True),
+                    lambda: self._send_stream(required_keys, **request),
+                    encode=str,
+                    decode=str,
+                )
+            except StreamOffSchema as e:
+                logging.warning(f"Streamed {kind} went off schema, attempt {attempt + 1}: {e}")
+                self.telemetry.count("ollama", request["model"], retries=1)
+                continue
+            return self._parse_streamed_json(text)
+        response = self._chat(**request)
+        return self._parse_json(response["message"]["content"])
 
-        # Return the relative path of the downloaded image
-        return file_path
+    # Async twin of _stream_json
+    async def _astream_json(self, request, kind):
+        required_keys = self.jstructs.required_keys[kind]
+        for attempt in range(self.max_stream_retries):
+            try:
+                text = await self.cache.afetch(
+                    "ollama",
+                    dict(request, stream=True),
+                    lambda: self._asend_stream(required_keys, **request),
+                    encode=str,
+                    decode=str,
+                )
+            except StreamOffSchema as e:
+                logging.warning(f"Streamed {kind} went off schema, attempt {attempt + 1}: {e}")
+                self.telemetry.count("ollama", request["model"], retries=1)
+                continue
+            return await self._aparse_streamed_json(text)
+        response = await self._achat(**request)
+        return await self._aparse_json(response["message"]["content"])
+
+    # A stream we hung up on ends mid-object, closing it is routine and is not
+    # counted as a JSON repair
+    def _parse_streamed_json(self, text):
+        try:
+            return repair_json(text)
+        except JsonRepairError:
+            return self._parse_json(text)
+
+    async def _aparse_streamed_json(self, text):
+        try:
+            return repair_json(text)
+        except JsonRepairError:
+            return await self._aparse_json(text)
+
+    # Reads the stream until the required keys are complete. Closing the
+    # generator closes the HTTP response, and Ollama stops generating once
+    # the client is gone.
+    def _send_stream(self, required_keys, **kwargs):
+        with self.telemetry.call("ollama", kwargs["model"]) as call:
+            call.waited(self.rate_limiter.acquire(
+                "ollama", kwargs["model"], estimate_tokens(kwargs["messages"])
+            ))
+            parser = JsonStreamParser(required_keys)
+            stream = self.client.chat(stream=True, **kwargs)
+            try:
+                for chunk in stream:
+                    parser.feed(chunk["message"]["content"])
+                    if parser.complete:
+                        break
+            finally:
+                stream.close()
+                # A stream we hang up on never gets its counts, these are estimates
+                call.usage(estimate_tokens(kwargs["messages"]), len(parser.text) // 4)
+            return parser.text
+
+    # Async twin of _send_stream
+    async def _asend_stream(self, required_keys, **kwargs):
+        with self.telemetry.call("ollama", kwargs["model"]) as call:
+            call.waited(await self.rate_limiter.aacquire(
+                "ollama", kwargs["model"], estimate_tokens(kwargs["messages"])
+            ))
+            parser = JsonStreamParser(required_keys)
+            stream = await self.async_client.chat(stream=True, **kwargs)
+            try:
+                async for chunk in stream:
+                    parser.feed(chunk["message"]["content"])
+                    if parser.complete:
+                        break
+            finally:
+                await stream.aclose()
+                call.usage(estimate_tokens(kwargs["messages"]), len(parser.text) // 4)
+            return parser.text
+
+    # This service function hands the download and storing of DALL-E Image URL responses
+    def _parse_url(self, image_url, image_storage):
+        return download_image(image_url, image_storage or self.image_storage)
 
     # This service function organizes and summarizes the users initial input txt
     def _summarize_context(self, input_prompt):
@@ -98,12 +344,12 @@ class ollamaClient:
         BEGIN USER INPUT:\n
         """
         prompt += input_prompt
-        response = self.client.chat(
-            model=self.general_use_model,
+        response = self._chat(
+            dedupe=True,
+            model=self.summary_model,
             messages=self._create_messages(prompt),
         )
-        time.sleep(1)
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
+        log_body("input", prompt)
 
         return response["message"]["content"]
 
@@ -115,7 +361,8 @@ class ollamaClient:
         If JSON output is requested, please be sure that JSON output is specificed in the prompt. 
         Summarize stories to single sentences or cut unneeded details:\n"""
         prompt += input_prompt
-        response = self.client.chat(
+        response = self._chat(
+            dedupe=True,
             model=self.general_use_model,
             messages=self._create_messages(prompt),
         )
@@ -124,9 +371,29 @@ class ollamaClient:
             output_content = response["message"]["content"]
             output_content += "\nReturn this information in JSON format."
 
-        time.sleep(1)
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        logging.debug(f">> OUTPUT FROM LLM:\n{response['message']['content']}\n")
+        log_body("input", prompt)
+        log_body("output", response['message']['content'])
+        return output_content
+
+    # Async twin of _shorten_prompt
+    async def _ashorten_prompt(self, input_prompt):
+        prompt = """
+        This prompt is too long.
+        Please optimize this prompt for comsumption by an Open Source large Language model.
+        If JSON output is requested, please be sure that JSON output is specificed in the prompt.
+        Summarize stories to single sentences or cut unneeded details:\n"""
+        prompt += input_prompt
+        response = await self._achat(
+            dedupe=True,
+            model=self.general_use_model,
+            messages=self._create_messages(prompt),
+        )
+        output_content = response["message"]["content"]
+        if "JSON" not in output_content:
+            output_content += "\nReturn this information in JSON format."
+
+        log_body("input", prompt)
+        log_body("output", response['message']['content'])
         return output_content
 
     # This service function attempts to fix any JSON that cannot be loaded,
@@ -134,24 +401,28 @@ class ollamaClient:
     def _fix_json_response(self, input_response):
         prompt = "This json data is not in properly formatted. Please format output in proper JSON. Input to be revised: \n"
         prompt += input_response
-        response = self.client.chat(
+        response = self._chat(
+            dedupe=True,
             model=self.general_use_model,  # this might be sketchy.
             messages=self._create_messages(prompt),
             format="json",
         )
-        time.sleep(1)
         logging.warning(" --- Incomplete JSON data fix attempted.")
         return response["message"]["content"]
 
-    # This service function gets the size of the string
-    # This is how we determine if a prompt is too large for a model
-    def _get_size_of_string(self, string_var):
-        # Get the number of bytes of the string
-        byte_size = sys.getsizeof(string_var)
-        # Convert bytes to kilobytes
-        kb_size = byte_size / 1024
-        return kb_size
-    
+    # Async twin of _fix_json_response
+    async def _afix_json_response(self, input_response):
+        prompt = "This json data is not in properly formatted. Please format output in proper JSON. Input to be revised: \n"
+        prompt += input_response
+        response = await self._achat(
+            dedupe=True,
+            model=self.general_use_model,
+            messages=self._create_messages(prompt),
+            format="json",
+        )
+        logging.warning(" --- Incomplete JSON data fix attempted.")
+        return response["message"]["content"]
+
     # This service function strips a descriptive prompt down to keywords for opensource sd models
     def optimize_for_stable_diffusion(self, input_prompt, visual_style):
         prompt = (
@@ -161,22 +432,56 @@ class ollamaClient:
             f"Visual Style: {visual_style}\n"
         )
 
-        response = self.client.chat(
+        response = self._chat(
+            dedupe=True,
             model=self.general_use_model,
             messages=self._create_messages(prompt),
         )
 
-        # Adding a delay to prevent hitting rate limits
-        time.sleep(10)
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        logging.debug(f">> OUTPUT FROM LLM:\n{response['message']['content']}\n")
+        log_body("input", prompt)
+        log_body("output", response['message']['content'])
         return response["message"]["content"].strip()
 
+    # Batched optimize_for_stable_diffusion: one call for a list of prompts.
+    # Returns the keyword lines in order, or fewer if the model lost some.
+    def optimize_for_stable_diffusion_batch(self, input_prompts, visual_style):
+        prompt = (
+            "Optimize each of the following prompts for Stable Diffusion by reducing it to a single line of comma-separated keywords. "
+            "The keywords should focus on description, styling, texture, and lighting.\n"
+            'Answer in JSON as {"prompts": {"1": "...", "2": "..."}}, one line of keywords per input prompt, under its number.\n'
+            f"Visual Style: {visual_style}\n"
+        )
+        for i, input_prompt in enumerate(input_prompts, 1):
+            prompt += f"Input prompt {i}: {input_prompt}\n"
+
+        response = self._chat(
+            dedupe=True,
+            model=self.general_use_model,
+            messages=self._create_messages(prompt),
+            format="json",
+        )
+
+        log_body("input", prompt)
+        log_body("output", response['message']['content'])
+        answer = self._parse_json(response["message"]["content"])
+        return batch_generation.keyed_prompts(answer, len(input_prompts))
+
 
     def generate_detailed_region_description(self, region, world_info="", style_input=""):
         if region == "":
             return {}
+        return self._chat_json(
+            self._region_description_prompt(region, world_info, style_input), kind="region_description"
+        )
 
+    async def agenerate_detailed_region_description(self, region, world_info="", style_input=""):
+        if region == "":
+            return {}
+        return await self._achat_json(
+            self._region_description_prompt(region, world_info, style_input), kind="region_description"
+        )
+
+    def _region_description_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Expand upon the simple description for this region:
         Region Name: {} - a {}.
@@ -190,27 +495,43 @@ class ollamaClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
-        prompt += "{'description' : 'An example descriptive paragraph','lore' : 'Example history, mood or lore of this region in one paragraph'}"
+        prompt += "{'regionDetails' : {'description' : 'An example descriptive paragraph','lore' : 'Example history, mood or lore of this region in one paragraph'}}"
 
-        if self._get_size_of_string(prompt) >= 90:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        logging.debug(self._create_messages(prompt))
 
-        response = self.client.chat(
-            model=self.general_use_model, messages=self._create_messages(prompt), format="json"
+    def generate_location(self, region, world_info="", style_input=""):
+        return self._chat_json(
+            self._location_prompt(region, world_info, style_input), kind="location"
         )
-        return self._parse_json(response["message"]["content"])
 
+    async def agenerate_location(self, region, world_info="", style_input=""):
+        return await self._achat_json(
+            self._location_prompt(region, world_info, style_input), kind="location"
+        )
 
-    def generate_location(self, region, world_info="", style_input=""):
+    # Several locations in one call, see batch_generation
+    def generate_locations(self, region, count, world_info="", style_input=""):
+        return batch_generation.generate_batch(
+            self, "location", count,
+            lambda first, size: self._location_prompt(region, world_info, style_input)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.generate_location(region, world_info, style_input),
+        )
+
+    async def agenerate_locations(self, region, count, world_info="", style_input=""):
+        return await batch_generation.agenerate_batch(
+            self, "location", count,
+            lambda first, size: self._location_prompt(region, world_info, style_input)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.agenerate_location(region, world_info, style_input),
+        )
+
+    def _location_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Create a unique fictional signficant locations for the location of {}, a {}.
         Region Short Description: {}
@@ -224,24 +545,44 @@ class ollamaClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.generate_location()
 
-        if self._get_size_of_string(prompt) >= 90:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = self.client.chat(
-            model=self.general_use_model, messages=self._create_messages(prompt), format="json"
+    # The dice seeds are taken for the same calls as GPT4oClient, this prompt
+    # does not roll demographics
+    def generate_character(self, region, world_info="", style_input="", dice_seed=None):
+        return self._chat_json(
+            self._character_prompt(region, world_info, style_input), kind="character"
+        )
+
+    async def agenerate_character(self, region, world_info="", style_input="", dice_seed=None):
+        return await self._achat_json(
+            self._character_prompt(region, world_info, style_input), kind="character"
         )
-        return self._parse_json(response["message"]["content"])
 
-    def generate_character(self, region, world_info="", style_input=""):
+    # Several characters in one call, see batch_generation
+    def generate_characters(self, region, count, world_info="", style_input="", dice_seeds=None):
+        return batch_generation.generate_batch(
+            self, "character", count,
+            lambda first, size: self._character_prompt(region, world_info, style_input)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.generate_character(region, world_info, style_input),
+        )
+
+    async def agenerate_characters(self, region, count, world_info="", style_input="", dice_seeds=None):
+        return await batch_generation.agenerate_batch(
+            self, "character", count,
+            lambda first, size: self._character_prompt(region, world_info, style_input)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.agenerate_character(region, world_info, style_input),
+        )
+
+    def _character_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Create a unique fictional character for the location of {}, a {}.
         Region Short Description: {}
@@ -254,24 +595,25 @@ class ollamaClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.generate_character()
 
-        if self._get_size_of_string(prompt) >= 90:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = self.client.chat(
-            model=self.general_use_model, messages=self._create_messages(prompt), format="json"
+    def generate_regional_drama(self, region, world_info="", style_input=""):
+        return self._chat_json(
+            self._regional_drama_prompt(region, world_info, style_input), kind="quest"
         )
-        return self._parse_json(response["message"]["content"])
 
-    def generate_regional_drama(self, region, world_info="", style_input=""):
+    async def agenerate_regional_drama(self, region, world_info="", style_input=""):
+        return await self._achat_json(
+            self._regional_drama_prompt(region, world_info, style_input), kind="quest"
+        )
+
+    def _regional_drama_prompt(self, region, world_info, style_input):
         prompt = """
         INSTRUCTIONS: Review all of the characteristics of the selected region and develop an interesting task, question or quest for the region.
         Please return a paragraph and be merely a prompt or suggestion used for direction.
@@ -286,34 +628,60 @@ class ollamaClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
-            style_input,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
         )
         prompt += self.jstructs.generate_quest()
         prompt += "\nThe situation may involve the following characters or locations:"
         prompt += "\nCharacters:\n"
-        for i in region["characters"]:
-            if "personality" in region["characters"][i]:
-                prompt += f" - {region['characters'][i]['personality']}"
+        personalities = [
+            character["personality"]
+            for character in region["characters"].values()
+            if "personality" in character
+        ]
+        for personality in self.budget.trim_list("characters", personalities):
+            prompt += f" - {personality}\n"
 
         prompt += "\nSignificant locations:\n"
-        for i in region["locations"]:
-            if "lore" in region["locations"][i]:
-                prompt += f" - {region['locations'][i]['lore']}"
+        lore = [
+            location["lore"]
+            for location in region["locations"].values()
+            if "lore" in location
+        ]
+        for entry in self.budget.trim_list("locations", lore):
+            prompt += f" - {entry}\n"
 
-        if self._get_size_of_string(prompt) >= 90:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = self.client.chat(
-            model=self.general_use_model, messages=self._create_messages(prompt), format="json"
+    def generate_random_encounter(self, region, world_info):
+        return self._chat_json(
+            self._random_encounter_prompt(region, world_info), kind="encounter"
         )
-        return self._parse_json(response["message"]["content"])
 
-    def generate_random_encounter(self, region, world_info):
+    async def agenerate_random_encounter(self, region, world_info):
+        return await self._achat_json(
+            self._random_encounter_prompt(region, world_info), kind="encounter"
+        )
+
+    # A whole random encounter table in as few calls as the context allows
+    def generate_encounter_table(self, region, count, world_info):
+        return batch_generation.generate_batch(
+            self, "encounter", count,
+            lambda first, size: self._random_encounter_prompt(region, world_info)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.generate_random_encounter(region, world_info),
+        )
+
+    async def agenerate_encounter_table(self, region, count, world_info):
+        return await batch_generation.agenerate_batch(
+            self, "encounter", count,
+            lambda first, size: self._random_encounter_prompt(region, world_info)
+            + batch_generation.batch_instructions(size),
+            lambda index: self.agenerate_random_encounter(region, world_info),
+        )
+
+    def _random_encounter_prompt(self, region, world_info):
         prompt = """
         INSTRUCTIONS: Review all of the characteristics of the selected region and create a short but interesting random encounter.
         Please return a short paragraph describing a detail description of the situation or opportunity. Some can be good, some situations can be bad.
@@ -327,33 +695,64 @@ class ollamaClient:
         """.format(
             region["LocationName"],
             region["LocationType"],
-            region["ShortDescription"],
-            world_info,
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
         )
         prompt += self.jstructs.generate_random_encounter()
         prompt += "\nThe situation may involve the following characters or locations:"
         prompt += "Characters:\n"
-        for character in region["characters"]:
+        characters = []
+        for character in region["characters"].values():
             if "description" in character and "personality" in character:
-                prompt += f" - {character['description']}. {character['personality']}."
+                characters.append(f"{character['description']}. {character['personality']}.")
             else:
                 logging.warning("missing important character elements")
+        for character in self.budget.trim_list("characters", characters):
+            prompt += f" - {character}\n"
 
         prompt += "Significant locations:\n"
-        for location in region["locations"]:
+        locations = []
+        for location in region["locations"].values():
             if "description" in location and "lore" in location:
-                prompt += f" - {location['description']}. {location['lore']}."
+                locations.append(f"{location['description']}. {location['lore']}.")
             else:
                 logging.warning("missing important location  elements")
+        for location in self.budget.trim_list("locations", locations):
+            prompt += f" - {location}\n"
 
-        if self._get_size_of_string(prompt) >= 90:
-            print(" - Shortening prompt")
-            prompt = self._shorten_prompt(prompt)
-            logging.warning(prompt)
+        return prompt
 
-        logging.debug(f"<< INPUT TO LLM:\n{prompt}\n")
-        response = self.client.chat(
-            model=self.general_use_model, messages=self._create_messages(prompt), format="json"
+    def generate_regional_demographics(self, region, world_info="", style_input=""):
+        if region == "":
+            return {}
+        return self._chat_json(
+            self._regional_demographics_prompt(region, world_info, style_input)
         )
-        return self._parse_json(response["message"]["content"])
-    
+
+    async def agenerate_regional_demographics(self, region, world_info="", style_input=""):
+        if region == "":
+            return {}
+        return await self._achat_json(
+            self._regional_demographics_prompt(region, world_info, style_input)
+        )
+
+    def _regional_demographics_prompt(self, region, world_info, style_input):
+        prompt = """
+        INSTRUCTIONS: Based on the provided region and world information, generate a list of possible races, genders, and classes or occupations that might be found in this region. Provide a probability or range table for each.
+        Region Name: {} - a {}.
+        Region Short Description: {}
+        World Info: {}
+        Writing Style: {}
+        Please return this information in JSON format. Please always provide correct json syntax.
+        Use object notation, not arrays. Store these under "demographics".
+        Example JSON:
+        """.format(
+            region["LocationName"],
+            region["LocationType"],
+            self.budget.trim("description", region["ShortDescription"]),
+            self.budget.trim("world_info", world_info),
+            self.budget.trim("writing_style", style_input),
+        )
+        prompt += self.jstructs.regional_demographics()
+
+        return prompt
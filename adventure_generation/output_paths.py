@@ -0,0 +1,32 @@
+import os
+import contextvars
+from contextlib import contextmanager
+
+# Where a run writes the files of its world (journal, region shards, images,
+# pages). A single run uses output/, every job of a batch run its own root.
+#
+# The root is a ContextVar, like the telemetry labels: steps that the task
+# scheduler, the image queue or asyncio run for a job keep the root that was
+# current when they were added.
+
+DEFAULT_ROOT = "output"
+
+_root = contextvars.ContextVar("output_root", default=DEFAULT_ROOT)
+
+
+def output_root():
+    return _root.get()
+
+
+def output_path(*parts):
+    return os.path.join(_root.get(), *parts)
+
+
+# Write everything done inside this block under root
+@contextmanager
+def using_output_root(root):
+    token = _root.set(root)
+    try:
+        yield
+    finally:
+        _root.reset(token)
@@ -0,0 +1,634 @@
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from adventure_generation.map_analyzer import MapAnalyzer
+from adventure_generation.context_extractor import ContextExtractor
+from adventure_generation.world_builder import WorldBuilder
+from adventure_generation.checkpoint_journal import CheckpointJournal
+from adventure_generation.world_store import WorldStore
+from adventure_generation.stage_cache import StageCache, hash_file, hash_text
+from adventure_generation.task_scheduler import TaskScheduler
+from adventure_generation.image_queue import ImageJobQueue, concurrency_from_env
+from adventure_generation.telemetry import labels
+from adventure_generation.output_paths import DEFAULT_ROOT, output_path, using_output_root
+from adventure_generation.backends import BackendRegistry
+from adventure_generation.rate_limiter import get_rate_limiter
+from adventure_generation.llm_cache import get_llm_cache, get_prompt_cache, DEFAULT_CACHE_PATH, DEFAULT_PROMPT_CACHE_PATH
+
+# The generator as a library:
+#
+#   config = RunConfig(using_money=False, output_root="output/coast", assume_yes=True, seed=7)
+#   world = Pipeline(config).run("coast.txt", "coast.jpg", "styles.json")
+#
+# A Pipeline holds everything one world needs: its settings, its clients, its
+# dice and its output root. Nothing is read from the environment or kept in
+# module globals, so several pipelines can build worlds at the same time in
+# one process. Pipelines made with for_root() share their clients. What is
+# shared by the whole process (rate limiter, telemetry, logs) is listed in
+# the README; the caches and HTTP pools are shared by pipelines whose
+# settings for them are the same.
+#
+# Clients come from a BackendRegistry: only the providers a stage actually
+# uses are imported and constructed, when that stage first runs.
+
+# Directory where your HTML templates are stored
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+class RunStopped(Exception):
+    """The run stopped before building anything: the API calls were not
+    confirmed, or the answer about an existing world made no sense (failed)."""
+
+    def __init__(self, message, failed=False):
+        super().__init__(message)
+        self.failed = failed
+
+
+class RunConfig:
+    """Settings of a run. RunConfig.from_env() reads them from the AC_* variables."""
+
+    def __init__(
+        self,
+        using_money=True,
+        create_images=True,
+        auto1111_server=None,
+        debug=False,
+        async_mode=False,
+        batch_items=False,
+        assume_yes=False,
+        resume=True,
+        stage_cache=True,
+        seed=None,
+        max_threads=2,
+        max_in_flight=8,
+        image_concurrency=None,
+        dalle_rpm=None,
+        stream=False,
+        prompt_tokens=None,
+        ollama_server=None,
+        ollama_num_ctx=None,
+        map_tiles="1",
+        http_pool_size=None,
+        a1111_pipeline=2,
+        a1111_format=None,
+        llm_cache="off",
+        llm_cache_path=DEFAULT_CACHE_PATH,
+        cache_salt="",
+        prompt_cache=True,
+        prompt_cache_path=DEFAULT_PROMPT_CACHE_PATH,
+        output_root=DEFAULT_ROOT,
+    ):
+        # GPT for everything, or a local ollama server (GPT still reads the map)
+        self.using_money = using_money
+        self.create_images = create_images
+        # host[:port] of the AUTOMATIC1111 server, None for localhost
+        self.auto1111_server = auto1111_server
+        # One item of each kind per region
+        self.debug = debug
+        # Run the region chains on asyncio instead of worker threads
+        self.async_mode = async_mode
+        # Ask for a region's locations, characters and encounters in batched calls
+        self.batch_items = batch_items
+        # Answer the confirmation prompts with yes, for runs nobody is watching.
+        # An existing world is then replaced by a new one.
+        self.assume_yes = assume_yes
+        # Pick up an interrupted run from its checkpoint journal
+        self.resume = resume
+        # Reuse the map analysis and input summaries while their inputs are unchanged
+        self.stage_cache = stage_cache
+        # Seed of the dice that size each region and roll its characters
+        self.seed = seed
+        self.max_threads = max_threads
+        self.max_in_flight = max_in_flight
+        # Image jobs running at once per image backend, see ImageJobQueue
+        self.image_concurrency = dict(image_concurrency or {})
+        # DALL-E images per minute of your OpenAI tier, None for the tier 1 limit
+        self.dalle_rpm = dalle_rpm
+        # Stream JSON answers and hang up once the needed keys are in
+        self.stream = stream
+        # Prompt budget in tokens, None for each client's default
+        self.prompt_tokens = prompt_tokens
+        # host[:port] of the Ollama server, None for localhost
+        self.ollama_server = ollama_server
+        # Context window Ollama runs its model with, None for Ollama's 2048
+        self.ollama_num_ctx = ollama_num_ctx
+        # The map is studied as N x N tiles, "auto" picks N by map size
+        self.map_tiles = map_tiles
+        # Connections of the HTTP pool, None for enough for max_threads / max_in_flight
+        self.http_pool_size = http_pool_size
+        # AUTOMATIC1111 requests sent ahead, and the format its images are saved in
+        self.a1111_pipeline = a1111_pipeline
+        self.a1111_format = a1111_format
+        # LLM response cache: off, readthrough, writeonly or replay
+        self.llm_cache = llm_cache
+        self.llm_cache_path = llm_cache_path
+        self.cache_salt = cache_salt
+        # Cache of the rewritten image prompts
+        self.prompt_cache = prompt_cache
+        self.prompt_cache_path = prompt_cache_path
+        self.output_root = output_root
+
+    @classmethod
+    def from_env(cls):
+        # By default, I want to use GPT as little as possible despite gpt4o-mini being
+        # extremely affordable. While testing, I will use ollama when possible.
+        using_money = os.getenv("AC_USE_MONEY", "True") == "True"
+        create_images = os.getenv("AC_CREATE_IMAGES", "True") == "True"
+        config = cls(
+            using_money=using_money,
+            create_images=create_images,
+            auto1111_server=os.getenv("AC_AUTO1111_SERVER") or None,
+            ollama_server=os.getenv("AC_OLLAMA_SERVER") or None,
+            stream=os.getenv("AC_STREAM") == "True",
+            debug=os.getenv("AC_DEBUG") == "True",
+            async_mode=os.getenv("AC_ASYNC") == "True",
+            batch_items=os.getenv("AC_BATCH_ITEMS") == "True",
+            assume_yes=os.getenv("AC_ASSUME_YES") == "True",
+            resume=os.getenv("AC_RESUME") != "False",
+            stage_cache=os.getenv("AC_STAGE_CACHE") != "off",
+            image_concurrency=concurrency_from_env(),
+            map_tiles=os.getenv("AC_MAP_TILES", "1"),
+            a1111_format=os.getenv("AC_A1111_FORMAT") or None,
+            llm_cache=os.getenv("AC_LLM_CACHE", "off"),
+            llm_cache_path=os.getenv("AC_LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+            cache_salt=os.getenv("AC_CACHE_SALT", ""),
+            prompt_cache=os.getenv("AC_PROMPT_CACHE") != "off",
+            prompt_cache_path=os.getenv("AC_PROMPT_CACHE_PATH", DEFAULT_PROMPT_CACHE_PATH),
+        )
+        if os.getenv("AC_SEED") and os.getenv("AC_SEED").isdigit():
+            config.seed = int(os.getenv("AC_SEED"))
+        if os.getenv("AC_MAX_THREADS") and os.getenv("AC_MAX_THREADS").isdigit():
+            config.max_threads = int(os.getenv("AC_MAX_THREADS"))
+        if os.getenv("AC_MAX_IN_FLIGHT") and os.getenv("AC_MAX_IN_FLIGHT").isdigit():
+            config.max_in_flight = int(os.getenv("AC_MAX_IN_FLIGHT"))
+        if os.getenv("AC_PROMPT_TOKENS") and os.getenv("AC_PROMPT_TOKENS").isdigit():
+            config.prompt_tokens = int(os.getenv("AC_PROMPT_TOKENS"))
+        if os.getenv("AC_DALLE_RPM") and os.getenv("AC_DALLE_RPM").isdigit():
+            config.dalle_rpm = int(os.getenv("AC_DALLE_RPM"))
+        if os.getenv("AC_OLLAMA_NUM_CTX") and os.getenv("AC_OLLAMA_NUM_CTX").isdigit():
+            config.ollama_num_ctx = int(os.getenv("AC_OLLAMA_NUM_CTX"))
+        if os.getenv("AC_HTTP_POOL_SIZE") and os.getenv("AC_HTTP_POOL_SIZE").isdigit():
+            config.http_pool_size = int(os.getenv("AC_HTTP_POOL_SIZE"))
+        if os.getenv("AC_A1111_PIPELINE") and os.getenv("AC_A1111_PIPELINE").isdigit():
+            config.a1111_pipeline = int(os.getenv("AC_A1111_PIPELINE"))
+        return config
+
+    # A copy with some settings changed
+    def replace(self, **changes):
+        config = copy.copy(self)
+        for name, value in changes.items():
+            if not hasattr(config, name):
+                raise AttributeError(f"RunConfig has no setting '{name}'")
+            setattr(config, name, value)
+        return config
+
+    def banner(self):
+        return f"""
+-----------------------
+GPT MODE*: {self.using_money}
+CREATING IMAGES: {self.create_images}
+DEBUG MODE: {self.debug}
+ASYNC MODE: {self.async_mode}
+BATCH ITEMS: {self.batch_items}
+CWD: {os.getcwd()}
+
+* As of now, GPT is still required for map reading.
+-----------------------
+"""
+
+
+class Pipeline:
+    """Builds worlds with one RunConfig, its own clients and its own output root.
+
+    ask is how a question reaches the user, input() on the command line. A
+    pipeline without one never blocks on a question: unless config.assume_yes
+    is set, a run that needs an answer raises RunStopped.
+    """
+
+    def __init__(self, config=None, gpt4o_client=None, ollama_client=None, stages=None, backends=None, ask=None):
+        self.config = config or RunConfig()
+        self.ask = ask
+        self.backends = backends or BackendRegistry(self.backend_options())
+        if gpt4o_client is not None:
+            self.backends.register("openai", gpt4o_client)
+        if ollama_client is not None:
+            self.backends.register("ollama", ollama_client)
+        self.stages = stages or StageCache(
+            os.path.join(self.config.output_root, "json_outputs", "stages"), self.config.stage_cache
+        )
+        if self.config.dalle_rpm:
+            get_rate_limiter().set_limits("openai", "dall-e-3", rpm=self.config.dalle_rpm)
+        # Dice of this world alone, seeded by config.seed
+        self.random = random.Random(self.config.seed)
+        self._dice_lock = threading.Lock()
+
+    # Enough connections for every worker to have one request in flight plus
+    # a few image downloads, unless the config sets the size
+    def http_pool_size(self):
+        return self.config.http_pool_size or max(self.config.max_threads, self.config.max_in_flight) + 4
+
+    def llm_cache(self):
+        return get_llm_cache(self.config.llm_cache, self.config.llm_cache_path, self.config.cache_salt)
+
+    def prompt_cache(self):
+        return get_prompt_cache(self.config.prompt_cache, self.config.prompt_cache_path)
+
+    # Constructor arguments of each provider's client
+    def backend_options(self):
+        text = {
+            "stream": self.config.stream,
+            "prompt_tokens": self.config.prompt_tokens,
+            "cache": self.llm_cache(),
+            "pool_size": self.http_pool_size(),
+        }
+        return {
+            "openai": text,
+            "ollama": dict(text, server=self.config.ollama_server, num_ctx=self.config.ollama_num_ctx),
+            "a1111": {
+                "server": self.config.auto1111_server,
+                "pipeline_depth": self.config.a1111_pipeline,
+                "output_format": self.config.a1111_format,
+                "pool_size": self.http_pool_size(),
+            },
+        }
+
+    # Another pipeline with the same clients and stage cache, writing under root
+    def for_root(self, root, **changes):
+        return Pipeline(
+            self.config.replace(output_root=root, **changes), stages=self.stages, backends=self.backends,
+        )
+
+    # GPT reads the map in both modes
+    @property
+    def gpt4o_client(self):
+        return self.backends.get("openai")
+
+    @property
+    def ollama_client(self):
+        return self.backends.get("ollama")
+
+    # The provider for the text of the regions and the summaries
+    @property
+    def text_provider(self):
+        return "openai" if self.config.using_money else "ollama"
+
+    @property
+    def text_llm(self):
+        return self.backends.get(self.text_provider)
+
+    @property
+    def image_backend(self):
+        return "dalle" if self.config.using_money else "a1111"
+
+    # Everything done inside this block writes under the output root of this pipeline
+    def using_root(self):
+        return using_output_root(self.config.output_root)
+
+    def new_world_builder(self, context, region, journal=None, image_queue=None):
+        world_builder = WorldBuilder(
+            context, region, self.text_llm, journal, self.config.batch_items, self.config.seed
+        )
+
+        # Portraits and location maps start as soon as a region's characters
+        # (or locations) exist
+        if image_queue is not None:
+            world_builder.enable_images(
+                image_queue, self.image_backend, self.text_llm, lambda: self.backends.get("a1111"),
+                self.prompt_cache(),
+            )
+        return world_builder
+
+    def schedule_region_tasks(self, scheduler, context, region, output_queue, journal=None, store=None, image_queue=None):
+        # This adds the region development chain to the shared task graph. This looks like:
+        # 1. Describe the region in generalized detail
+        # 2. Create each new location and describe it in detail
+        # 3. Create each new character and describe them in detail
+        # 4. Create a custom encounter table of random events for this region
+        # 5. Create a minor side quest that connect characters and locations.
+        # 6. Illustrate the characters and locations, on the image queue next to the text steps
+
+        # The tasks keep the output root they were added with
+        with self.using_root():
+            world_builder = self.new_world_builder(context, region, journal, image_queue)
+
+            text_done = world_builder.schedule_development_chain(scheduler)
+
+            def text_finished():
+                world_builder_finish(world_builder, output_queue, store, image_queue)
+
+            scheduler.add(f"{region['LocationName']}/save", text_finished, deps=[text_done], cost=0)
+
+    async def async_world_builder_task(self, context, region, semaphore, output_queue, journal=None, store=None, image_queue=None):
+        # Same chain as schedule_region_tasks, but the text steps of every region share
+        # one event loop and one in-flight limit (semaphore).
+        print(f" - Starting async chain for region: {region['LocationName']}")
+
+        with self.using_root():
+            world_builder = self.new_world_builder(context, region, journal, image_queue)
+
+            await world_builder.aregion_development_chain(semaphore)
+
+            # Saving writes files, keep it off the event loop
+            await asyncio.to_thread(world_builder_finish, world_builder, output_queue, store, image_queue)
+
+    async def async_world_builder_runner(self, context, regions, output_queue, journal=None, store=None, image_queue=None):
+        semaphore = asyncio.Semaphore(self.config.max_in_flight)
+        try:
+            await asyncio.gather(*(
+                self.async_world_builder_task(context, region, semaphore, output_queue, journal, store, image_queue)
+                for region in regions
+            ))
+        finally:
+            await close_async_pool()
+
+    # The checkpoint journal and region store of this pipeline's output root.
+    # Every finished step is journaled. If a journal is left over, the last run
+    # was interrupted and we only need to generate the missing steps.
+    def open_journal(self):
+        with self.using_root():
+            journal = CheckpointJournal(output_path('json_outputs', 'checkpoint_journal.jsonl'))
+            store = WorldStore(output_path('json_outputs', 'world'))
+        if len(journal) > 0 and not self.config.resume:
+            print("- discarding the checkpoint journal of the interrupted run")
+            journal.clear()
+        return journal, store
+
+    # Roll the dice for the number of characters, locations, quests and
+    # encounters of every region. A resumed run keeps the rolls it journaled.
+    def plan_regions(self, world, journal=None, store=None):
+
+        if journal is not None and len(journal) > 0:
+            print(f"Resuming the interrupted world ({len(journal)} finished steps in the checkpoint journal)...")
+        else:
+            print("Creating a new world...")
+            if store is not None:
+                store.reset()
+        if store is not None:
+            store.save_world_info(world)
+        # Start Rolling for a random number of characters and locations in each region
+        for region in world['regions']:
+
+            # A resumed run has to keep the dice rolls of the interrupted one
+            if journal is not None and journal.has(region['LocationName'], 'plan'):
+                region.update(journal.get(region['LocationName'], 'plan'))
+                continue
+
+            # For each region, roll dice to determine the number of characters and locations need to be generated.
+            with self._dice_lock:
+                dice = self.random
+                if region['LocationType'] == 'bigTown':
+                    region['num_locations'] = dice.randint(4, 10)
+                    region['num_characters'] = dice.randint(4, 10)
+                    region['quests'] = dice.randint(1, 6)
+                    region['encounters'] = 10
+
+                elif region['LocationType'] == 'smallTown':
+                    region['num_locations'] = dice.randint(2, 6)
+                    region['num_characters'] = dice.randint(2, 6)
+                    region['quests'] = dice.randint(1, 2)
+                    region['encounters'] = 8
+
+                elif region['LocationType'] == 'other' or region['LocationType'] == 'NaturalFeature':
+                    region['num_locations'] = dice.randint(1, 2)
+                    region['num_characters'] = dice.randint(1, 4)
+                    region['quests'] = dice.randint(1, 4)
+                    region['encounters']  = 6
+
+            # minimize
+            if self.config.debug:
+                region['num_locations'] = 1
+                region['num_characters'] = 1
+                region['quests'] = 1
+                region['encounters'] = 1
+
+            if journal is not None:
+                journal.record(region['LocationName'], 'plan', 0, {
+                    key: region[key] for key in ('num_locations', 'num_characters', 'quests', 'encounters')
+                })
+
+    # The user's answer to a question, `default` when assume_yes is set
+    def _answer(self, question, default):
+        if self.config.assume_yes:
+            return default
+        if self.ask is None:
+            raise RunStopped(f"No one to answer '{question.strip()}', set assume_yes to run unattended")
+        return self.ask(question)
+
+    # Warn the user about the number of queries, stops unless they say yes
+    def confirm_api_calls(self):
+        if self.config.using_money == True:
+            print(f"Warning: about to perform 'very many' API calls. Generally more than 100 per map location. Please confirm if this is okay.")
+            print(f"Warning: All queries will use OpenAI GPT 4o, 4o-mini, 3.5-turbo, and DALL-E 3.")
+        else:
+            print(f"You are running in FREE MODE and will use a local ollama server")
+            print(f"Warning: about to perform 'very many' API calls. This will take some time. Please confirm if this is okay.")
+        user_confirmation = self._answer("Enter 'yes' to proceed, or any other key to stop:", 'yes')
+
+        if user_confirmation.lower() != 'yes':
+            raise RunStopped("Process stopped by user.")
+
+    # Image jobs get their own workers, one pool per image backend
+    def new_image_queue(self):
+        return ImageJobQueue(self.config.image_concurrency) if self.config.create_images else None
+
+    # Put the built regions of output_queue into the world and save it as
+    # json_outputs/expanded_world.json of the output root
+    def save_expanded_world(self, world, output_queue):
+        # Collect results from the output queue
+        built_world = []
+        while not output_queue.empty():
+            built_world.append(output_queue.get())
+
+        # Update the world with the built regions
+        world['regions'] = built_world
+
+        # Save the updated world as a new JSON file
+        expanded_world_json_path = self.expanded_world_path()
+        os.makedirs(os.path.dirname(expanded_world_json_path), exist_ok=True)
+        with open(expanded_world_json_path, 'w') as file:
+            json.dump(world, file, indent=4)
+        return world
+
+    def expanded_world_path(self):
+        return os.path.join(self.config.output_root, 'json_outputs', 'expanded_world.json')
+
+    def build_regions(self, context_extractor, world, journal=None, store=None):
+        self.plan_regions(world, journal, store)
+        self.confirm_api_calls()
+
+        # If the user has confirmed, the remaining code will proceed as written
+        output_queue = queue.Queue()
+        image_queue = self.new_image_queue()
+
+        try:
+            if self.config.async_mode:
+                # In async mode a single event loop replaces the worker threads
+                asyncio.run(self.async_world_builder_runner(
+                    context_extractor, world['regions'], output_queue, journal, store, image_queue))
+            else:
+                # Every step of every region goes into one task graph that a single pool
+                # of worker threads drains, biggest remaining chain first
+                scheduler = TaskScheduler(self.config.max_threads)
+                for region in world['regions']:
+                    self.schedule_region_tasks(scheduler, context_extractor, region, output_queue, journal, store, image_queue)
+                scheduler.run()
+        finally:
+            # The last images are usually still rendering when the text is done
+            if image_queue is not None:
+                image_queue.join()
+
+        return self.save_expanded_world(world, output_queue)
+
+    # The region pages of the output root (story_html/). env is a Jinja
+    # environment to reuse, if the caller keeps one.
+    def generate_documents(self, expanded_world_json_path=None, env=None):
+        # Create a output directory and run document generator
+        # Create output directory if it doesn't exist
+        story_output_dir = os.path.join(self.config.output_root, 'story_html')
+        if not os.path.exists(story_output_dir):
+            os.makedirs(story_output_dir)
+
+        # Run DocumentGenerator
+        from adventure_generation.document_generator import DocumentGenerator
+        print("Generating docs")
+        document_generator = DocumentGenerator(
+            expanded_world_json_path or self.expanded_world_path(), TEMPLATE_DIR, story_output_dir, env=env
+        )
+        document_generator.generate_html()
+
+    # The map analysis and the three input summaries do not depend on each other,
+    # so they run together. Each one is kept in the stage cache under the hash of
+    # its own input and model: a warm start makes no calls at all, and changing
+    # one input only redoes the stage that reads it.
+    def bootstrap_stages(self, context_extractor):
+        stages = self.stages
+        map_image = context_extractor.get_input_imagepath()
+
+        # We use GPT-4o to analyze the map
+        # I couldn't get llava to read any of the text on my sample maps.
+        # The clients are only made for the stages that miss the cache.
+        map_analyzer = MapAnalyzer(map_image, None, self.config.map_tiles, self.config.max_threads)
+
+        def analyze_map():
+            print(f"- studying the map with GPT4o: {map_image}")
+            map_analyzer.llm_client = self.gpt4o_client
+            with labels(step="map_analysis"):
+                return map_analyzer.identify_regions()
+
+        def summarize(name, text):
+            def build():
+                with labels(step=f"summary_{name}"):
+                    return self.text_llm._summarize_context(text)
+            return build
+
+        summary_backend = f"{self.text_provider}/{self.backends.model(self.text_provider, 'summary')}"
+        inputs = {
+            "context": context_extractor.get_context(),
+            "writing_style": context_extractor.get_writing_style(),
+            "visual_style": context_extractor.get_visual_style(),
+        }
+
+        print("- studying the map and parsing user text input")
+        # The workers write under the output root of this pipeline
+        with self.using_root(), ThreadPoolExecutor(max_workers=1 + len(inputs)) as pool:
+            world = pool.submit(
+                contextvars.copy_context().run, stages.get_or_build, "map_analysis",
+                dict(map_analyzer.settings_key(), image=hash_file(map_image), model=self.backends.model("openai", "map")),
+                analyze_map,
+            )
+            summaries = {
+                name: pool.submit(
+                    contextvars.copy_context().run, stages.get_or_build, f"summary_{name}",
+                    {"text": hash_text(text), "backend": summary_backend}, summarize(name, text),
+                )
+                for name, text in inputs.items()
+            }
+            context_extractor.optimized_context = summaries["context"].result()
+            context_extractor.optimized_writing_style = summaries["writing_style"].result()
+            context_extractor.optimized_visual_style = summaries["visual_style"].result()
+            world = world.result()
+
+        if stages.hits:
+            print(f"- reused {stages.hits} of {stages.hits + stages.misses} bootstrap stages")
+        return world
+
+    # Build the world of one map, returns the expanded world
+    def run(self, prompt_file, map_image, settings):
+        # Extract context from the prompt file
+        print("- reading the context file")
+        context_extractor = ContextExtractor(prompt_file, map_image, settings)
+
+        # Check if the output directory exists, if not, create it
+        input_directory = 'input'
+        if not os.path.exists(input_directory):
+            os.makedirs(input_directory)
+
+        # Check if the output directory exists, if not, create it
+        output_directory = self.config.output_root
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+
+        world = self.bootstrap_stages(context_extractor)
+
+        journal, store = self.open_journal()
+
+        # But basically, load the old world file, or create a new one.
+        expanded_world_json_path = self.expanded_world_path()
+        if len(journal) > 0:
+            world = self.build_regions(context_extractor, world, journal, store)
+        elif os.path.exists(expanded_world_json_path):
+            print("Existing world found. Do you want to use the existing world (option 1), or create a new one (option 2)?")
+            user_option = self._answer("Enter option number: ", '2')
+            if user_option == '1':
+                print("Using the existing world.")
+                with open(expanded_world_json_path, 'r') as file:
+                    world = json.load(file)
+            elif user_option == '2':
+                world = self.build_regions(context_extractor, world, journal, store)
+            else:
+                raise RunStopped("Invalid input. Stopping.", failed=True)
+        else:
+            world = self.build_regions(context_extractor, world, journal, store)
+
+        self.generate_documents(expanded_world_json_path)
+
+        # The world is complete, nothing left to resume
+        journal.clear()
+        return world
+
+
+# Async connections can not outlive their event loop: close the pool of the
+# running loop, if a backend opened one, before asyncio.run() tears it down
+async def close_async_pool():
+    transport = sys.modules.get("adventure_generation.http_transport")
+    if transport is not None:
+        await transport.ashutdown()
+
+
+# The text of a region is done. Its images may still be rendering, the region
+# is handed over once they are.
+def world_builder_finish(world_builder, output_queue, store=None, image_queue=None):
+    built = world_builder.region
+
+    # save the region shard with all json for review
+    if store is not None:
+        store.save_region(built, 'text')
+
+    if image_queue is None:
+        output_queue.put(built)
+        return
+
+    def illustrated():
+        # save the region shard again, now with images
+        if store is not None:
+            store.save_region(built, 'illustrated')
+        output_queue.put(built)
+
+    image_queue.when_done(world_builder.image_jobs, illustrated)
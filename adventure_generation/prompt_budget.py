@@ -0,0 +1,168 @@
+import re
+import logging
+import threading
+from functools import lru_cache
+
+# tiktoken gives exact token counts for OpenAI models (and a close one for
+# llama 3, whose tokenizer is built on the same BPE). Without it we fall back
+# to a word-piece estimate that errs on the high side.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Share of a prompt's token budget each trimmable section may use. Whatever is
+# left over goes to the fixed instructions and the example JSON.
+DEFAULT_SECTION_SHARES = {
+    "description": 0.08,
+    "world_info": 0.25,
+    "writing_style": 0.08,
+    "characters": 0.12,
+    "locations": 0.12,
+}
+
+# Never trim a section below this many tokens, a trimmed line must still say something
+MIN_SECTION_TOKENS = 24
+
+TRIM_MARKER = " [...]"
+
+_WORD_PIECES = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def _encoding_name(model):
+    if model.startswith(("gpt-4o", "o1")):
+        return "o200k_base"
+    return "cl100k_base"
+
+
+@lru_cache(maxsize=None)
+def _load_encoding(name):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # tiktoken downloads its tables on first use, which can fail offline
+        logging.warning(f"Could not load the {name} tokenizer, estimating tokens instead: {e}")
+        return None
+
+
+class TokenCounter:
+    def __init__(self, model):
+        self.model = model
+        self.encoding = _load_encoding(_encoding_name(model))
+        self.count = lru_cache(maxsize=4096)(self._count)
+
+    def _count(self, text):
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        # Roughly one token per short word or punctuation mark, long words take more
+        return sum(1 + len(piece) // 6 for piece in _WORD_PIECES.findall(text))
+
+    # The longest prefix of text that is at most max_tokens long
+    def head(self, text, max_tokens):
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            return self.encoding.decode(tokens[:max_tokens])
+        pieces = 0
+        for match in _WORD_PIECES.finditer(text):
+            size = 1 + len(match.group()) // 6
+            if pieces + size > max_tokens:
+                # Keep whatever part of the last word still fits
+                return text[: match.start() + max(0, max_tokens - pieces - 1) * 6]
+            pieces += size
+        return text
+
+
+class PromptBudget:
+    """Token budget for the prompts sent to one model.
+
+    Every prompt gets `prompt_tokens` tokens. The variable sections (the region
+    description, World Info, Writing Style and lists of characters/locations)
+    each get a share of that, and are trimmed locally when they go over it:
+    whole sentences are dropped from the end first, and only a single overlong
+    sentence is cut mid-way. The same input always gives the same trimmed text,
+    so trimmed prompts still hit the response cache.
+
+    A prompt that is still too long is handed to an LLM shortening call as a
+    last resort, and that answer is kept for the rest of the run.
+    """
+
+    def __init__(self, model, prompt_tokens, shares=None):
+        self.counter = TokenCounter(model)
+        self.prompt_tokens = prompt_tokens
+        self.shares = dict(DEFAULT_SECTION_SHARES, **(shares or {}))
+        self.trim = lru_cache(maxsize=1024)(self._trim)
+        self._shortened = {}
+        self._lock = threading.Lock()
+
+    def count(self, text):
+        return self.counter.count(text)
+
+    def limit(self, section):
+        return max(MIN_SECTION_TOKENS, int(self.prompt_tokens * self.shares[section]))
+
+    def fits(self, prompt):
+        return self.count(prompt) <= self.prompt_tokens
+
+    def _trim(self, section, text, max_tokens=None):
+        text = str(text)
+        if max_tokens is None:
+            max_tokens = self.limit(section)
+        if self.count(text) <= max_tokens:
+            return text
+
+        max_tokens -= self.count(TRIM_MARKER)
+        kept = ""
+        for sentence in _SENTENCE_END.split(text):
+            candidate = f"{kept} {sentence}" if kept else sentence
+            if self.count(candidate) > max_tokens:
+                break
+            kept = candidate
+        if not kept:
+            kept = self.counter.head(text, max_tokens).rstrip()
+        logging.debug(f"Trimmed {section} from {self.count(text)} to {self.count(kept)} tokens")
+        return kept + TRIM_MARKER
+
+    # Trim a list of entries (one per character or location) so that together
+    # they fit the section's budget. Every entry keeps an equal share, so the
+    # last characters are not dropped just because the first ones are wordy.
+    def trim_list(self, section, entries):
+        entries = [str(entry) for entry in entries]
+        if not entries:
+            return entries
+        if sum(self.count(entry) for entry in entries) <= self.limit(section):
+            return entries
+        share = max(MIN_SECTION_TOKENS, self.limit(section) // len(entries))
+        return [self.trim(section, entry, share) for entry in entries]
+
+    # Last resort for prompts that are still over budget after local trimming
+    def fit(self, prompt, shorten):
+        if self.fits(prompt):
+            return prompt
+        with self._lock:
+            if prompt in self._shortened:
+                return self._shortened[prompt]
+        print(" - Shortening prompt")
+        logging.warning(f"Prompt is {self.count(prompt)} tokens, over the {self.prompt_tokens} token budget")
+        shortened = shorten(prompt)
+        with self._lock:
+            self._shortened[prompt] = shortened
+        return shortened
+
+    # Async twin of fit, `ashorten` is a coroutine function
+    async def afit(self, prompt, ashorten):
+        if self.fits(prompt):
+            return prompt
+        with self._lock:
+            if prompt in self._shortened:
+                return self._shortened[prompt]
+        print(" - Shortening prompt")
+        logging.warning(f"Prompt is {self.count(prompt)} tokens, over the {self.prompt_tokens} token budget")
+        shortened = await ashorten(prompt)
+        with self._lock:
+            self._shortened[prompt] = shortened
+        return shortened
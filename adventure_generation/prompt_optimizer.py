@@ -0,0 +1,90 @@
+import logging
+
+from adventure_generation.llm_cache import get_prompt_cache
+
+# The image prompt rewrite as a stage of its own: DALL-E prompts are rewritten
+# by GPT, Stable Diffusion keyword lines by Ollama. Every rewrite is cached on
+# disk under its description and visual style, so re-illustrating a world or
+# retrying a failed image never pays for it again, and the rewrites a region
+# still needs are asked for in one call.
+
+
+class PromptOptimizer:
+    def __init__(self, llm, backend, visual_style, cache=None):
+        # backend is "dalle" (llm is the GPT client) or "a1111" (llm is Ollama)
+        self.llm = llm
+        self.backend = backend
+        # Portraits and location maps use the same style, so they share entries
+        self.visual_style = visual_style
+        self.cache = cache or get_prompt_cache()
+
+    # The text the rewrite starts from. kind is "portrait" or "illustration".
+    def _input_prompt(self, kind, description):
+        if self.backend != "dalle":
+            return description
+        if kind == "portrait":
+            return self.llm.character_portrait_prompt(description, self.visual_style)
+        return self.llm.location_map_prompt(description, self.visual_style)
+
+    # Stable Diffusion keywords do not depend on the kind of image
+    def _request(self, kind, description):
+        return {
+            "model": f"{self.backend}/{kind}" if self.backend == "dalle" else self.backend,
+            "messages": [description, self.visual_style],
+        }
+
+    def _rewrite(self, kind, description):
+        if self.backend == "dalle":
+            return self.llm._optimize_dalle_prompt(self._input_prompt(kind, description))
+        return self.llm.optimize_for_stable_diffusion(description, self.visual_style)
+
+    def _rewrite_batch(self, kind, descriptions):
+        if self.backend == "dalle":
+            return self.llm._optimize_dalle_prompts(
+                [self._input_prompt(kind, description) for description in descriptions]
+            )
+        return self.llm.optimize_for_stable_diffusion_batch(descriptions, self.visual_style)
+
+    def optimize(self, kind, description):
+        return self.cache.fetch(
+            self.backend, self._request(kind, description),
+            lambda: self._rewrite(kind, description), str, str, dedupe=True,
+        )
+
+    # Optimized prompts for every description, in order
+    def optimize_batch(self, kind, descriptions):
+        if self.cache.mode == "off":
+            keys = [None] * len(descriptions)
+            prompts = [None] * len(descriptions)
+        else:
+            keys = [
+                self.cache.make_key(self.backend, self._request(kind, description), dedupe=True)
+                for description in descriptions
+            ]
+            prompts = [self.cache.get(key) for key in keys]
+        missing = [i for i, prompt in enumerate(prompts) if prompt is None]
+        if len(missing) == 1:
+            prompts[missing[0]] = self.optimize(kind, descriptions[missing[0]])
+        elif missing:
+            print(f" > Optimizing {len(missing)} prompts in one call")
+            try:
+                rewritten = self._rewrite_batch(kind, [descriptions[i] for i in missing])
+            except Exception as e:
+                logging.warning(f"Batched prompt optimization failed: {e}")
+                rewritten = []
+            # Rewrites are matched to their descriptions by position, so an
+            # answer of the wrong length is not cached at all
+            if len(rewritten) != len(missing):
+                if rewritten:
+                    logging.warning(f"Batched prompt optimization returned {len(rewritten)} prompts for {len(missing)}")
+                rewritten = []
+            for i, prompt in zip(missing, rewritten):
+                if prompt and prompt.strip():
+                    prompts[i] = prompt
+                    if keys[i] is not None:
+                        self.cache.put(keys[i], prompt)
+            # Whatever the batched answer lost is asked for one at a time
+            for i in missing:
+                if prompts[i] is None:
+                    prompts[i] = self.optimize(kind, descriptions[i])
+        return prompts
@@ -0,0 +1,248 @@
+import os
+import re
+import time
+import random
+import asyncio
+import threading
+import logging
+
+# Process-wide rate limiting for every LLM and image backend.
+# Each (backend, model) pair gets a requests-per-minute and a tokens-per-minute
+# bucket, and each backend gets an overall pair on top of that. A call reserves
+# what it needs from every bucket it touches and only sleeps when one of them
+# is in debt, so there is no delay at all while we have quota headroom.
+
+# Published OpenAI tier 1 limits. Response headers replace these as soon as
+# the first reply comes back, so they only matter for the first few calls.
+# Image answers carry no such headers, so the DALL-E limit (images per minute)
+# holds for the whole run: set your tier's with AC_DALLE_RPM, see set_limits.
+DEFAULT_MODEL_LIMITS = {
+    ("openai", "gpt-4o"): {"rpm": 500, "tpm": 30000},
+    ("openai", "gpt-4o-mini"): {"rpm": 500, "tpm": 200000},
+    ("openai", "gpt-3.5-turbo-16k"): {"rpm": 3500, "tpm": 200000},
+    ("openai", "dall-e-3"): {"rpm": 500, "tpm": None},
+}
+
+# A 429 that does not say how long to wait blocks the model for a random
+# time of up to BACKOFF_BASE * 2**attempt seconds ("full jitter"), at most
+# BACKOFF_CAP, so the threads that were turned away do not all come back at once
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+# Retry-After and the x-ratelimit-reset-* headers use "20ms", "1s" or "6m0s"
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+# Rough token estimate for a request before we send it: ~4 characters per
+# token for the messages plus everything we allow the model to write back.
+def estimate_tokens(messages, max_tokens=None):
+    chars = 0
+    for message in messages or []:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            for part in content:
+                chars += len(str(part.get("text", "")))
+        else:
+            chars += len(str(content))
+    return chars // 4 + (max_tokens or 0)
+
+
+class TokenBucket:
+    """A bucket that refills `per_minute` units evenly over each minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        rate = self.capacity / 60.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    # Take `amount` from the bucket and return how long the caller has to wait
+    # before that is actually covered. The bucket is allowed to go negative so
+    # that waiting callers queue up behind each other instead of racing.
+    def reserve(self, amount, now):
+        self._refill(now)
+        amount = min(float(amount), self.capacity)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / (self.capacity / 60.0)
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    # Values reported by the server win over our own bookkeeping
+    def sync(self, limit, remaining, now):
+        self._refill(now)
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.tokens = min(self.tokens, float(remaining))
+
+
+class RateLimiter:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._blocked_until = {}
+        # Dice of the backoff, apart from the process random
+        self._dice = random.Random()
+
+    # Backend-wide limits come from AC_<BACKEND>_RPM / AC_<BACKEND>_TPM.
+    # Nothing is set for ollama by default since it is usually a local server.
+    def _configured_limits(self, backend, model):
+        if model is not None:
+            return DEFAULT_MODEL_LIMITS.get((backend, model), {"rpm": None, "tpm": None})
+        limits = {}
+        for kind in ("rpm", "tpm"):
+            value = os.getenv(f"AC_{backend.upper()}_{kind.upper()}")
+            limits[kind] = int(value) if value and value.isdigit() else None
+        return limits
+
+    def _bucket(self, backend, model, kind):
+        key = (backend, model, kind)
+        if key not in self._buckets:
+            per_minute = self._configured_limits(backend, model)[kind]
+            self._buckets[key] = TokenBucket(per_minute) if per_minute else None
+        return self._buckets[key]
+
+    def _reserve(self, backend, model, tokens):
+        now = time.monotonic()
+        wait = 0.0
+        with self._lock:
+            for scope in (model, None):
+                for kind, amount in (("rpm", 1), ("tpm", tokens)):
+                    bucket = self._bucket(backend, scope, kind)
+                    if bucket is not None and amount:
+                        wait = max(wait, bucket.reserve(amount, now))
+                blocked_until = self._blocked_until.get((backend, scope), 0)
+                wait = max(wait, blocked_until - now)
+        return wait
+
+    # Block until a request of roughly `tokens` tokens may be sent.
+    # Returns the number of seconds we actually slept.
+    def acquire(self, backend, model, tokens=0):
+        wait = self._reserve(backend, model, tokens)
+        if wait > 0:
+            logging.info(f"Rate limiter: waiting {wait:.2f}s for {backend}/{model}")
+            time.sleep(wait)
+        return max(wait, 0.0)
+
+    # Async twin of acquire
+    async def aacquire(self, backend, model, tokens=0):
+        wait = self._reserve(backend, model, tokens)
+        if wait > 0:
+            logging.info(f"Rate limiter: waiting {wait:.2f}s for {backend}/{model}")
+            await asyncio.sleep(wait)
+        return max(wait, 0.0)
+
+    # Limits of a model set by the run (RunConfig.dalle_rpm), in place of
+    # DEFAULT_MODEL_LIMITS. The limiter is shared by the whole process, so the
+    # last pipeline to set a model's limits wins.
+    def set_limits(self, backend, model, rpm=None, tpm=None):
+        now = time.monotonic()
+        with self._lock:
+            for kind, per_minute in (("rpm", rpm), ("tpm", tpm)):
+                if not per_minute:
+                    continue
+                bucket = self._bucket(backend, model, kind)
+                if bucket is None:
+                    self._buckets[(backend, model, kind)] = TokenBucket(per_minute)
+                else:
+                    bucket.sync(per_minute, per_minute, now)
+
+    # Once the real usage is known, give back what we over-reserved
+    def settle(self, backend, model, reserved_tokens, used_tokens):
+        unused = reserved_tokens - used_tokens
+        if unused <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for scope in (model, None):
+                bucket = self._bucket(backend, scope, "tpm")
+                if bucket is not None:
+                    bucket.refund(unused, now)
+
+    # Read Retry-After and the x-ratelimit-* headers from a response (or from
+    # the response attached to a 429 error) and adjust the model's buckets.
+    # Returns True when the headers said how long to wait.
+    def update_from_headers(self, backend, model, headers):
+        if not headers:
+            return False
+        now = time.monotonic()
+        blocked = False
+        with self._lock:
+            for kind, name in (("rpm", "requests"), ("tpm", "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{name}")
+                remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                if limit is None and remaining is None:
+                    continue
+                limit = int(limit) if limit and limit.isdigit() else None
+                remaining = int(remaining) if remaining and remaining.isdigit() else None
+                bucket = self._buckets.get((backend, model, kind))
+                if bucket is None and limit:
+                    bucket = self._buckets[(backend, model, kind)] = TokenBucket(limit)
+                if bucket is not None:
+                    bucket.sync(limit, remaining, now)
+                if remaining == 0:
+                    reset = parse_duration(headers.get(f"x-ratelimit-reset-{name}"))
+                    if reset:
+                        self._block(backend, model, now + reset)
+                        blocked = True
+
+            retry_after = headers.get("retry-after-ms")
+            if retry_after is not None:
+                retry_after = parse_duration(retry_after)
+                retry_after = retry_after / 1000 if retry_after is not None else None
+            else:
+                retry_after = parse_duration(headers.get("retry-after"))
+            if retry_after:
+                self._block(backend, model, now + retry_after)
+                blocked = True
+        return blocked
+
+    # After the attempt-th 429 in a row (counting from 0) that came without a
+    # Retry-After, block the model for an exponential, jittered delay.
+    # Returns the delay.
+    def backoff(self, backend, model, attempt):
+        with self._lock:
+            delay = self._dice.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+            self._block(backend, model, time.monotonic() + delay)
+        return delay
+
+    def _block(self, backend, model, until):
+        key = (backend, model)
+        self._blocked_until[key] = max(self._blocked_until.get(key, 0), until)
+
+
+# One limiter for the whole process, shared by every client instance and thread
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = RateLimiter()
+        return _shared_limiter
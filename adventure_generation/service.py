@@ -0,0 +1,560 @@
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import queue
+import sqlite3
+import logging
+import argparse
+import itertools
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from jinja2 import Environment, FileSystemLoader
+
+from adventure_generation.pipeline import Pipeline, RunConfig, TEMPLATE_DIR
+from adventure_generation.batch_runner import BatchJob, prepare_job, finish_job
+from adventure_generation.task_scheduler import TaskScheduler, TaskCancelled
+from adventure_generation.json_repair import get_repair_stats
+from adventure_generation.telemetry import get_telemetry
+from adventure_generation.llm_logging import configure_logging
+from adventure_generation import http_transport
+
+# Long running generation service:
+#
+#   python -m adventure_generation.service --port 8790
+#   python -m adventure_generation.service --socket /tmp/adventure.sock
+#
+# The clients, connection pool, rate limiter, caches and the Jinja templates
+# are set up once when the service starts, so a job starts working the moment
+# it is picked up. Jobs wait in a SQLite queue (output/service/jobs.sqlite),
+# highest priority first, and survive a restart: a job that was running when
+# the service stopped is queued again and resumes from its journal.
+#
+#   POST   /jobs              {"context", "map", "settings", "priority", "name"}
+#   GET    /jobs              every job
+#   GET    /jobs/<id>         state and progress of a job
+#   DELETE /jobs/<id>         cancel it (a running job stops after its running steps)
+#   GET    /jobs/<id>/events  progress as JSON lines, until the job is over
+#   GET    /jobs/<id>/world   the expanded world of a finished job
+#   GET    /health
+#
+# Paths in a job are paths on the machine of the service. Every job writes to
+# its own output root (output/service/jobs/<id>-<name>). The jobs running at
+# the same time share one pool of step slots (AC_MAX_THREADS), the image
+# workers and the rate limiter; a free slot goes to the job with the highest
+# priority. Jobs always run on worker threads, AC_ASYNC is not used here.
+
+DEFAULT_ROOT = "output/service"
+DEFAULT_PORT = 8790
+
+TERMINAL_STATES = ("done", "failed", "cancelled")
+
+JOB_FIELDS = (
+    "id", "name", "priority", "state", "context", "map", "settings", "root",
+    "created", "started", "finished", "regions", "done", "error",
+)
+
+
+class JobQueue:
+    """The persistent job queue and progress log of the service."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, "
+                "priority INTEGER NOT NULL, state TEXT NOT NULL, "
+                "context TEXT NOT NULL, map TEXT NOT NULL, settings TEXT NOT NULL, "
+                "root TEXT NOT NULL, created REAL NOT NULL, started REAL, finished REAL, "
+                "regions INTEGER NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0, error TEXT)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (state, priority, id)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "job INTEGER NOT NULL, seq INTEGER NOT NULL, payload TEXT NOT NULL, "
+                "PRIMARY KEY (job, seq))"
+            )
+            self._db.commit()
+        return self._db
+
+    def add(self, name, context, map_image, settings, priority, jobs_dir):
+        with self._lock:
+            db = self._connect()
+            cursor = db.execute(
+                "INSERT INTO jobs (name, priority, state, context, map, settings, root, created) "
+                "VALUES (?, ?, 'queued', ?, ?, ?, '', ?)",
+                (name, priority, context, map_image, settings, time.time()),
+            )
+            job_id = cursor.lastrowid
+            root = os.path.join(jobs_dir, f"{job_id}-{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}")
+            db.execute("UPDATE jobs SET root = ? WHERE id = ?", (root, job_id))
+            db.commit()
+        return self.get(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else {field: row[field] for field in JOB_FIELDS}
+
+    def list(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT * FROM jobs ORDER BY id").fetchall()
+        return [{field: row[field] for field in JOB_FIELDS} for row in rows]
+
+    # Take the next job off the queue: highest priority, then oldest
+    def claim(self):
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                "SELECT id FROM jobs WHERE state = 'queued' ORDER BY priority DESC, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = 'running', started = ?, error = NULL WHERE id = ?",
+                (time.time(), row["id"]),
+            )
+            db.commit()
+        return self.get(row["id"])
+
+    def update(self, job_id, **fields):
+        if not fields:
+            return
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            db = self._connect()
+            db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            db.commit()
+
+    # Jobs that were running when the service stopped go back in the queue
+    def requeue_running(self):
+        with self._lock:
+            db = self._connect()
+            count = db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'").rowcount
+            db.commit()
+        return count
+
+    def add_event(self, job_id, payload):
+        with self._lock:
+            db = self._connect()
+            seq = db.execute(
+                "SELECT COALESCE(MAX(seq), 0) + 1 FROM events WHERE job = ?", (job_id,)
+            ).fetchone()[0]
+            payload = dict(payload, seq=seq)
+            db.execute(
+                "INSERT INTO events (job, seq, payload) VALUES (?, ?, ?)",
+                (job_id, seq, json.dumps(payload)),
+            )
+            db.commit()
+        return payload
+
+    def events(self, job_id, after=0):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT payload FROM events WHERE job = ? AND seq > ? ORDER BY seq", (job_id, after)
+            ).fetchall()
+        return [json.loads(row["payload"]) for row in rows]
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+class SharedCapacity:
+    """Step slots shared by every running job.
+
+    A step of a job holds a slot while it runs. When a slot frees up, the
+    waiting step of the job with the highest priority gets it, so an urgent
+    job is not stuck behind the steps of a big one that started earlier.
+    """
+
+    def __init__(self, slots):
+        self.slots = max(1, slots)
+        self._busy = 0
+        self._waiting = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority=0):
+        with self._condition:
+            ticket = (-priority, next(self._counter))
+            heapq.heappush(self._waiting, ticket)
+            while self._busy >= self.slots or self._waiting[0] != ticket:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._busy += 1
+            # The next waiter may fit in a slot as well
+            self._condition.notify_all()
+
+    def release(self):
+        with self._condition:
+            self._busy -= 1
+            self._condition.notify_all()
+
+    # The slots as a context manager for the steps of one job
+    def for_priority(self, priority):
+        return _Slot(self, priority)
+
+
+class _Slot:
+    def __init__(self, capacity, priority):
+        self.capacity = capacity
+        self.priority = priority
+
+    def __enter__(self):
+        self.capacity.acquire(self.priority)
+
+    def __exit__(self, *exc):
+        self.capacity.release()
+
+
+# The output queue of a job: tells the service about every region handed over
+class _ProgressQueue(queue.Queue):
+    def __init__(self, on_put):
+        super().__init__()
+        self._on_put = on_put
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self._on_put(item)
+
+
+class GenerationService:
+    def __init__(self, root=DEFAULT_ROOT, jobs=None, config=None):
+        self.config = config or RunConfig.from_env()
+        self.root = root
+        self.jobs_dir = os.path.join(root, "jobs")
+        self.queue = JobQueue(os.path.join(root, "jobs.sqlite"))
+        self.concurrent_jobs = jobs or concurrent_jobs()
+        self.capacity = SharedCapacity(self.config.max_threads)
+        self._changed = threading.Condition()
+        self._running = {}
+        self._stopping = threading.Event()
+        self._workers = []
+
+        # Everything a job needs that is worth keeping between jobs: the
+        # clients and stage cache (every job gets a pipeline made from this
+        # one), the templates and the image workers
+        self.pipeline = Pipeline(self.config)
+        # Made now rather than by the first job
+        self.pipeline.gpt4o_client
+        self.pipeline.text_llm
+        self.env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+        self.image_queue = self.pipeline.new_image_queue()
+
+    def start(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print(f"- {requeued} interrupted jobs are queued again")
+        for number in range(self.concurrent_jobs):
+            worker = threading.Thread(target=self._work, name=f"service-job-{number}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    # Stop taking jobs and stop the running ones after their running steps.
+    # They are queued again and resume when the service starts next time.
+    def stop(self):
+        self._stopping.set()
+        with self._changed:
+            for scheduler in self._running.values():
+                scheduler.cancel()
+            self._changed.notify_all()
+        for worker in self._workers:
+            worker.join()
+        if self.image_queue is not None:
+            self.image_queue.join()
+        self.queue.close()
+        get_repair_stats().log_summary()
+        get_telemetry().write_report()
+        http_transport.shutdown()
+        a1111 = sys.modules.get("adventure_generation.Automatic1111ImageGenerator")
+        if a1111 is not None:
+            a1111.shutdown()
+
+    def submit(self, context, map_image, settings, priority=0, name=None):
+        name = name or os.path.splitext(os.path.basename(map_image))[0]
+        with self._changed:
+            job = self.queue.add(name, context, map_image, settings, priority, self.jobs_dir)
+            self._publish(job["id"], "queued", priority=priority)
+            self._changed.notify_all()
+        return job
+
+    # Cancel a job. Returns the job, or None when there is no such job.
+    def cancel(self, job_id):
+        with self._changed:
+            job = self.queue.get(job_id)
+            if job is None:
+                return None
+            if job["state"] == "queued":
+                self._publish(job_id, "cancelled", columns={"state": "cancelled", "finished": time.time()})
+            elif job["state"] == "running" and job_id in self._running:
+                self._running[job_id].cancel()
+                self._publish(job_id, "cancelling")
+            self._changed.notify_all()
+        return self.queue.get(job_id)
+
+    # Record an event of a job. columns are job fields that change with it, they
+    # are written under the same lock so a reader sees both or neither.
+    def _publish(self, job_id, event, columns=None, **fields):
+        with self._changed:
+            self.queue.update(job_id, **(columns or {}))
+            self.queue.add_event(job_id, dict(fields, job=job_id, event=event, time=round(time.time(), 3)))
+            self._changed.notify_all()
+
+    # Events of a job after seq `after`. Waits up to timeout for new ones
+    # while the job is not over.
+    def wait_events(self, job_id, after=0, timeout=15.0):
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                events = self.queue.events(job_id, after)
+                job = self.queue.get(job_id)
+                remaining = deadline - time.monotonic()
+                if events or job is None or job["state"] in TERMINAL_STATES or remaining <= 0:
+                    return events, job
+                self._changed.wait(remaining)
+
+    def health(self):
+        states = {}
+        for job in self.queue.list():
+            states[job["state"]] = states.get(job["state"], 0) + 1
+        return {"ok": not self._stopping.is_set(), "jobs": states, "slots": self.capacity.slots}
+
+    def _work(self):
+        while not self._stopping.is_set():
+            with self._changed:
+                job = self.queue.claim()
+                if job is None:
+                    self._changed.wait(1.0)
+                    continue
+                scheduler = TaskScheduler(
+                    self.config.max_threads, capacity=self.capacity.for_priority(job["priority"])
+                )
+                self._running[job["id"]] = scheduler
+            try:
+                self._run(job, scheduler)
+            finally:
+                with self._changed:
+                    del self._running[job["id"]]
+
+    def _run(self, row, scheduler):
+        job_id = row["id"]
+        job = BatchJob(row["name"], row["context"], row["map"], row["settings"], row["root"])
+        regions_done = itertools.count(1)
+        job.output_queue = _ProgressQueue(lambda region: self._region_done(job_id, region, next(regions_done)))
+        self._publish(job_id, "started")
+        images = None
+        try:
+            # force: the service builds every job it is given, an interrupted
+            # one resumes from its journal
+            prepare_job(job, self.pipeline, force=True)
+            if scheduler.cancelled:
+                raise TaskCancelled(f"Job {job_id} was cancelled")
+            regions = [region['LocationName'] for region in job.world['regions']]
+            self._publish(job_id, "planned", columns={"regions": len(regions), "done": 0}, regions=regions)
+
+            images = self.image_queue.group() if self.image_queue is not None else None
+            for region in job.world['regions']:
+                job.pipeline.schedule_region_tasks(
+                    scheduler, job.context_extractor, region, job.output_queue,
+                    job.journal, job.store, images,
+                )
+            try:
+                scheduler.run()
+            finally:
+                if images is not None:
+                    images.join()
+            finish_job(job, self.env)
+        except Exception as e:
+            if scheduler.cancelled and self._stopping.is_set():
+                self._publish(job_id, "interrupted", columns={"state": "queued"})
+            elif scheduler.cancelled:
+                self._publish(job_id, "cancelled", columns={"state": "cancelled", "finished": time.time()})
+            else:
+                logging.error(f"Job {job_id} failed: {e}")
+                self._publish(
+                    job_id, "failed", columns={"state": "failed", "finished": time.time(), "error": str(e)},
+                    error=str(e),
+                )
+            return
+        self._publish(
+            job_id, "done", columns={"state": "done", "finished": time.time()},
+            world=os.path.abspath(job.pipeline.expanded_world_path()),
+            pages=os.path.abspath(os.path.join(job.root, "story_html")),
+        )
+
+    def _region_done(self, job_id, region, done):
+        self._publish(job_id, "region", columns={"done": done}, name=region['LocationName'], done=done)
+
+
+def concurrent_jobs():
+    if os.getenv("AC_SERVICE_JOBS") and os.getenv("AC_SERVICE_JOBS").isdigit():
+        return max(1, int(os.getenv("AC_SERVICE_JOBS")))
+    return 2
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("service: " + format % args)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        path, _, query = self.path.partition("?")
+        match = re.fullmatch(r"/jobs/(\d+)(/events|/world)?", path.rstrip("/"))
+        params = dict(part.split("=", 1) for part in query.split("&") if "=" in part)
+        if match:
+            return path, int(match.group(1)), match.group(2), params
+        return path.rstrip("/") or "/", None, None, params
+
+    def do_GET(self):
+        service = self.server.service
+        path, job_id, view, params = self._route()
+        if path == "/health":
+            self._send_json(200, service.health())
+            return
+        if path == "/jobs":
+            self._send_json(200, {"jobs": service.queue.list()})
+            return
+        if job_id is None:
+            self._send_json(404, {"error": f"no such path {self.path}"})
+            return
+        job = service.queue.get(job_id)
+        if job is None:
+            self._send_json(404, {"error": f"no job {job_id}"})
+        elif view == "/events":
+            after = params.get("after", "0")
+            self._stream_events(service, job_id, int(after) if after.isdigit() else 0)
+        elif view == "/world":
+            world_path = os.path.join(job["root"], "json_outputs", "expanded_world.json")
+            if job["state"] != "done" or not os.path.exists(world_path):
+                self._send_json(409, {"error": f"job {job_id} is {job['state']}"})
+                return
+            with open(world_path, "r") as file:
+                self._send_json(200, json.load(file))
+        else:
+            self._send_json(200, job)
+
+    def do_POST(self):
+        service = self.server.service
+        if self._route()[0] != "/jobs":
+            self._send_json(404, {"error": f"no such path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            files = {key: os.path.abspath(request[key]) for key in ("context", "map", "settings")}
+            priority = int(request.get("priority", 0))
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"expected JSON with context, map and settings: {e}"})
+            return
+        missing = [path for path in files.values() if not os.path.isfile(path)]
+        if missing:
+            self._send_json(400, {"error": f"no such file: {', '.join(missing)}"})
+            return
+        job = service.submit(files["context"], files["map"], files["settings"], priority, request.get("name"))
+        self._send_json(201, job)
+
+    def do_DELETE(self):
+        _, job_id, view, _ = self._route()
+        job = None if job_id is None or view else self.server.service.cancel(job_id)
+        if job is None:
+            self._send_json(404, {"error": f"no such job {self.path}"})
+        else:
+            self._send_json(200, job)
+
+    # One JSON line per event, from seq `after` on, until the job is over
+    def _stream_events(self, service, job_id, after):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                events, job = service.wait_events(job_id, after)
+                for event in events:
+                    self.wfile.write(json.dumps(event).encode() + b"\n")
+                    after = event["seq"]
+                self.wfile.flush()
+                if not events and (job is None or job["state"] in TERMINAL_STATES):
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped following
+            pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# The HTTP server of a service, on host:port or on a Unix socket
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = _UnixHTTPServer(socket_path, _Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve world generation jobs over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--socket", help="listen on this Unix socket instead of host:port")
+    parser.add_argument("--root", default=DEFAULT_ROOT, help="job queue and job outputs")
+    parser.add_argument("--jobs", type=int, help="jobs running at the same time (AC_SERVICE_JOBS)")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    config = RunConfig.from_env()
+    print(config.banner())
+    service = GenerationService(args.root, args.jobs, config).start()
+    server = make_server(service, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{server.server_address[1]}"
+    print(f"Generation service on {where}, {service.concurrent_jobs} jobs at a time, {service.capacity.slots} step slots")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+        print("Stopping, running jobs resume on the next start...")
+        service.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+
+# Bump when a bootstrap prompt changes, so old artifacts are not reused
+STAGE_VERSION = 1
+
+
+def hash_text(text):
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def hash_file(path, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCache:
+    """Outputs of the bootstrap stages (map analysis, input summaries), kept
+    on disk under a hash of everything they were made from.
+
+    A stage is only run again when one of its own inputs changes: a new map
+    image redoes the map analysis but keeps the summaries, a new writing style
+    only redoes that one summary. Artifacts are written to a temp file first
+    and then moved into place, so an interrupted run never leaves a broken one.
+    """
+
+    def __init__(self, directory="output/json_outputs/stages", enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # AC_STAGE_CACHE=off always runs every stage
+    @classmethod
+    def from_env(cls):
+        return cls(enabled=os.getenv("AC_STAGE_CACHE") != "off")
+
+    def make_key(self, stage, inputs):
+        key_fields = dict(inputs, stage=stage, version=STAGE_VERSION)
+        return hashlib.sha256(
+            json.dumps(key_fields, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()[:32]
+
+    def _path(self, stage, key):
+        return os.path.join(self.directory, f"{stage}-{key}.json")
+
+    # Return the stored artifact of stage for these inputs, or build and store it
+    def get_or_build(self, stage, inputs, build):
+        path = self._path(stage, self.make_key(stage, inputs))
+        if self.enabled and os.path.exists(path):
+            try:
+                with open(path, "r") as file:
+                    artifact = json.load(file)["artifact"]
+                with self._lock:
+                    self.hits += 1
+                logging.info(f"Stage cache hit: {stage}")
+                return artifact
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable stage artifact {path}: {e}")
+
+        artifact = build()
+        with self._lock:
+            self.misses += 1
+        if self.enabled:
+            self._atomic_write(path, json.dumps({"stage": stage, "inputs": inputs, "artifact": artifact}))
+        return artifact
+
+    def _atomic_write(self, path, data):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
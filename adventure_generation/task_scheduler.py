@@ -0,0 +1,155 @@
+import heapq
+import itertools
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Task:
+    def __init__(self, name, func, deps=(), cost=1.0):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.cost = cost
+        # Runs in the context it was added from, so it keeps that job's
+        # output root and telemetry labels
+        self.context = contextvars.copy_context()
+        self.dependents = []
+        self.waiting_on = len(self.deps)
+        # Longest chain of work (including this task) that still has to run
+        # after this task starts. Filled in by TaskScheduler.run.
+        self.critical_path = None
+
+
+class TaskScheduler:
+    """Runs a graph of generation steps on one shared worker pool.
+
+    Tasks from every region go into the same graph. A task becomes ready once
+    all of its dependencies are done, and ready tasks are started in
+    critical-path-first order: the task with the most work still chained
+    behind it goes first. That way a big town is not left to run on its own
+    at the end while the other workers sit idle.
+    """
+
+    # capacity is an optional semaphore shared with other schedulers: a task
+    # only runs while it holds a slot, so several graphs running side by side
+    # never have more than that many steps in flight together.
+    def __init__(self, max_workers=2, capacity=None):
+        self.max_workers = max_workers
+        self.capacity = capacity
+        self.tasks = {}
+        self.errors = {}
+        self._cancelled = threading.Event()
+
+    def add(self, name, func, deps=(), cost=1.0):
+        if name in self.tasks:
+            raise ValueError(f"Task '{name}' was added twice")
+        task = Task(name, func, deps, cost)
+        for dep in task.deps:
+            dep.dependents.append(task)
+        self.tasks[name] = task
+        return task
+
+    # A view that adds tasks under "prefix:name", so graphs of several jobs
+    # with the same region names can share one scheduler
+    def scoped(self, prefix):
+        return ScopedScheduler(self, prefix)
+
+    def _compute_critical_paths(self):
+        # Walk the graph from the sinks backwards (reverse topological order)
+        order = []
+        waiting = {task: len(task.dependents) for task in self.tasks.values()}
+        stack = [task for task, count in waiting.items() if count == 0]
+        while stack:
+            task = stack.pop()
+            order.append(task)
+            for dep in task.deps:
+                waiting[dep] -= 1
+                if waiting[dep] == 0:
+                    stack.append(dep)
+        if len(order) != len(self.tasks):
+            raise ValueError("Task graph has a cycle")
+        for task in order:
+            task.critical_path = task.cost + max(
+                (dependent.critical_path for dependent in task.dependents), default=0
+            )
+
+    # Start no more tasks. The running ones finish, the rest fail with
+    # TaskCancelled.
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def _call(self, task):
+        if self.capacity is None:
+            return task.context.run(task.func)
+        with self.capacity:
+            return task.context.run(task.func)
+
+    # Run everything. A failed task is logged and everything that depends on it
+    # is skipped, the rest of the graph keeps going. The first error is raised
+    # once nothing else can run.
+    def run(self):
+        self._compute_critical_paths()
+        counter = itertools.count()
+        ready = []
+        for task in self.tasks.values():
+            if task.waiting_on == 0:
+                heapq.heappush(ready, (-task.critical_path, next(counter), task))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+            while ready or running:
+                while ready and len(running) < self.max_workers:
+                    _, _, task = heapq.heappop(ready)
+                    if self._cancelled.is_set():
+                        self._skip_dependents(task, TaskCancelled(f"Task {task.name} was cancelled"))
+                        continue
+                    running[pool.submit(self._call, task)] = task
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logging.error(f"Task {task.name} failed: {error}")
+                        print(f" - {task.name} failed: {error}")
+                        self._skip_dependents(task, error)
+                        continue
+                    for dependent in task.dependents:
+                        dependent.waiting_on -= 1
+                        if dependent.waiting_on == 0 and dependent.name not in self.errors:
+                            heapq.heappush(
+                                ready, (-dependent.critical_path, next(counter), dependent)
+                            )
+
+        if self.errors:
+            raise next(iter(self.errors.values()))
+
+    def _skip_dependents(self, task, error):
+        stack = [task]
+        while stack:
+            current = stack.pop()
+            if current.name in self.errors:
+                continue
+            self.errors[current.name] = error
+            stack.extend(current.dependents)
+
+
+class ScopedScheduler:
+    def __init__(self, scheduler, prefix):
+        self.scheduler = scheduler
+        self.prefix = prefix
+
+    def add(self, name, func, deps=(), cost=1.0):
+        return self.scheduler.add(f"{self.prefix}:{name}", func, deps, cost)
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Per-call numbers for every LLM and image request, added up per region, step
+# and model. They answer "where did the time (and the money) go": waiting for
+# rate limit quota, sleeping after a 429, or the model itself.
+#
+# For every call:
+#   latency - wall time of the whole call, retries included
+#   queue   - time spent waiting for rate limit quota before the first attempt
+#   sleep   - time spent waiting again after being rate limited
+#   prompt_tokens / completion_tokens - as reported by the backend
+#   retries - rate limited attempts and streams dropped for going off schema
+#   json_repairs - broken JSON answers that needed fixing
+#
+# write_report() saves a JSON report and a Prometheus text file.
+
+# USD per million tokens (input, output), or per image
+PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo-16k": (3.00, 4.00),
+}
+IMAGE_PRICES = {
+    "dall-e-3": 0.04,
+}
+
+FIELDS = (
+    "calls", "errors", "latency_seconds", "queue_seconds", "sleep_seconds",
+    "prompt_tokens", "completion_tokens", "images", "retries", "json_repairs", "cost_usd",
+)
+
+# Which region and step the current thread / task is working on
+_labels = contextvars.ContextVar("telemetry_labels", default=None)
+
+
+def current_labels():
+    return _labels.get() or {"region": "-", "step": "-"}
+
+
+# Label every call made inside this block
+@contextmanager
+def labels(region=None, step=None):
+    token = _labels.set({"region": region or "-", "step": step or "-"})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+class CallRecord:
+    def __init__(self, backend, model):
+        self.backend = backend
+        self.model = model
+        self.started = time.monotonic()
+        self.queue_seconds = 0.0
+        self.sleep_seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.images = 0
+        self.retries = 0
+
+    # Time a rate limiter made us wait. Before the first attempt that is
+    # queueing for quota, after a 429 it is backing off.
+    def waited(self, seconds):
+        if self.retries:
+            self.sleep_seconds += seconds
+        else:
+            self.queue_seconds += seconds
+
+    def retry(self):
+        self.retries += 1
+
+    def usage(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens += prompt_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+
+class Telemetry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+
+    def _add(self, model, values):
+        key = (current_labels()["region"], current_labels()["step"], model)
+        with self._lock:
+            totals = self._totals.setdefault(key, dict.fromkeys(FIELDS, 0))
+            for name, value in values.items():
+                totals[name] += value
+
+    # Wrap one request, including its retries:
+    #   with telemetry.call("openai", model) as call: ...
+    @contextmanager
+    def call(self, backend, model):
+        call = CallRecord(backend, model)
+        failed = False
+        try:
+            yield call
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self._add(f"{backend}/{model}", {
+                "calls": 1,
+                "errors": int(failed),
+                "latency_seconds": time.monotonic() - call.started,
+                "queue_seconds": call.queue_seconds,
+                "sleep_seconds": call.sleep_seconds,
+                "prompt_tokens": call.prompt_tokens,
+                "completion_tokens": call.completion_tokens,
+                "images": call.images,
+                "retries": call.retries,
+                "cost_usd": self._cost(model, call),
+            })
+
+    # Events outside a single request (a dropped stream, a JSON repair)
+    def count(self, backend, model, **values):
+        self._add(f"{backend}/{model}", values)
+
+    def _cost(self, model, call):
+        input_price, output_price = PRICES.get(model, (0.0, 0.0))
+        return (
+            call.prompt_tokens * input_price + call.completion_tokens * output_price
+        ) / 1_000_000 + call.images * IMAGE_PRICES.get(model, 0.0)
+
+    def snapshot(self):
+        with self._lock:
+            return [
+                dict(region=region, step=step, model=model, **totals)
+                for (region, step, model), totals in sorted(self._totals.items())
+            ]
+
+    def summary(self):
+        total = dict.fromkeys(FIELDS, 0)
+        for row in self.snapshot():
+            for name in FIELDS:
+                total[name] += row[name]
+        return total
+
+    def write_report(self, json_path="output/telemetry.json", prometheus_path="output/telemetry.prom"):
+        rows = self.snapshot()
+        report = {"generated": time.time(), "total": self.summary(), "calls": rows}
+        _atomic_write(json_path, json.dumps(report, indent=4))
+        _atomic_write(prometheus_path, self.prometheus(rows))
+        total = report["total"]
+        logging.info(
+            f"Telemetry: {total['calls']} calls, {total['latency_seconds']:.1f}s in calls, "
+            f"{total['queue_seconds']:.1f}s queued, {total['sleep_seconds']:.1f}s backing off, "
+            f"{total['retries']} retries, {total['json_repairs']} JSON repairs, ${total['cost_usd']:.4f}"
+        )
+        print(f"- {total['calls']} model calls, about ${total['cost_usd']:.2f}, see {json_path}")
+
+    # Prometheus text exposition format, one counter per field
+    def prometheus(self, rows=None):
+        rows = self.snapshot() if rows is None else rows
+        lines = []
+        for name in FIELDS:
+            metric = f"adventure_llm_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for row in rows:
+                labels = ",".join(
+                    f'{label}="{_escape(row[label])}"' for label in ("region", "step", "model")
+                )
+                lines.append(f"{metric}{{{labels}}} {row[name]}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _atomic_write(path, data):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+# One collector for the whole process
+_shared_telemetry = None
+_shared_telemetry_lock = threading.Lock()
+
+
+def get_telemetry():
+    global _shared_telemetry
+    with _shared_telemetry_lock:
+        if _shared_telemetry is None:
+            _shared_telemetry = Telemetry()
+        return _shared_telemetry
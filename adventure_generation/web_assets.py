@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Image widths made for every picture in the book. The smallest one is the
+# thumbnail, the browser picks the best of the others through srcset.
+WIDTHS = (160, 480, 768, 1024)
+
+# Bump when the derivatives change, so every image is processed again
+ASSET_VERSION = 1
+
+MANIFEST_NAME = 'assets.json'
+
+
+# The page and image workers are spawned, not forked: the pipeline and the
+# service build pages while other threads (image jobs, the log writer, the
+# HTTP pool) may hold locks, and a forked child would inherit them held.
+def process_pool(workers, **options):
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), **options)
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _save(image, path, image_format, **options):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            image.save(file, format=image_format, **options)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Runs in a worker process: decode the source once and write every size of it.
+# Names carry the source fingerprint, so they never change for the same image
+# and can be cached by browsers forever.
+def make_derivatives(source_path, output_dir, fingerprint, widths, webp):
+    from PIL import Image
+
+    record = {'webp': [], 'jpeg': []}
+    with Image.open(source_path) as image:
+        image = image.convert('RGB')
+        record['width'], record['height'] = image.size
+        sizes = [width for width in widths if width < image.width] + [min(image.width, max(widths))]
+        for width in sizes:
+            height = max(1, round(image.height * width / image.width))
+            resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+            name = f"{fingerprint}-{width}w"
+            _save(resized, os.path.join(output_dir, f"{name}.jpg"), 'JPEG', quality=82, optimize=True, progressive=True)
+            record['jpeg'].append([width, f"{name}.jpg"])
+            if webp:
+                _save(resized, os.path.join(output_dir, f"{name}.webp"), 'WEBP', quality=80, method=4)
+                record['webp'].append([width, f"{name}.webp"])
+    return record
+
+
+# make_derivatives for one image of the pool. An unreadable or truncated image
+# is reported back instead of failing every other page of the build.
+def _derivatives_or_error(*job):
+    try:
+        return make_derivatives(*job), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+class WebAssets:
+    """Web sized copies of the illustrations used by the book.
+
+    Every source image gets JPEG (and WebP, when Pillow supports it) copies in
+    a few widths, named after a hash of the source. assets.json remembers what
+    was made, so an image is only processed the first time it is seen.
+    """
+
+    def __init__(self, output_dir, workers=None):
+        self.output_dir = output_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('version') == ASSET_VERSION and manifest.get('widths') == list(WIDTHS):
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {'version': ASSET_VERSION, 'widths': list(WIDTHS), 'sources': {}, 'images': {}}
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    # The fingerprint of a source file. It is only hashed again when its size
+    # or modification time changed.
+    def _fingerprint(self, path):
+        stat = os.stat(path)
+        known = self.manifest['sources'].get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['fingerprint']
+        fingerprint = _file_hash(path)[:16]
+        self.manifest['sources'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'fingerprint': fingerprint}
+        return fingerprint
+
+    # {source path: record} for every path, making the derivatives of images
+    # not seen before in a process pool. Missing files and images that could
+    # not be read are left out, their pages link the original file.
+    def process(self, paths):
+        from PIL import features
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        fingerprints = {}
+        for path in set(paths):
+            if path and os.path.isfile(path):
+                fingerprints[path] = self._fingerprint(path)
+
+        new = {}
+        for path, fingerprint in fingerprints.items():
+            if fingerprint not in self.manifest['images'] and fingerprint not in new.values():
+                new[path] = fingerprint
+
+        if new:
+            webp = features.check('webp')
+            jobs = [(path, self.output_dir, fingerprint, WIDTHS, webp) for path, fingerprint in new.items()]
+            if len(jobs) > 1 and self.workers > 1:
+                with process_pool(min(self.workers, len(jobs))) as pool:
+                    results = list(pool.map(_derivatives_or_error, *zip(*jobs)))
+            else:
+                results = [_derivatives_or_error(*job) for job in jobs]
+            prepared = 0
+            for (path, fingerprint), (record, error) in zip(new.items(), results):
+                if error is not None:
+                    logging.warning(f"Could not prepare {path} for the web: {error}")
+                    print(f" - {path} could not be read, its page links the original")
+                    continue
+                self.manifest['images'][fingerprint] = record
+                prepared += 1
+            print(f"{prepared} new images prepared for the web")
+
+        self._write_manifest()
+        return {
+            path: self.manifest['images'][fingerprint]
+            for path, fingerprint in fingerprints.items()
+            if fingerprint in self.manifest['images']
+        }
+
+    def _write_manifest(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(self.manifest, file)
+        os.replace(tmp_path, self.manifest_path)
+
+
+# The illustrations a region page shows
+def region_images(region):
+    paths = []
+    for loc in (region.get('locations') or {}).values():
+        if isinstance(loc, dict) and loc.get('illustration'):
+            paths.append(loc['illustration'])
+    for char in (region.get('characters') or {}).values():
+        if isinstance(char, dict) and char.get('portrait'):
+            paths.append(char['portrait'])
+    return paths
@@ -1,12 +1,15 @@
 import os
 import json
-import requests
+import asyncio
 import random  # for dice rolls
 
+from adventure_generation.prompt_optimizer import PromptOptimizer
+from adventure_generation.telemetry import labels
+
 
 class WorldBuilder:
 
-    def __init__(self, context_extractor_object, region, llm_client):
+    def __init__(self, context_extractor_object, region, llm_client, journal=None, batch=False, seed=None):
         self.context_extractor = context_extractor_object
         if isinstance(region, dict):
             self.region = region
@@ -16,6 +19,99 @@ class WorldBuilder:
         self.optimized_context = context_extractor_object.optimized_context
         self.optimized_writing_style = context_extractor_object.optimized_writing_style
         self.optimized_visual_style = context_extractor_object.optimized_visual_style
+        self.journal = journal
+        # Ask for all locations / characters / encounters of a region in as few calls as possible
+        self.batch = batch
+        # Seed of the world's dice, see dice_seed
+        self.seed = seed
+
+        # Step outputs by index, until the collect_* steps put them in the region
+        self._new_locations = {}
+        self._new_characters = {}
+        self._new_quests = {}
+        self._new_encounters = {}
+
+        # Portrait / location map jobs, see enable_images
+        self.image_queue = None
+        self.image_backend = None
+        self.image_llm = None
+        self.a1111_factory = None
+        self.prompt_optimizer = None
+        self.image_jobs = []
+        self._a1111 = None
+
+    # Run one step of the chain, unless the checkpoint journal already has its
+    # output from an earlier (interrupted) run
+    def _checkpoint(self, step, index, generate, *args, **kwargs):
+        if self.journal is not None and self.journal.has(self.region["LocationName"], step, index):
+            return self.journal.get(self.region["LocationName"], step, index)
+        with labels(self.region["LocationName"], step):
+            output = generate(*args, **kwargs)
+        if self.journal is not None:
+            self.journal.record(self.region["LocationName"], step, index, output)
+        return output
+
+    # Async twin of _checkpoint
+    async def _acheckpoint(self, step, index, generate, *args, **kwargs):
+        if self.journal is not None and self.journal.has(self.region["LocationName"], step, index):
+            return self.journal.get(self.region["LocationName"], step, index)
+        with labels(self.region["LocationName"], step):
+            output = await generate(*args, **kwargs)
+        if self.journal is not None:
+            self.journal.record(self.region["LocationName"], step, index, output)
+        return output
+
+    # Batched version of _checkpoint: items already in the journal are reused
+    # and only the missing indices are asked for, in one batched call.
+    # seeded=True hands generate_batch the dice seeds of the missing items.
+    # Returns {index: output}.
+    def _checkpoint_batch(self, step, count, generate_batch, *args, seeded=False):
+        outputs, missing = self._journaled_items(step, range(count))
+        if missing:
+            kwargs = self._batch_seeds(step, missing) if seeded else {}
+            with labels(self.region["LocationName"], step):
+                batch = generate_batch(self.region, len(missing), *args, **kwargs)
+            for i, output in zip(missing, batch):
+                outputs[i] = self._record(step, i, output)
+        return outputs
+
+    # Async twin of _checkpoint_batch
+    async def _acheckpoint_batch(self, step, count, generate_batch, *args, seeded=False):
+        outputs, missing = self._journaled_items(step, range(count))
+        if missing:
+            kwargs = self._batch_seeds(step, missing) if seeded else {}
+            with labels(self.region["LocationName"], step):
+                batch = await generate_batch(self.region, len(missing), *args, **kwargs)
+            for i, output in zip(missing, batch):
+                outputs[i] = self._record(step, i, output)
+        return outputs
+
+    def _journaled_items(self, step, indices):
+        outputs = {}
+        missing = []
+        for i in indices:
+            if self.journal is not None and self.journal.has(self.region["LocationName"], step, i):
+                outputs[i] = self.journal.get(self.region["LocationName"], step, i)
+            else:
+                missing.append(i)
+        return outputs, missing
+
+    # The dice of one item of a step, from the world's seed, the region and the
+    # item's index. The same world rolls the same characters (and sends the
+    # same prompts) in any order, on any thread, and on a resumed run.
+    # None when there is no seed, for unseeded dice.
+    def dice_seed(self, step, index):
+        if self.seed is None:
+            return None
+        return f"{self.seed}/{self.region['LocationName']}/{step}/{index}"
+
+    def _batch_seeds(self, step, indices):
+        return {"dice_seeds": [self.dice_seed(step, i) for i in indices]}
+
+    def _record(self, step, index, output):
+        if self.journal is not None:
+            self.journal.record(self.region["LocationName"], step, index, output)
+        return output
 
     def _optimize_user_input(self, input_copy):
         optimized_copy = self.llm_client._summarize_context(input_copy)
@@ -29,131 +125,404 @@ class WorldBuilder:
     # 5. Create a minor side quest that connect characters and locations.
 
     def region_development_chain(self):
+        self.create_region_description()
+        self.create_regional_demographics()
 
-        # Step 1 - Run Create Region Description
+        print(
+            f"{self.region['LocationName']} needs {self.region['num_locations']} locations"
+        )
+        if self.batch:
+            self.create_locations()
+        else:
+            for i in range(self.region["num_locations"]):
+                self.create_location(i)
+        self.collect_locations()
+
+        print(
+            f"{self.region['LocationName']} needs {self.region['num_characters']} characters"
+        )
+        if self.batch:
+            self.create_characters()
+        else:
+            for i in range(self.region["num_characters"]):
+                self.create_character(i)
+        self.collect_characters()
+
+        print(f"{self.region['LocationName']} - Quest or plot prompts")
+        for i in range(1, 7):
+            self.create_quest(i)
+
+        print(f"{self.region['LocationName']} - Generating a random encounter table")
+        if self.batch:
+            self.create_encounters()
+        else:
+            for i in range(self.region["encounters"]):
+                self.create_encounter(i)
+        self.collect_events()
+
+        return self.region
+
+    # The same chain as a task graph for the TaskScheduler, so steps of every
+    # region can share one worker pool:
+    #   description -> demographics -> characters
+    #   (characters, locations) -> quests / encounters
+    # Returns the last task, which completes once the region text is done.
+    def schedule_development_chain(self, scheduler):
+        name = self.region["LocationName"]
+
+        description = scheduler.add(f"{name}/description", self.create_region_description)
+        demographics = scheduler.add(
+            f"{name}/demographics", self.create_regional_demographics, deps=[description]
+        )
+
+        if self.batch:
+            locations = [scheduler.add(
+                f"{name}/location/batch", self.create_locations, cost=self._batch_cost("num_locations")
+            )]
+        else:
+            locations = [
+                scheduler.add(f"{name}/location/{i}", lambda i=i: self.create_location(i))
+                for i in range(self.region["num_locations"])
+            ]
+        locations_done = scheduler.add(
+            f"{name}/locations", self.collect_locations, deps=locations, cost=0
+        )
+
+        if self.batch:
+            characters = [scheduler.add(
+                f"{name}/character/batch", self.create_characters,
+                deps=[demographics], cost=self._batch_cost("num_characters"),
+            )]
+        else:
+            characters = [
+                scheduler.add(
+                    f"{name}/character/{i}", lambda i=i: self.create_character(i), deps=[demographics]
+                )
+                for i in range(self.region["num_characters"])
+            ]
+        characters_done = scheduler.add(
+            f"{name}/characters", self.collect_characters, deps=characters, cost=0
+        )
+
+        events = [
+            scheduler.add(
+                f"{name}/quest/{i}", lambda i=i: self.create_quest(i),
+                deps=[locations_done, characters_done],
+            )
+            for i in range(1, 7)
+        ]
+        if self.batch:
+            events.append(scheduler.add(
+                f"{name}/encounter/batch", self.create_encounters,
+                deps=[locations_done, characters_done], cost=self._batch_cost("encounters"),
+            ))
+        else:
+            events += [
+                scheduler.add(
+                    f"{name}/encounter/{i}", lambda i=i: self.create_encounter(i),
+                    deps=[locations_done, characters_done],
+                )
+                for i in range(self.region["encounters"])
+            ]
+        return scheduler.add(f"{name}/events", self.collect_events, deps=events, cost=0)
+
+    # A batched call is one round trip, but a longer one than a single item
+    def _batch_cost(self, count_key):
+        return 1 + self.region[count_key] / 10
+
+    # Step 1 - Run Create Region Description
+    def create_region_description(self):
         print(f"{self.region['LocationName']} - Creating a regional description")
-        regional_description = self.llm_client.generate_detailed_region_description(
+        regional_description = self._checkpoint(
+            "description", 0, self.llm_client.generate_detailed_region_description,
             self.region, self.optimized_context, self.optimized_writing_style
         )
         self.region.update(regional_description)
-        
-        # Step 1.5 - Create regional demographics
+
+    # Step 1.5 - Create regional demographics
+    def create_regional_demographics(self):
         print(f"{self.region['LocationName']} - Creating a regional demographics")
-        regional_demographics = self.llm_client.generate_regional_demographics(
+        regional_demographics = self._checkpoint(
+            "demographics", 0, self.llm_client.generate_regional_demographics,
             self.region, self.optimized_context, self.optimized_writing_style
         )
         self.region.update(regional_demographics)
 
-        # Step 2 - Create the locations
-        created_locations = {}
-        print(
-            f"{self.region['LocationName']} needs {self.region['num_locations']} locations"
+    # Step 2 - Create the locations
+    def create_location(self, i):
+        loc = self._checkpoint(
+            "location", i, self.llm_client.generate_location,
+            self.region, self.optimized_context, self.optimized_writing_style
         )
-        for i in range(self.region["num_locations"]):
-            loc = self.llm_client.generate_location(
-                self.region, self.optimized_context, self.optimized_writing_style
-            )
 
-            if "name" not in loc.keys():
-                loc["name"] = f"Location #{i+1}"
+        self._add_location(i, loc)
 
-            location_name = loc["name"] if "name" in loc else None
-            created_locations[location_name] = loc
-        self.region["locations"] = created_locations
+    def create_locations(self):
+        locations = self._checkpoint_batch(
+            "location", self.region["num_locations"], self.llm_client.generate_locations,
+            self.optimized_context, self.optimized_writing_style
+        )
+        for i, loc in locations.items():
+            self._add_location(i, loc)
 
-        # Step 3 - Create the characters
-        created_characters = {}
-        print(
-            f"{self.region['LocationName']} needs {self.region['num_characters']} characters"
+    def _add_location(self, i, loc):
+        if "name" not in loc.keys():
+            loc["name"] = f"Location #{i+1}"
+        self._new_locations[i] = loc
+
+    # Every location of the region exists now, their maps go on the image queue
+    def collect_locations(self):
+        self.region["locations"] = {
+            loc["name"]: loc for i, loc in sorted(self._new_locations.items())
+        }
+        self._queue_location_maps(dict(self._new_locations))
+
+    # Step 3 - Create the characters
+    def create_character(self, i):
+        char = self._checkpoint(
+            "character", i, self.llm_client.generate_character,
+            self.region, self.optimized_context, self.optimized_writing_style,
+            dice_seed=self.dice_seed("character", i),
         )
-        for i in range(self.region["num_characters"]):
-            char = self.llm_client.generate_character(
-                self.region, self.optimized_context, self.optimized_writing_style
-            )
-            if "name" not in char.keys():
-                char["name"] = f"Character #{i+1}"
-                # char=self.llm_client._fix_json_response(char)
+        self._add_character(i, char)
 
-            character_name = char["name"]
-            created_characters[character_name] = char
-        self.region["characters"] = created_characters
+    def create_characters(self):
+        characters = self._checkpoint_batch(
+            "character", self.region["num_characters"], self.llm_client.generate_characters,
+            self.optimized_context, self.optimized_writing_style, seeded=True,
+        )
+        for i, char in characters.items():
+            self._add_character(i, char)
 
-        # Step 4 - Create a custom encounter table based on a d10
-        print(f"{self.region['LocationName']} - Quest or plot prompts")
-        created_quests = {}
-        for i in range(1, 7):
-            quest = self.llm_client.generate_regional_drama(
-                self.region, self.optimized_writing_style
-            )
-            created_quests[i] = quest
-        self.region["quests"] = created_quests
+    def _add_character(self, i, char):
+        if "name" not in char.keys():
+            char["name"] = f"Character #{i+1}"
+        self._new_characters[i] = char
 
-        # Step 5  - Create a random encounter table
-        print(f"{self.region['LocationName']} - Generating a random encounter table")
-        created_encounters = {}
-        for i in range(self.region["encounters"]):
-            encounter = self.llm_client.generate_random_encounter(
-                self.region, self.optimized_context
+    # Every character of the region exists now, their portraits go on the image queue
+    def collect_characters(self):
+        self.region["characters"] = {
+            char["name"]: char for i, char in sorted(self._new_characters.items())
+        }
+        self._queue_portraits(dict(self._new_characters))
+
+    # Step 4 - Create quest or plot prompts
+    def create_quest(self, i):
+        self._new_quests[i] = self._checkpoint(
+            "quest", i, self.llm_client.generate_regional_drama,
+            self.region, self.optimized_writing_style
+        )
+
+    # Step 5  - Create a random encounter table based on a d10
+    def create_encounter(self, i):
+        self._new_encounters[i] = self._checkpoint(
+            "encounter", i, self.llm_client.generate_random_encounter,
+            self.region, self.optimized_context
+        )
+
+    def create_encounters(self):
+        self._new_encounters.update(self._checkpoint_batch(
+            "encounter", self.region["encounters"], self.llm_client.generate_encounter_table,
+            self.optimized_context
+        ))
+
+    def collect_events(self):
+        self.region["quests"] = dict(sorted(self._new_quests.items()))
+        self.region["random_encounter_table"] = dict(sorted(self._new_encounters.items()))
+
+    # Async version of region_development_chain. Items inside a step do not
+    # depend on each other, so they are sent together and the semaphore caps how
+    # many requests are in flight. Wall time follows the depth of the chain:
+    # 1. description -> 2. demographics -> 3. locations + characters -> 4. quests + encounters
+    async def aregion_development_chain(self, semaphore=None, max_in_flight=4):
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def limited(step, index, generate, *args, **kwargs):
+            async with semaphore:
+                return await self._acheckpoint(step, index, generate, *args, **kwargs)
+
+        # One batched call for every missing item of a step, returned as a list
+        async def limited_batch(step, count, generate_batch, *args, seeded=False):
+            async with semaphore:
+                outputs = await self._acheckpoint_batch(step, count, generate_batch, *args, seeded=seeded)
+            return [outputs[i] for i in range(count)]
+
+        # Step 1 - Run Create Region Description
+        print(f"{self.region['LocationName']} - Creating a regional description")
+        regional_description = await limited(
+            "description", 0, self.llm_client.agenerate_detailed_region_description,
+            self.region, self.optimized_context, self.optimized_writing_style,
+        )
+        self.region.update(regional_description)
+
+        # Step 1.5 - Create regional demographics
+        print(f"{self.region['LocationName']} - Creating a regional demographics")
+        regional_demographics = await limited(
+            "demographics", 0, self.llm_client.agenerate_regional_demographics,
+            self.region, self.optimized_context, self.optimized_writing_style,
+        )
+        self.region.update(regional_demographics)
+
+        # Step 2 & 3 - Create the locations and characters together
+        print(
+            f"{self.region['LocationName']} needs {self.region['num_locations']} locations"
+            f" and {self.region['num_characters']} characters"
+        )
+        if self.batch:
+            locations, characters = await asyncio.gather(
+                limited_batch(
+                    "location", self.region["num_locations"], self.llm_client.agenerate_locations,
+                    self.optimized_context, self.optimized_writing_style,
+                ),
+                limited_batch(
+                    "character", self.region["num_characters"], self.llm_client.agenerate_characters,
+                    self.optimized_context, self.optimized_writing_style, seeded=True,
+                ),
             )
-            created_encounters[i] = encounter
-        self.region["random_encounter_table"] = created_encounters
+            for i, loc in enumerate(locations):
+                self._add_location(i, loc)
+            for i, char in enumerate(characters):
+                self._add_character(i, char)
+        else:
+            async def location(i):
+                self._add_location(i, await limited(
+                    "location", i, self.llm_client.agenerate_location,
+                    self.region, self.optimized_context, self.optimized_writing_style,
+                ))
 
-        return self.region
+            async def character(i):
+                self._add_character(i, await limited(
+                    "character", i, self.llm_client.agenerate_character,
+                    self.region, self.optimized_context, self.optimized_writing_style,
+                    dice_seed=self.dice_seed("character", i),
+                ))
 
-    # these have to be done separately because I will need DALL-E for now.
-    def region_illustration_chain(self, llm):
-        # Step 6 - Create character portraits
-        print(f"{self.region['LocationName']} - Generating character portraits")
-        for character in self.region["characters"]:
-            portrait_file = llm.generate_character_portrait(
-                character_description=self.region["characters"][character]["description"],
-                world_info=self.optimized_context,
-                illustration_style=self.context_extractor.get_visual_style(),
+            await asyncio.gather(
+                *(location(i) for i in range(self.region["num_locations"])),
+                *(character(i) for i in range(self.region["num_characters"])),
             )
-            self.region["characters"][character]["portrait"] = portrait_file
-
-        # Step 7 - Create location maps
-        print(f"{self.region['LocationName']} - Generating location maps")
-        for loc in self.region["locations"]:
-            location_map = llm.generate_location_maps(
-                location_description=self.region["locations"][loc]["description"],
-                world_info=self.optimized_context,
-                illustration_style=self.context_extractor.get_visual_style(),
+        self.collect_locations()
+        self.collect_characters()
+
+        # Step 4 & 5 - Quests and the random encounter table only need the
+        # locations and characters, so they run together as well
+        print(f"{self.region['LocationName']} - Quest or plot prompts and random encounters")
+        quest_jobs = [
+            limited(
+                "quest", i, self.llm_client.agenerate_regional_drama,
+                self.region, self.optimized_writing_style,
             )
-            self.region["locations"][loc]["illustration"] = location_map
+            for i in range(1, 7)
+        ]
+        if self.batch:
+            encounter_jobs = [limited_batch(
+                "encounter", self.region["encounters"], self.llm_client.agenerate_encounter_table,
+                self.optimized_context,
+            )]
+        else:
+            encounter_jobs = [
+                limited(
+                    "encounter", i, self.llm_client.agenerate_random_encounter,
+                    self.region, self.optimized_context,
+                )
+                for i in range(self.region["encounters"])
+            ]
+        results = await asyncio.gather(*quest_jobs, *encounter_jobs)
+        quests = results[: len(quest_jobs)]
+        encounters = results[len(quest_jobs):]
+        if self.batch:
+            encounters = encounters[0]
+
+        self.region["quests"] = {i + 1: quest for i, quest in enumerate(quests)}
+        self.region["random_encounter_table"] = {
+            i: encounter for i, encounter in enumerate(encounters)
+        }
 
         return self.region
 
-    def region_illustration_chain_sd(self, llm):
-        from adventure_generation.Automatic1111ImageGenerator import (
-            Automatic1111ImageGenerator,
+    # Illustrate characters and locations on the image queue as soon as all of
+    # a region's characters (or locations) exist, next to the remaining text
+    # steps. backend is "dalle"
+    # (llm is the GPT client) or "a1111" (llm writes the Stable Diffusion prompts).
+    # a1111 returns the AUTOMATIC1111 generator to render with, it is only
+    # called once the first image is rendered. Without it the builder makes
+    # one of its own. prompt_cache keeps the rewritten prompts, see PromptOptimizer.
+    def enable_images(self, image_queue, backend, llm, a1111=None, prompt_cache=None):
+        self.image_queue = image_queue
+        self.image_backend = backend
+        self.image_llm = llm
+        self.a1111_factory = a1111
+        # Portraits and maps of both backends are drawn in the same style
+        self.prompt_optimizer = PromptOptimizer(
+            llm, backend, self.optimized_visual_style or self.context_extractor.get_visual_style(),
+            prompt_cache,
         )
-        A1gen = Automatic1111ImageGenerator()
 
-        # Step 6 - Create character portraits
-        print(f"{self.region['LocationName']} - Generating character portraits")
-        for character in self.region["characters"]:
+    # Step 6 - Create character portraits
+    def _queue_portraits(self, characters):
+        self._queue_image_group("portrait", characters)
 
-            # customize the prompt
-            print(" > Optimizing prompt for Stable Diffusion")
-            new_prompt = llm.optimize_for_stable_diffusion(
-                self.region["characters"][character]["description"],
-                self.optimized_visual_style,
-            )
+    # Step 7 - Create location maps
+    def _queue_location_maps(self, locations):
+        self._queue_image_group("illustration", locations)
 
-            print(" > Generating Character Portrait")
-            portrait_file = A1gen.generate_character_portrait(new_prompt)
-            self.region["characters"][character]["portrait"] = portrait_file
+    # The images of a step are queued together, as one job: the prompts it
+    # still needs are optimized in one call, and AUTOMATIC1111 gets the
+    # renders pipelined to the server. step is also the field of the item the
+    # image path goes into.
+    def _queue_image_group(self, step, items):
+        if self.image_queue is None or not items:
+            return
+        # The key exists before the job starts, so saving the region while the
+        # job runs never sees the dict change size
+        for item in items.values():
+            item.setdefault(step, None)
+        descriptions = {i: item.get("description", "") for i, item in items.items()}
 
-        # Step 7 - Create location maps
-        for loc in self.region["locations"]:
+        def job():
+            paths, missing = self._journaled_items(step, sorted(items))
+            if missing:
+                with labels(self.region["LocationName"], step):
+                    prompts = self.prompt_optimizer.optimize_batch(step, [descriptions[i] for i in missing])
+                    rendered = self._render_images(step, [descriptions[i] for i in missing], prompts)
+                for i, path in zip(missing, rendered):
+                    # A failed render is not journaled, so a resumed run retries it
+                    paths[i] = self._record(step, i, path) if path else None
+            for i, path in paths.items():
+                items[i][step] = path
 
-            print(" > Optimizing prompt for Stable Diffusion")
-            new_prompt = llm.optimize_for_stable_diffusion(
-                self.region["locations"][loc]["description"],
-                self.context_extractor.get_visual_style(),
+        self.image_jobs.append(self.image_queue.submit(
+            self.image_backend, f"{self.region['LocationName']}/{step}/batch", job
+        ))
+
+    def _a1111_generator(self):
+        if self._a1111 is None and self.a1111_factory is not None:
+            self._a1111 = self.a1111_factory()
+        elif self._a1111 is None:
+            from adventure_generation.Automatic1111ImageGenerator import (
+                Automatic1111ImageGenerator,
             )
+            self._a1111 = Automatic1111ImageGenerator()
+        return self._a1111
+
+    # Render already optimized prompts, returns the image paths in order
+    def _render_images(self, step, descriptions, prompts):
+        if self.image_backend == "dalle":
+            if step == "portrait":
+                render = self.image_llm.generate_character_portrait
+            else:
+                render = self.image_llm.generate_location_maps
+            return [
+                render(
+                    description, self.optimized_context, self.prompt_optimizer.visual_style,
+                    prompt=prompt,
+                )
+                for description, prompt in zip(descriptions, prompts)
+            ]
 
-            print(" > Generating Location Map")
-            location_map = A1gen.generate_location_maps(new_prompt)
-            self.region["locations"][loc]["illustration"] = location_map
+        if step == "portrait":
+            print(" > Generating Character Portraits")
+            return self._a1111_generator().generate_character_portrait_batch(prompts)
+        print(" > Generating Location Maps")
+        return self._a1111_generator().generate_location_map_batch(prompts)
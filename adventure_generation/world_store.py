@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+
+class WorldStore:
+    """Incremental on-disk layout for a world that is being built.
+
+    root/
+        world.json       - everything in the world except its regions
+        regions/*.json   - one shard per region, replaced atomically
+        manifest.jsonl   - one line appended every time a region shard is saved
+
+    Every save only writes the region that changed, and readers never see a
+    half-written shard because each one is written to a temp file first and
+    then moved into place.
+    """
+
+    def __init__(self, root="output/json_outputs/world"):
+        self.root = root
+        self.regions_dir = os.path.join(root, "regions")
+        self.manifest_path = os.path.join(root, "manifest.jsonl")
+        self.world_path = os.path.join(root, "world.json")
+        self._lock = threading.Lock()
+        self._manifest_checked = False
+
+    # Start over for a brand new world
+    def reset(self):
+        with self._lock:
+            if os.path.exists(self.root):
+                shutil.rmtree(self.root)
+
+    # A crash mid-append can leave a partial last manifest line. It is cut off
+    # before this store appends, or the next entry would be glued to it and lost.
+    def _cut_torn_line(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r+b") as file:
+            data = file.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                logging.warning(f"Dropping a partial line at the end of {self.manifest_path}")
+                file.truncate(end)
+
+    def _shard_name(self, region_name):
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", region_name).strip("_") or "region"
+        digest = hashlib.sha1(region_name.encode("utf-8")).hexdigest()[:8]
+        return f"{slug}-{digest}.json"
+
+    def _atomic_write(self, path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def save_world_info(self, world):
+        info = {key: value for key, value in world.items() if key != "regions"}
+        self._atomic_write(self.world_path, json.dumps(info, indent=4))
+
+    def save_region(self, region, stage):
+        shard = self._shard_name(region["LocationName"])
+        data = json.dumps(region, indent=4)
+        self._atomic_write(os.path.join(self.regions_dir, shard), data)
+
+        entry = {
+            "region": region["LocationName"],
+            "file": os.path.join("regions", shard),
+            "stage": stage,
+            "sha256": hashlib.sha256(data.encode("utf-8")).hexdigest(),
+            "time": time.time(),
+        }
+        with self._lock:
+            if not self._manifest_checked:
+                self._cut_torn_line()
+                self._manifest_checked = True
+            with open(self.manifest_path, "a") as file:
+                file.write(json.dumps(entry) + "\n")
+
+    # The latest manifest entry of each region, in the order regions first appeared
+    def manifest(self):
+        entries = {}
+        if not os.path.exists(self.manifest_path):
+            return entries
+        with open(self.manifest_path, "r") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    continue
+                entries[entry["region"]] = entry
+        return entries
+
+    def load_world(self):
+        world = {}
+        if os.path.exists(self.world_path):
+            with open(self.world_path, "r") as file:
+                world = json.load(file)
+        regions = []
+        for entry in self.manifest().values():
+            with open(os.path.join(self.root, entry["file"]), "r") as file:
+                regions.append(json.load(file))
+        world["regions"] = regions
+        return world
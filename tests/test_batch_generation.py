@@ -0,0 +1,91 @@
+import asyncio
+
+from adventure_generation import batch_generation
+from adventure_generation.batch_generation import agenerate_batch, generate_batch
+
+
+class FakeBudget:
+    def count(self, prompt):
+        return len(prompt)
+
+
+class FakeStructures:
+    def normalize(self, kind, item):
+        return item
+
+    def validate(self, kind, item):
+        return isinstance(item, dict) and "name" in item
+
+
+# Answers every batch from `answers`, one response per call
+class FakeClient:
+    def __init__(self, answers, max_output_tokens=4000, context_window=100000):
+        self.answers = list(answers)
+        self.max_output_tokens = max_output_tokens
+        self.context_window = context_window
+        self.budget = FakeBudget()
+        self.jstructs = FakeStructures()
+        self.prompts = []
+
+    def _chat_json(self, prompt, max_tokens=None):
+        self.prompts.append(prompt)
+        return self.answers.pop(0) if self.answers else {}
+
+    async def _achat_json(self, prompt, max_tokens=None):
+        return self._chat_json(prompt, max_tokens)
+
+
+def items(*names):
+    return {"items": [{"name": name} for name in names]}
+
+
+def tracked_prompts():
+    built = []
+
+    def build_prompt(first, size):
+        built.append((first, size))
+        return f"items {first}..{first + size - 1}"
+    return built, build_prompt
+
+
+def test_one_call_builds_its_prompt_once():
+    built, build_prompt = tracked_prompts()
+    client = FakeClient([items("a", "b", "c")])
+    result = generate_batch(client, "location", 3, build_prompt, lambda index: {"name": f"single {index}"})
+    assert [item["name"] for item in result] == ["a", "b", "c"]
+    assert built == [(0, 3)]
+
+
+def test_batch_that_does_not_fit_is_built_again_smaller():
+    built, build_prompt = tracked_prompts()
+    # Room for two locations per call
+    client = FakeClient([items("a", "b"), items("c")], max_output_tokens=2 * batch_generation.ITEM_TOKENS["location"])
+    result = generate_batch(client, "location", 3, build_prompt, lambda index: {"name": f"single {index}"})
+    assert [item["name"] for item in result] == ["a", "b", "c"]
+    assert built == [(0, 3), (0, 2), (2, 1)]
+
+
+def test_invalid_items_are_asked_for_again_then_one_by_one():
+    _, build_prompt = tracked_prompts()
+    client = FakeClient([{"items": [{"name": "a"}, {"oops": 1}]}, {"items": []}, {"items": []}])
+    result = generate_batch(client, "character", 3, build_prompt, lambda index: {"name": f"single {index}"})
+    assert [item["name"] for item in result] == ["a", "single 1", "single 2"]
+    assert len(client.prompts) == 1 + batch_generation.MAX_EMPTY_BATCHES
+
+
+def test_extra_and_renamed_items():
+    _, build_prompt = tracked_prompts()
+    client = FakeClient([{"encounters": [{"name": "a"}, {"name": "b"}, {"name": "c"}]}])
+    result = generate_batch(client, "encounter", 2, build_prompt, lambda index: {"name": f"single {index}"})
+    assert [item["name"] for item in result] == ["a", "b"]
+
+
+def test_async_twin():
+    _, build_prompt = tracked_prompts()
+    client = FakeClient([items("a")])
+
+    async def single(index):
+        return {"name": f"single {index}"}
+
+    result = asyncio.run(agenerate_batch(client, "location", 2, build_prompt, single))
+    assert [item["name"] for item in result] == ["a", "single 1"]
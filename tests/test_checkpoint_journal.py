@@ -0,0 +1,59 @@
+import json
+
+from adventure_generation.checkpoint_journal import CheckpointJournal
+
+
+def test_steps_survive_a_restart(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = CheckpointJournal(path)
+    journal.record("Cove", "plan", 0, {"num_locations": 2})
+    journal.record("Cove", "location", 1, {"name": "Harbor"})
+    journal.record("Cove", "location", 1, {"name": "Harbor, again"})
+
+    resumed = CheckpointJournal(path)
+    assert len(resumed) == 2
+    assert resumed.get("Cove", "plan") == {"num_locations": 2}
+    assert resumed.get("Cove", "location", 1) == {"name": "Harbor, again"}
+    assert not resumed.has("Cove", "location", 0)
+
+
+def test_torn_last_line(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    CheckpointJournal(str(path)).record("Cove", "description", 0, {"description": "a cove"})
+    torn = json.dumps({"region": "Cove", "step": "location", "index": 0, "output": {"name": "Har"}})
+    with open(path, "a") as file:
+        file.write(torn[:30])
+
+    resumed = CheckpointJournal(str(path))
+    assert len(resumed) == 1
+    assert not resumed.has("Cove", "location", 0)
+
+    # The next step starts on a line of its own and is there after another restart
+    resumed.record("Cove", "location", 0, {"name": "Harbor"})
+    again = CheckpointJournal(str(path))
+    assert again.get("Cove", "location", 0) == {"name": "Harbor"}
+    assert again.get("Cove", "description", 0) == {"description": "a cove"}
+
+
+def test_unreadable_line_in_the_middle_is_skipped(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    lines = [
+        json.dumps({"region": "Cove", "step": "quest", "index": 1, "output": "find the bell"}),
+        "{not json",
+        json.dumps({"region": "Cove", "step": "quest", "index": 2, "output": "ring it"}),
+    ]
+    path.write_text("\n".join(lines) + "\n")
+    journal = CheckpointJournal(str(path))
+    assert [journal.get("Cove", "quest", i) for i in (1, 2)] == ["find the bell", "ring it"]
+
+
+def test_clear(tmp_path):
+    path = tmp_path / "json_outputs" / "journal.jsonl"
+    journal = CheckpointJournal(str(path))
+    journal.record("Cove", "plan", 0, {})
+    journal.clear()
+    assert len(journal) == 0
+    assert not path.exists()
+    assert len(CheckpointJournal(str(path))) == 0
+    # Clearing a journal that was never written is fine too
+    CheckpointJournal(str(tmp_path / "none.jsonl")).clear()
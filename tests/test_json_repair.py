@@ -0,0 +1,52 @@
+import pytest
+
+from adventure_generation.json_repair import JsonRepairError, RepairStats, repair_json
+
+
+def test_valid_json_is_left_alone():
+    assert repair_json('{"a": [1, 2], "b": "c"}') == {"a": [1, 2], "b": "c"}
+
+
+def test_fences_and_chatter():
+    text = 'Sure! Here is the region:\n```json\n{"name": "Ariel Coast"}\n```\nEnjoy.'
+    assert repair_json(text) == {"name": "Ariel Coast"}
+
+
+def test_single_quotes_like_our_examples():
+    text = "{'regionDetails' : {'description' : 'It\\'s \"windy\"', 'lore' : 'old'}}"
+    assert repair_json(text) == {"regionDetails": {"description": "It's \"windy\"", "lore": "old"}}
+
+
+def test_trailing_commas_and_python_literals():
+    assert repair_json('{"a": [1, 2,], "b": True, "c": None,}') == {"a": [1, 2], "b": True, "c": None}
+
+
+def test_bare_keys_and_words():
+    assert repair_json('{name: Tharos, level: 3}') == {"name": "Tharos", "level": 3}
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": "cut off in the mid', {"a": "cut off in the mid"}),
+    ('{"a": [1, 2', {"a": [1, 2]}),
+    ('{"a": 1, "b": ', {"a": 1}),
+    ('{"a": 1, "b"', {"a": 1}),
+    ('[{"a": 1}, {"b": 2},', [{"a": 1}, {"b": 2}]),
+])
+def test_truncated_output_is_closed(text, expected):
+    assert repair_json(text) == expected
+
+
+def test_no_json_at_all():
+    with pytest.raises(JsonRepairError):
+        repair_json("I can not help with that.")
+
+
+def test_repair_stats():
+    stats = RepairStats()
+    stats.record("gpt-4o", "local")
+    stats.record("gpt-4o", "local")
+    stats.record("gpt-4o", "llm")
+    stats.record("gpt-4o", "failed")
+    report = stats.summary()["gpt-4o"]
+    assert report["broken"] == 4
+    assert report["local_success_rate"] == 0.5
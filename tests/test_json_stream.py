@@ -0,0 +1,45 @@
+import pytest
+
+from adventure_generation.json_stream import MAX_PRELUDE_CHARS, JsonStreamParser, StreamOffSchema
+
+
+def feed(parser, text, chunk_size=3):
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+        if parser.complete:
+            return start + chunk_size
+    return len(text)
+
+
+def test_complete_once_the_required_key_is_closed():
+    parser = JsonStreamParser(["regionDetails"])
+    text = '{"regionDetails": {"description": "a \\"windy\\" coast", "lore": "old"}, "extra": "never read'
+    read = feed(parser, text)
+    assert parser.complete
+    assert read < len(text)
+    assert parser.completed_keys == {"regionDetails"}
+
+
+def test_nested_keys_do_not_count():
+    parser = JsonStreamParser(["lore"])
+    feed(parser, '{"regionDetails": {"lore": "old"}')
+    assert not parser.complete
+
+
+def test_plain_values_and_prelude():
+    parser = JsonStreamParser(["name", "level"])
+    feed(parser, 'Here you go: {"name": "Tharos", "level": 3}')
+    assert parser.complete
+    assert parser.closed
+
+
+def test_closed_object_without_the_keys_is_off_schema():
+    parser = JsonStreamParser(["regionDetails"])
+    with pytest.raises(StreamOffSchema):
+        feed(parser, '{"description": "a coast", "lore": "old"}')
+
+
+def test_long_prelude_is_off_schema():
+    parser = JsonStreamParser(["name"])
+    with pytest.raises(StreamOffSchema):
+        feed(parser, "I am sorry, " * (MAX_PRELUDE_CHARS // 10))
@@ -0,0 +1,101 @@
+from adventure_generation.batch_generation import keyed_prompts
+from adventure_generation.image_queue import ImageJobQueue
+from adventure_generation.llm_cache import LLMCache
+from adventure_generation.prompt_optimizer import PromptOptimizer
+from adventure_generation.world_builder import WorldBuilder
+
+# A batched rewrite is matched to its descriptions by number. A short or
+# shuffled answer must never put one image's prompt in another's cache entry.
+
+
+class FakeOllama:
+    def __init__(self, batch_answer):
+        self.batch_answer = batch_answer
+        self.single_calls = []
+
+    def optimize_for_stable_diffusion_batch(self, descriptions, visual_style):
+        return keyed_prompts(self.batch_answer, len(descriptions))
+
+    def optimize_for_stable_diffusion(self, description, visual_style):
+        self.single_calls.append(description)
+        return f"single {description}"
+
+
+def optimizer(tmp_path, batch_answer):
+    cache = LLMCache(path=str(tmp_path / "prompts.sqlite"), mode="readthrough")
+    return PromptOptimizer(FakeOllama(batch_answer), "a1111", "ink", cache=cache)
+
+
+def test_keyed_answer_in_any_order(tmp_path):
+    prompts = optimizer(tmp_path, {"prompts": {"2": "b", "1": "a", "3": "c"}})
+    assert prompts.optimize_batch("portrait", ["A", "B", "C"]) == ["a", "b", "c"]
+    assert prompts.llm.single_calls == []
+
+
+def test_skipped_number_is_asked_alone(tmp_path):
+    prompts = optimizer(tmp_path, {"prompts": {"1": "a", "3": "c"}})
+    assert prompts.optimize_batch("portrait", ["A", "B", "C"]) == ["a", "single B", "c"]
+    assert prompts.llm.single_calls == ["B"]
+
+
+def test_short_list_is_not_cached(tmp_path):
+    prompts = optimizer(tmp_path, {"prompts": ["a", "c"]})
+    assert prompts.optimize_batch("portrait", ["A", "B", "C"]) == ["single A", "single B", "single C"]
+
+    # Nothing from the dropped batch landed in the cache
+    again = optimizer(tmp_path, {"prompts": {"1": "x", "2": "y", "3": "z"}})
+    assert again.optimize_batch("portrait", ["A", "B", "C"]) == ["single A", "single B", "single C"]
+    assert again.llm.single_calls == []
+
+
+def test_keyed_prompts():
+    assert keyed_prompts({"prompts": ["a", "b"]}, 2) == ["a", "b"]
+    assert keyed_prompts({"prompts": ["a"]}, 2) == [None, None]
+    assert keyed_prompts({"1": "a", "2": " "}, 2) == ["a", None]
+    assert keyed_prompts("nonsense", 2) == [None, None]
+
+
+class FakeContext:
+    optimized_context = "a coast"
+    optimized_writing_style = "terse"
+    optimized_visual_style = "ink"
+
+
+class FakeWriter(FakeOllama):
+    def __init__(self):
+        super().__init__({})
+        self.batches = []
+        self.locations = 0
+
+    def generate_location(self, region, context, style):
+        self.locations += 1
+        return {"name": f"Place {self.locations}", "description": "a cove"}
+
+    def optimize_for_stable_diffusion_batch(self, descriptions, visual_style):
+        self.batches.append(list(descriptions))
+        return [f"keywords {i}" for i, _ in enumerate(descriptions)]
+
+
+class FakeA1111:
+    def generate_location_map_batch(self, prompts):
+        return [f"maps/{prompt}.png" for prompt in prompts]
+
+
+# Unbatched items still share one rewrite call per step of a region
+def test_region_images_share_one_rewrite_call(tmp_path):
+    writer = FakeWriter()
+    builder = WorldBuilder(FakeContext(), {"LocationName": "Cove", "num_locations": 3}, writer)
+    image_queue = ImageJobQueue()
+    builder.enable_images(image_queue, "a1111", writer, FakeA1111, LLMCache(str(tmp_path / "p.sqlite"), mode="off"))
+
+    for i in range(3):
+        builder.create_location(i)
+    builder.collect_locations()
+    image_queue.join()
+
+    assert len(writer.batches) == 1
+    assert len(writer.batches[0]) == 3
+    assert writer.single_calls == []
+    assert [loc["illustration"] for loc in builder.region["locations"].values()] == [
+        "maps/keywords 0.png", "maps/keywords 1.png", "maps/keywords 2.png",
+    ]
@@ -0,0 +1,85 @@
+import pytest
+
+from adventure_generation import rate_limiter
+from adventure_generation.rate_limiter import RateLimiter, TokenBucket, estimate_tokens, parse_duration
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("20ms", 0.02),
+    ("1s", 1.0),
+    ("6m0s", 360.0),
+    ("1h2m", 3720.0),
+    ("2.5", 2.5),
+    ("soon", None),
+    (None, None),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == (pytest.approx(seconds) if seconds is not None else None)
+
+
+def test_estimate_tokens():
+    messages = [{"role": "user", "content": "x" * 40}, {"role": "user", "content": [{"text": "y" * 40}]}]
+    assert estimate_tokens(messages, max_tokens=100) == 120
+
+
+def test_bucket_goes_into_debt_and_refills():
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60, now=bucket.updated) == 0.0
+    # One per second: the next two callers queue behind each other
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(1.0)
+    assert bucket.reserve(1, now=bucket.updated) == pytest.approx(2.0)
+    assert bucket.reserve(1, now=bucket.updated + 10) == 0.0
+
+
+def test_no_wait_while_there_is_headroom():
+    limiter = RateLimiter()
+    assert all(limiter.acquire("openai", "gpt-4o", tokens=100) == 0.0 for _ in range(10))
+
+
+def test_headers_resize_the_buckets_and_block(monkeypatch):
+    limiter = RateLimiter()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: 1000.0)
+    blocked = limiter.update_from_headers("openai", "gpt-4o", {
+        "x-ratelimit-limit-requests": "10",
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "6s",
+    })
+    assert blocked
+    assert limiter._buckets[("openai", "gpt-4o", "rpm")].capacity == 10
+    assert limiter._reserve("openai", "gpt-4o", 0) >= 6.0
+
+
+def test_retry_after_blocks_the_model_only(monkeypatch):
+    limiter = RateLimiter()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: 1000.0)
+    assert limiter.update_from_headers("openai", "gpt-4o", {"retry-after-ms": "1500"})
+    assert limiter._reserve("openai", "gpt-4o", 0) == pytest.approx(1.5)
+    assert limiter._reserve("openai", "gpt-4o-mini", 0) == 0.0
+
+
+def test_headers_without_a_wait():
+    limiter = RateLimiter()
+    assert not limiter.update_from_headers("openai", "gpt-4o", {})
+    assert not limiter.update_from_headers("openai", "gpt-4o", {"x-ratelimit-remaining-requests": "5"})
+
+
+def test_backoff_is_jittered_and_capped(monkeypatch):
+    limiter = RateLimiter()
+    monkeypatch.setattr(rate_limiter.time, "monotonic", lambda: 1000.0)
+    delays = [limiter.backoff("openai", "gpt-4o", attempt) for attempt in range(12)]
+    assert all(0 <= delay <= min(rate_limiter.BACKOFF_CAP, rate_limiter.BACKOFF_BASE * 2 ** attempt)
+               for attempt, delay in enumerate(delays))
+    assert len(set(delays)) > 1
+    assert limiter._reserve("openai", "gpt-4o", 0) == pytest.approx(max(delays))
+
+
+def test_set_limits():
+    limiter = RateLimiter()
+    limiter.set_limits("openai", "dall-e-3", rpm=5)
+    assert limiter._buckets[("openai", "dall-e-3", "rpm")].capacity == 5
+    # A model without defaults gets a bucket too
+    limiter.set_limits("openai", "some-model", rpm=7, tpm=700)
+    assert limiter._buckets[("openai", "some-model", "tpm")].capacity == 700
+    waits = [limiter.acquire("openai", "dall-e-3") for _ in range(5)]
+    assert waits == [0.0] * 5
+    assert limiter._reserve("openai", "dall-e-3", 0) > 0
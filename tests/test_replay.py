@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from adventure_generation.benchmark import PACKAGE_DIR, SAMPLE_INPUTS, synthetic_world
+from adventure_generation.mock_backend import MockBackend, MockSettings
+
+# A seeded run recorded with AC_LLM_CACHE=writeonly has to replay from the
+# cache alone: the same world must send the very same requests.
+
+
+@pytest.fixture
+def backend():
+    with MockBackend(MockSettings(latency=0, image_latency=0, world=synthetic_world(2, seed=3))) as backend:
+        yield backend
+
+
+def run_main(backend, workdir, cache_path, mode, **settings):
+    os.makedirs(workdir)
+    os.symlink(PACKAGE_DIR, os.path.join(workdir, "adventure_generation"))
+    with open(os.path.join(workdir, "map_description.json"), "w") as file:
+        json.dump(backend.settings.world, file)
+
+    env = dict(os.environ, PYTHONPATH=workdir)
+    env.update(backend.environment())
+    env.update({
+        "AC_ASSUME_YES": "True",
+        "AC_CREATE_IMAGES": "False",
+        "AC_DEBUG": "True",
+        "AC_SEED": "7",
+        "AC_LLM_CACHE": mode,
+        "AC_LLM_CACHE_PATH": cache_path,
+    })
+    env.update(settings)
+    return subprocess.run(
+        [
+            sys.executable, "-m", "adventure_generation.main",
+            os.path.join(SAMPLE_INPUTS, "ariel_coast.txt"),
+            os.path.join(SAMPLE_INPUTS, "ariel_coast.jpg"),
+            os.path.join(SAMPLE_INPUTS, "styles.json"),
+        ],
+        cwd=workdir, env=env, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=300,
+    )
+
+
+@pytest.mark.parametrize("settings", [
+    {},
+    {"AC_BATCH_ITEMS": "True"},
+    {"AC_ASYNC": "True", "AC_BATCH_ITEMS": "True"},
+])
+def test_replay_after_writeonly(backend, tmp_path, settings):
+    cache_path = str(tmp_path / "llm_cache.sqlite")
+
+    recorded = run_main(backend, str(tmp_path / "record"), cache_path, "writeonly", **settings)
+    assert recorded.returncode == 0, recorded.stdout + recorded.stderr
+    assert backend.stats().get("requests", 0) > 0
+
+    backend.reset_stats()
+    replayed = run_main(backend, str(tmp_path / "replay"), cache_path, "replay", **settings)
+    assert replayed.returncode == 0, replayed.stdout + replayed.stderr
+    assert backend.stats().get("requests", 0) == 0
+
+    assert regions(tmp_path / "replay") == regions(tmp_path / "record")
+
+
+# The regions of a world by name, they are saved in the order they finish.
+# The quests (and unbatched encounters) of a region are identical requests,
+# answered by the cache in the order the threads ask, so only their set counts.
+def regions(workdir):
+    with open(workdir / "output" / "json_outputs" / "expanded_world.json") as file:
+        world = json.load(file)
+    for region in world["regions"]:
+        for table in ("quests", "random_encounter_table"):
+            region[table] = sorted(json.dumps(item, sort_keys=True) for item in region[table].values())
+    return {region["LocationName"]: region for region in world["regions"]}
@@ -0,0 +1,48 @@
+from adventure_generation.pipeline import Pipeline, RunConfig
+from adventure_generation.llm_cache import get_llm_cache
+
+# Everything a pipeline's clients use comes from its RunConfig, so two
+# pipelines of one process can differ in it.
+
+
+def test_from_env(monkeypatch):
+    for name, value in {
+        "AC_MAP_TILES": "auto",
+        "AC_HTTP_POOL_SIZE": "30",
+        "AC_A1111_PIPELINE": "4",
+        "AC_A1111_FORMAT": "webp",
+        "AC_OLLAMA_NUM_CTX": "8192",
+        "AC_LLM_CACHE": "replay",
+        "AC_LLM_CACHE_PATH": "elsewhere.sqlite",
+        "AC_CACHE_SALT": "pepper",
+        "AC_PROMPT_CACHE": "off",
+    }.items():
+        monkeypatch.setenv(name, value)
+    config = RunConfig.from_env()
+    assert config.map_tiles == "auto"
+    assert config.http_pool_size == 30
+    assert (config.a1111_pipeline, config.a1111_format) == (4, "webp")
+    assert config.ollama_num_ctx == 8192
+    assert (config.llm_cache, config.llm_cache_path, config.cache_salt) == ("replay", "elsewhere.sqlite", "pepper")
+    assert config.prompt_cache is False
+
+
+def test_pipelines_keep_their_own_settings(tmp_path, monkeypatch):
+    monkeypatch.setenv("AC_LLM_CACHE", "replay")
+    first = Pipeline(RunConfig(
+        output_root=str(tmp_path / "a"), llm_cache="readthrough", llm_cache_path=str(tmp_path / "a.sqlite"),
+        max_threads=6, a1111_pipeline=3,
+    ))
+    second = Pipeline(RunConfig(output_root=str(tmp_path / "b"), http_pool_size=5))
+
+    first_options, second_options = first.backend_options(), second.backend_options()
+    assert first_options["openai"]["cache"].mode == "readthrough"
+    assert first_options["openai"]["cache"].path == str(tmp_path / "a.sqlite")
+    assert second_options["ollama"]["cache"].mode == "off"
+    assert first_options["openai"]["pool_size"] == max(6, 8) + 4
+    assert second_options["a1111"]["pool_size"] == 5
+    assert first_options["a1111"]["pipeline_depth"] == 3
+
+    # Same settings, same cache
+    assert first.llm_cache() is get_llm_cache("readthrough", str(tmp_path / "a.sqlite"), "")
+    assert first.prompt_cache() is not Pipeline(RunConfig(prompt_cache=False)).prompt_cache()
@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+
+import pytest
+
+from adventure_generation.benchmark import SAMPLE_INPUTS, synthetic_world
+from adventure_generation.mock_backend import MockBackend, MockSettings
+from adventure_generation.pipeline import RunConfig
+from adventure_generation.service import GenerationService, JobQueue, SharedCapacity, TERMINAL_STATES
+
+
+def add_jobs(jobs, tmp_path, *priorities):
+    return [
+        jobs.add(f"job{i}", "context.txt", "map.jpg", "styles.json", priority, str(tmp_path / "jobs"))
+        for i, priority in enumerate(priorities)
+    ]
+
+
+def test_claim_takes_the_highest_priority_then_the_oldest(tmp_path):
+    jobs = JobQueue(str(tmp_path / "jobs.sqlite"))
+    add_jobs(jobs, tmp_path, 0, 5, 0, 5)
+    claimed = [jobs.claim() for _ in range(4)]
+    assert [job["name"] for job in claimed] == ["job1", "job3", "job0", "job2"]
+    assert all(job["state"] == "running" and job["started"] for job in claimed)
+    assert jobs.claim() is None
+
+
+def test_running_jobs_are_queued_again_after_a_restart(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    jobs = JobQueue(path)
+    first, second, _ = add_jobs(jobs, tmp_path, 0, 0, 0)
+    jobs.claim()
+    jobs.claim()
+    jobs.update(first["id"], state="done")
+    jobs.close()
+
+    restarted = JobQueue(path)
+    assert restarted.requeue_running() == 1
+    assert [job["state"] for job in restarted.list()] == ["done", "queued", "queued"]
+    # The interrupted job is older, so it goes first
+    assert restarted.claim()["id"] == second["id"]
+    restarted.close()
+
+
+def wait_until(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_free_slot_goes_to_the_highest_priority():
+    capacity = SharedCapacity(1)
+    capacity.acquire()
+    order = []
+
+    def step(name, priority):
+        with capacity.for_priority(priority):
+            order.append(name)
+
+    threads = []
+    for name, priority in [("big", 0), ("urgent", 5), ("normal", 1), ("urgent, later", 5)]:
+        threads.append(threading.Thread(target=step, args=(name, priority)))
+        threads[-1].start()
+        # Each step waits before the next one asks
+        wait_until(lambda: len(capacity._waiting) == len(threads))
+
+    capacity.release()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert order == ["urgent", "urgent, later", "normal", "big"]
+
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    # Slow enough answers that a job is still running when it is cancelled
+    settings = MockSettings(latency=0.1, latency_sigma=0, world=synthetic_world(3, seed=1))
+    with MockBackend(settings) as backend:
+        for name, value in backend.environment().items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.chdir(tmp_path)
+        config = RunConfig(create_images=False, stage_cache=False, seed=7, output_root=str(tmp_path / "output"))
+        service = GenerationService(str(tmp_path / "service"), jobs=1, config=config).start()
+        yield service
+        service.stop()
+
+
+def submit(service, name):
+    return service.submit(
+        os.path.join(SAMPLE_INPUTS, "ariel_coast.txt"),
+        os.path.join(SAMPLE_INPUTS, "ariel_coast.jpg"),
+        os.path.join(SAMPLE_INPUTS, "styles.json"),
+        name=name,
+    )
+
+
+def events(service, job_id):
+    return [event["event"] for event in service.queue.events(job_id)]
+
+
+def test_cancel_queued_and_running_jobs(service):
+    # One job at a time: the second waits in the queue
+    running = submit(service, "running")
+    waiting = submit(service, "waiting")
+
+    cancelled = service.cancel(waiting["id"])
+    assert cancelled["state"] == "cancelled"
+    assert cancelled["started"] is None
+    assert events(service, waiting["id"]) == ["queued", "cancelled"]
+
+    wait_until(lambda: "planned" in events(service, running["id"]), timeout=60)
+    assert service.cancel(running["id"])["state"] == "running"
+    # The job row is written just before its last event, so wait for the event
+    wait_until(lambda: events(service, running["id"])[-1] in TERMINAL_STATES, timeout=60)
+
+    job = service.queue.get(running["id"])
+    assert job["state"] == "cancelled"
+    assert job["done"] < job["regions"]
+    history = events(service, running["id"])
+    assert "cancelling" in history and history[-1] == "cancelled"
+    # The cancelled job was never picked up
+    assert service.queue.get(waiting["id"])["started"] is None
+    assert service.cancel(12345) is None
@@ -0,0 +1,43 @@
+import os
+
+from adventure_generation.stage_cache import StageCache, hash_text
+
+
+def test_stage_is_built_once_per_inputs(tmp_path):
+    cache = StageCache(str(tmp_path))
+    builds = []
+
+    def build():
+        builds.append(1)
+        return {"summary": "a coast"}
+
+    inputs = {"context": hash_text("a coast")}
+    assert cache.get_or_build("summary", inputs, build) == {"summary": "a coast"}
+    assert cache.get_or_build("summary", inputs, build) == {"summary": "a coast"}
+    assert len(builds) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Only the stage whose inputs changed runs again
+    cache.get_or_build("summary", {"context": hash_text("a desert")}, build)
+    assert len(builds) == 2
+
+
+def test_a_new_process_reuses_the_artifact(tmp_path):
+    StageCache(str(tmp_path)).get_or_build("map", {"image": "abc"}, lambda: [1, 2])
+    assert StageCache(str(tmp_path)).get_or_build("map", {"image": "abc"}, lambda: [3]) == [1, 2]
+
+
+def test_unreadable_artifact_is_rebuilt(tmp_path):
+    cache = StageCache(str(tmp_path))
+    cache.get_or_build("map", {"image": "abc"}, lambda: [1, 2])
+    (path,) = [tmp_path / name for name in os.listdir(tmp_path)]
+    path.write_text('{"artifact": [1,')
+    assert cache.get_or_build("map", {"image": "abc"}, lambda: [3]) == [3]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_disabled_cache_always_builds(tmp_path):
+    cache = StageCache(str(tmp_path), enabled=False)
+    assert cache.get_or_build("map", {"image": "abc"}, lambda: 1) == 1
+    assert cache.get_or_build("map", {"image": "abc"}, lambda: 2) == 2
+    assert os.listdir(tmp_path) == []
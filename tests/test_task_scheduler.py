@@ -0,0 +1,86 @@
+import threading
+
+import pytest
+
+from adventure_generation.task_scheduler import TaskCancelled, TaskScheduler
+
+
+def recorder():
+    order = []
+    lock = threading.Lock()
+
+    def step(name):
+        def run():
+            with lock:
+                order.append(name)
+            return name
+        return run
+    return order, step
+
+
+def test_dependencies_run_first():
+    order, step = recorder()
+    scheduler = TaskScheduler(max_workers=4)
+    region = scheduler.add("region", step("region"))
+    locations = scheduler.add("locations", step("locations"), deps=[region])
+    characters = scheduler.add("characters", step("characters"), deps=[region])
+    scheduler.add("quests", step("quests"), deps=[locations, characters])
+    scheduler.run()
+    assert order[0] == "region"
+    assert order[-1] == "quests"
+    assert set(order[1:3]) == {"locations", "characters"}
+
+
+def test_longest_chain_starts_first():
+    order, step = recorder()
+    scheduler = TaskScheduler(max_workers=1)
+    scheduler.add("small town", step("small town"), cost=1)
+    big = scheduler.add("big town", step("big town"), cost=1)
+    scheduler.add("big town quests", step("big town quests"), deps=[big], cost=5)
+    scheduler.run()
+    assert order == ["big town", "big town quests", "small town"]
+
+
+def test_failure_skips_only_its_dependents():
+    order, step = recorder()
+    scheduler = TaskScheduler(max_workers=2)
+
+    def fail():
+        raise RuntimeError("boom")
+
+    broken = scheduler.add("broken", fail)
+    scheduler.add("after broken", step("after broken"), deps=[broken])
+    scheduler.add("other", step("other"))
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert order == ["other"]
+    assert set(scheduler.errors) == {"broken", "after broken"}
+
+
+def test_cancel_stops_new_tasks():
+    order, step = recorder()
+    scheduler = TaskScheduler(max_workers=1)
+    first = scheduler.add("first", lambda: scheduler.cancel())
+    scheduler.add("second", step("second"), deps=[first])
+    with pytest.raises(TaskCancelled):
+        scheduler.run()
+    assert order == []
+
+
+def test_scoped_names_and_duplicates():
+    scheduler = TaskScheduler()
+    scheduler.scoped("coast").add("region", lambda: None)
+    scheduler.scoped("desert").add("region", lambda: None)
+    assert set(scheduler.tasks) == {"coast:region", "desert:region"}
+    with pytest.raises(ValueError):
+        scheduler.scoped("coast").add("region", lambda: None)
+
+
+def test_cycle_is_rejected():
+    scheduler = TaskScheduler()
+    a = scheduler.add("a", lambda: None)
+    b = scheduler.add("b", lambda: None, deps=[a])
+    a.deps.append(b)
+    b.dependents.append(a)
+    with pytest.raises(ValueError):
+        scheduler.run()
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+from PIL import Image
+
+from adventure_generation import web_assets
+from adventure_generation.web_assets import WebAssets
+
+
+def image(path, width=600, height=400):
+    Image.new("RGB", (width, height), (120, 80, 40)).save(path, format="PNG")
+    return str(path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_broken_image_is_left_out(tmp_path, workers):
+    good = image(tmp_path / "good.png")
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(open(good, "rb").read()[:200])
+    junk = tmp_path / "junk.png"
+    junk.write_text("not an image")
+
+    assets = WebAssets(str(tmp_path / "assets"), workers)
+    records = assets.process([good, str(broken), str(junk), str(tmp_path / "missing.png")])
+
+    assert list(records) == [good]
+    assert [width for width, _ in records[good]["jpeg"]] == [160, 480, 600]
+    for _, name in records[good]["jpeg"]:
+        assert os.path.isfile(tmp_path / "assets" / name)
+
+
+def test_known_images_are_not_processed_again(tmp_path, monkeypatch):
+    good = image(tmp_path / "good.png")
+    first = WebAssets(str(tmp_path / "assets")).process([good])
+
+    def boom(*job):
+        raise AssertionError("processed again")
+
+    monkeypatch.setattr(web_assets, "make_derivatives", boom)
+    assert WebAssets(str(tmp_path / "assets")).process([good]) == first
@@ -0,0 +1,76 @@
+import os
+import json
+
+import pytest
+
+from adventure_generation import world_store
+from adventure_generation.world_store import WorldStore
+
+
+def region(name, **fields):
+    return dict({"LocationName": name, "LocationType": "smallTown"}, **fields)
+
+
+def shards(store):
+    return sorted(os.listdir(store.regions_dir))
+
+
+def test_shard_is_replaced_in_place(tmp_path):
+    store = WorldStore(str(tmp_path / "world"))
+    store.save_region(region("Salt Cove"), "text")
+    store.save_region(region("Salt Cove", characters={"Ana": {}}), "illustrated")
+
+    (shard,) = shards(store)
+    with open(os.path.join(store.regions_dir, shard)) as file:
+        assert json.load(file)["characters"] == {"Ana": {}}
+    assert store.manifest()["Salt Cove"]["stage"] == "illustrated"
+
+
+def test_failed_write_keeps_the_old_shard(tmp_path, monkeypatch):
+    store = WorldStore(str(tmp_path / "world"))
+    store.save_region(region("Salt Cove", lore="old"), "text")
+
+    def crash(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(world_store.os, "replace", crash)
+    with pytest.raises(OSError):
+        store.save_region(region("Salt Cove", lore="new"), "illustrated")
+    monkeypatch.undo()
+
+    assert shards(store) == [store._shard_name("Salt Cove")]
+    assert store.load_world()["regions"][0]["lore"] == "old"
+
+
+def test_world_is_rebuilt_from_the_manifest(tmp_path):
+    store = WorldStore(str(tmp_path / "world"))
+    store.save_world_info({"title": "Ariel Coast", "regions": []})
+    store.save_region(region("Salt Cove"), "text")
+    store.save_region(region("Deep Wild"), "text")
+    store.save_region(region("Salt Cove", lore="new"), "illustrated")
+
+    world = WorldStore(store.root).load_world()
+    assert world["title"] == "Ariel Coast"
+    # Regions in the order they first appeared, each at its latest save
+    assert [r["LocationName"] for r in world["regions"]] == ["Salt Cove", "Deep Wild"]
+    assert world["regions"][0]["lore"] == "new"
+
+
+def test_torn_manifest_line(tmp_path):
+    store = WorldStore(str(tmp_path / "world"))
+    store.save_region(region("Salt Cove"), "text")
+    with open(store.manifest_path, "a") as file:
+        file.write('{"region": "Deep Wild", "fi')
+
+    # A resumed run appends after the partial line, not onto it
+    resumed = WorldStore(store.root)
+    resumed.save_region(region("Deep Wild"), "text")
+    assert list(WorldStore(store.root).manifest()) == ["Salt Cove", "Deep Wild"]
+
+
+def test_reset(tmp_path):
+    store = WorldStore(str(tmp_path / "world"))
+    store.save_region(region("Salt Cove"), "text")
+    store.reset()
+    assert not os.path.exists(store.root)
+    assert store.load_world() == {"regions": []}